@@ -11,29 +11,43 @@ import warnings
 
 # Sci stack
 import iris
+from loguru import logger
 
 # My packages and local scripts
 from aeolus.const import add_planet_conf_to_cubes, init_const
 from aeolus.coord import get_cube_rel_days
-from aeolus.io import save_cubelist
 from aeolus.model import lfric
 from aeolus.subset import DimConstr, unique_cubes
+from lfric_chunks import (
+    chunk_day,
+    find_chunks,
+    find_mesh_fields,
+    load_field_pack,
+    load_lfric_fields,
+    load_partials,
+    partial_fname,
+    process_windows,
+    remove_partials,
+    split_into_windows,
+)
+from io_utils import CHUNK_LAYOUTS, save_output
+from catalogue import query_chunks, query_fields
+from conservation_diag import integrate_column_diags
+from manifest import manifest_path, options_hash, replace_output
+from mesh_cache import add_height_coord
 import paths
+from profiling import PROFILER, stage
+from ugrid_utils import ugrid_spatial_stats, ugrid_zonal_mean
 
 from aeolus.log import create_logger
 
-from aeolus.lfric import (
-    add_equally_spaced_height_coord,
-    add_um_height_coord,
-    load_lfric_raw,
-    ugrid_spatial,
-)
 
 # Global definitions and styles
 warnings.filterwarnings("ignore")
 SCRIPT = Path(__file__).name
 
 AGGREGATORS = ["max", "mean", "median", "min", "std_dev", "variance"]
+VARPACK_FILE = paths.scripts / "varpack_lfric.json"
 
 
 def parse_args(args=None):
@@ -62,21 +76,226 @@ def parse_args(args=None):
         help="Cubed Sphere Mesh Number",
         default="C48",
     )
+    ap.add_argument(
+        "-s",
+        "--startday",
+        type=int,
+        default=None,
+        help="Load chunks starting on or after this day",
+    )
+    ap.add_argument(
+        "-e",
+        "--endday",
+        type=int,
+        default=None,
+        help="Load chunks starting on or before this day",
+    )
+    ap.add_argument(
+        "--catalogue",
+        type=str,
+        default=None,
+        help=(
+            "SQLite catalogue of raw files made by catalogue.py, to find"
+            " files without opening them (new files are added to it)"
+        ),
+    )
     ap.add_argument(
         "--level_height",
         type=str,
         default="uniform",
         help="Type of the vertical level height coordinate",
     )
+    ap.add_argument(
+        "--model_top",
+        type=float,
+        default=32_000,
+        help="If level_height=uniform, set the model top height.",
+    )
+    ap.add_argument(
+        "--varpack",
+        type=str,
+        default=None,
+        help=(
+            "JSON file with names of netCDF variables to aggregate"
+            " in its 'aggregate' list (all single-level fields on the mesh"
+            " if not given)"
+        ),
+    )
+    ap.add_argument(
+        "--zonal_mean",
+        action="store_true",
+        default=False,
+        help=(
+            "Also calculate zonal means on the native mesh of the fields"
+            " in the 'zonal_mean' list of the --varpack file"
+            f" ({VARPACK_FILE.name} if not given), for all levels"
+        ),
+    )
+    ap.add_argument(
+        "--column_integrals",
+        action="store_true",
+        default=False,
+        help=(
+            "Also calculate global integrals of the column-integrated"
+            " diagnostics, for checking conservation"
+        ),
+    )
+    ap.add_argument(
+        "--time_chunk",
+        type=int,
+        default=None,
+        help="Number of time steps to reduce at once (all if not given)",
+    )
+    ap.add_argument(
+        "--mesh_index",
+        type=str,
+        default=None,
+        help=(
+            "JSON file with mesh fingerprints of raw files, so that"
+            " the mesh is read only once in each process"
+        ),
+    )
+    ap.add_argument(
+        "--window",
+        type=int,
+        default=None,
+        help=(
+            "Process this many restart chunks at a time and concatenate"
+            " the partial outputs at the end (all at once if not given)"
+        ),
+    )
+    ap.add_argument(
+        "--keep_partial",
+        action="store_true",
+        default=False,
+        help="Do NOT delete partial outputs after concatenating them",
+    )
+    ap.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to handle windows of chunks in parallel",
+    )
+    ap.add_argument(
+        "--incremental",
+        action="store_true",
+        default=False,
+        help=(
+            "Only process new or changed chunks and reuse partial outputs"
+            " listed in the manifest from previous runs"
+        ),
+    )
+    ap.add_argument(
+        "--complevel",
+        type=int,
+        default=4,
+        help="Compression level of the output, from 0 (none) to 9",
+    )
+    ap.add_argument(
+        "--chunk_layout",
+        type=str,
+        default="slice",
+        choices=CHUNK_LAYOUTS,
+        help=(
+            "Chunk shape of the output: 'slice' for maps and cross-sections,"
+            " 'column' for vertical profiles and time series"
+        ),
+    )
+    ap.add_argument(
+        "--zarr",
+        action="store_true",
+        default=False,
+        help=(
+            "Write a Zarr store instead of a netCDF file"
+            " (for notebooks; not read by the other scripts)"
+        ),
+    )
+    ap.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help=(
+            "Directory to which a report on the time, memory and I/O"
+            " of each processing stage is written"
+        ),
+    )
+    ap.add_argument(
+        "--cprofile",
+        action="store_true",
+        default=False,
+        help="Also save cProfile statistics to the --profile directory",
+    )
     return ap.parse_args(args)
 
 
+def process_files(
+    fnames,
+    add_levs,
+    fields=None,
+    mesh_index=None,
+    time_chunk=None,
+    planet=None,
+    zonal_fields=None,
+):
+    """
+    Load LFRic files and spatially reduce single-level fields.
+
+    If `fields` is given, only these netCDF variables are read.
+    If `zonal_fields` is given, zonal means of these variables are
+    also calculated on the native mesh.
+    If `planet` is given, global integrals of the column-integrated
+    diagnostics are also calculated, for checking conservation.
+    """
+    with stage("load"):
+        cl_raw = load_lfric_fields(
+            fnames, fields=fields, callback=add_levs, mesh_index=mesh_index
+        )
+    if len(cl_raw) == 0:
+        return cl_raw
+    # Process only single-level cubes
+    DC = DimConstr(model=lfric)
+    with stage("extract"):
+        cubes_single_lev = unique_cubes(
+            cl_raw.extract(DC.relax.t).extract(
+                iris.Constraint(cube_func=lambda cube: cube.ndim == 2)
+            )
+        )
+
+    # Loop over cubes and apply all operators in one pass over the data
+    cl_proc = iris.cube.CubeList()
+    for cube in cubes_single_lev:
+        logger.info(f"Processing {cube.var_name}")
+        with stage("aggregate"):
+            cl_proc.extend(
+                ugrid_spatial_stats(
+                    cube, AGGREGATORS, model=lfric, time_chunk=time_chunk
+                )
+            )
+    if zonal_fields:
+        for cube in cl_raw.extract(
+            [iris.NameConstraint(var_name=i) for i in zonal_fields]
+        ):
+            logger.info(f"Zonal mean of {cube.var_name}")
+            with stage("zonal_mean"):
+                cl_proc.append(ugrid_zonal_mean(cube, model=lfric))
+    if planet is not None:
+        with stage("integrate"):
+            cl_proc.extend(
+                integrate_column_diags(cubes_single_lev, planet=planet)
+            )
+    return cl_proc
+
+
 def main(args=None):
     """Main entry point of the script."""
     t0 = time()
     L = create_logger(Path(__file__))
     # Parse command-line arguments
     args = parse_args(args)
+    PROFILER.start(
+        track_memory=args.profile is not None,
+        cprofile=(args.profile is not None) and args.cprofile,
+    )
     planet = args.planet
     L.info(f"{planet=}")
 
@@ -88,12 +307,10 @@ def main(args=None):
 
     # Height coordinate
     if args.level_height == "uniform":
-        add_levs = partial(
-            add_equally_spaced_height_coord, model_top_height=32_000
-        )
+        add_levs = partial(add_height_coord, model_top_height=args.model_top)
     elif args.level_height == "um_L38_29t_9s_40km":
         add_levs = partial(
-            add_um_height_coord,
+            add_height_coord,
             path_to_levels_file=paths.vert / "vertlevs_L38_29t_9s_40km",
         )
     else:
@@ -109,53 +326,129 @@ def main(args=None):
     # outdir = mypaths.sadir / label / "_processed"
     outdir.mkdir(parents=True, exist_ok=True)
 
-    # Make a list of files matching the file mask and the start day threshold
-    fnames = sorted(
-        inpdir.glob(f"*/*{c_num}*/lfric_diag.nc"),
-        key=lambda x: int(x.parent.parent.name),
-    )
+    # Make a list of files matching the file mask and the range of days
+    with stage("find_files"):
+        if args.catalogue is None:
+            fnames = find_chunks(
+                inpdir, c_num, startday=args.startday, endday=args.endday
+            )
+        else:
+            fnames = query_chunks(
+                args.catalogue,
+                inpdir,
+                c_num,
+                startday=args.startday,
+                endday=args.endday,
+                L=L,
+            )
     if len(fnames) == 0:
         L.critical("No files found!")
         return
     L.info(f"fnames({len(fnames)}) = {fnames[0]} ... {fnames[-1]}")
 
-    cl_raw = load_lfric_raw(fnames, callback=add_levs)
-    if len(cl_raw) == 0:
+    gl_attrs = {
+        "name": label,
+        "planet": planet,
+        "processed": "True",
+    }
+    # Read only single-level fields
+    fields = None
+    if args.varpack is not None:
+        fields = load_field_pack(args.varpack).get("aggregate")
+    if fields is None:
+        with stage("find_fields"):
+            if args.catalogue is None:
+                fields = find_mesh_fields(fnames[0], ndim=2)
+            else:
+                fields = query_fields(args.catalogue, fnames, ndim=2)
+    L.info(f"fields({len(fields)}) = {fields}")
+    if args.zonal_mean:
+        zonal_fields = load_field_pack(args.varpack or VARPACK_FILE)[
+            "zonal_mean"
+        ]
+        L.info(f"zonal_fields({len(zonal_fields)}) = {zonal_fields}")
+    else:
+        zonal_fields = []
+    kw_proc = {
+        "add_levs": add_levs,
+        "mesh_index": args.mesh_index,
+        "fields": [*fields, *zonal_fields],
+        "zonal_fields": zonal_fields,
+        "time_chunk": args.time_chunk,
+        "planet": planet if args.column_integrals else None,
+    }
+    # Process all files at once or in windows of restart chunks
+    if (args.workers > 1 or args.incremental) and (args.window is None):
+        # Give each worker one chunk at a time
+        args.window = 1
+    windows = split_into_windows(fnames, args.window)
+    if args.incremental:
+        manifest_file = manifest_path(outdir, label, "aggr")
+        # Options that affect the partial outputs
+        options = options_hash(
+            {
+                "level_height": args.level_height,
+                "model_top": args.model_top,
+                "fields": fields,
+                "zonal_fields": zonal_fields,
+                "time_chunk": args.time_chunk,
+                "planet": planet,
+                "column_integrals": args.column_integrals,
+            }
+        )
+    else:
+        manifest_file = None
+        options = None
+    streaming = (len(windows) > 1) or args.incremental
+    if not streaming:
+        cl_proc = process_files(fnames, **kw_proc)
+    else:
+        fnames_part = process_windows(
+            partial(process_files, **kw_proc),
+            windows,
+            [partial_fname(outdir, label, i, "aggr") for i in windows],
+            gl_attrs,
+            workers=args.workers,
+            manifest_file=manifest_file,
+            options=options,
+        )
+        # Concatenate the partial outputs lazily
+        with stage("load_partials"):
+            cl_proc = load_partials(fnames_part)
+    if len(cl_proc) == 0:
         L.critical("Files are empty!")
         return
-    # Process only single-level cubes
-    DC = DimConstr(model=lfric)
-    cubes_single_lev = unique_cubes(
-        cl_raw.extract(DC.relax.t).extract(
-            iris.Constraint(cube_func=lambda cube: cube.ndim == 2)
-        )
-    )
-
-    # Loop over cubes and operators
-    cl_proc = iris.cube.CubeList()
-    for cube in cubes_single_lev:
-        L.info(f"Processing {cube.var_name}")
-        for aggr in AGGREGATORS:
-            L.info(f"Applying {aggr=}")
-            cl_proc.append(ugrid_spatial(cube, aggr, model=lfric))
 
     const = init_const(planet, directory=paths.const)
     add_planet_conf_to_cubes(cl_proc, const=const)
 
     time_prof = "inst"
     # Write the data to a netCDF file
-    gl_attrs = {
-        "name": label,
-        "planet": planet,
-        "processed": "True",
-    }
-    days = 0 + get_cube_rel_days(cl_proc[0]).astype(int)
+    if args.startday is None:
+        day0 = 0
+    else:
+        # Count days from the start of the first selected chunk
+        day0 = chunk_day(fnames[0])
+    days = day0 + get_cube_rel_days(cl_proc[0]).astype(int)
     day_str = f"days{days[0]}"
     if len(days) > 1:
         day_str += f"_{days[-1]}"
     fname_out = outdir / f"{label}_{time_prof}_{day_str}_aggr.nc"
-    save_cubelist(cl_proc, fname_out, **gl_attrs)
+    with stage("save"):
+        fname_out = save_output(
+            cl_proc,
+            fname_out,
+            layout=args.chunk_layout,
+            complevel=args.complevel,
+            zarr=args.zarr,
+            **gl_attrs,
+        )
     L.success(f"Saved to {fname_out}")
+    if manifest_file is not None:
+        replace_output(manifest_file, fname_out)
+    elif streaming and not args.keep_partial:
+        remove_partials(fnames_part)
+    PROFILER.finish(args.profile, f"{Path(__file__).stem}_{label}", L=L)
     L.info(f"Execution time: {time() - t0:.1f}s")
 
 
@@ -0,0 +1,768 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark the processing scripts on synthetic LFRic and UM output."""
+# Standard library
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import importlib
+from importlib.metadata import PackageNotFoundError, version
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import platform
+import resource
+import shutil
+import sys
+from time import perf_counter, time
+
+# External modules
+from aeolus.io import create_dummy_cube
+from aeolus.log import create_logger
+import f90nml
+import iris
+from iris.fileformats.pp import STASH
+import netCDF4
+import numpy as np
+
+# Local modules
+from lfric_chunks import find_mesh_fields, load_field_pack, load_lfric_fields
+import paths
+from pp_lfric_data import VARPACK_FILE
+from regrid_utils import compare_with_esmf
+
+# Global definitions and styles
+SCRIPT = Path(__file__).name
+# Simulation label and planet of the synthetic data.
+# The label must be in `shared.TF_CASES` for the time mean script.
+LABEL = "hs"
+PLANET = "earth"
+LEVELS_FILE = "vertlevs_L38_29t_9s_40km"
+EARTH_RADIUS = 6371229.0
+# Standard name, units and vertical levels of synthetic LFRic fields
+LFRIC_FIELD_SPECS = {
+    "cloud_amount_maxrnd": (None, "1", None),
+    "divergence": (None, "s-1", "half"),
+    "grid_surface_temperature": ("surface_temperature", "K", None),
+    "lw_down_surf": (None, "W m-2", None),
+    "lw_up_surf": (None, "W m-2", None),
+    "lw_up_toa": ("toa_outgoing_longwave_flux", "W m-2", None),
+    "lw_up_clear_toa_rts": (None, "W m-2", None),
+    "pressure_in_wth": ("air_pressure", "Pa", "full"),
+    "sw_direct_toa": (None, "W m-2", None),
+    "sw_down_surf": (None, "W m-2", None),
+    "sw_up_surf": (None, "W m-2", None),
+    "sw_up_toa": ("toa_outgoing_shortwave_flux", "W m-2", None),
+    "sw_up_clear_toa_rts": (None, "W m-2", None),
+    "temperature": ("air_temperature", "K", "full"),
+    "theta": ("air_potential_temperature", "K", "full"),
+    "tot_col_int_energy": (None, "J m-2", None),
+    "tot_col_dry_air_mass": (None, "kg m-2", None),
+    "tot_col_pot_energy": (None, "J m-2", None),
+    "tot_col_m_ci": (None, "kg m-2", None),
+    "tot_col_m_cl": (None, "kg m-2", None),
+    "tot_col_m_v": (None, "kg m-2", None),
+    "u_in_w3": ("eastward_wind", "m s-1", "half"),
+    "v_in_w3": ("northward_wind", "m s-1", "half"),
+    "w_in_wth": ("upward_air_velocity", "m s-1", "full"),
+}
+# Fields always generated, because the regridding and sigma-p steps need them
+REQUIRED_FIELDS = [
+    "theta",
+    "temperature",
+    "pressure_in_wth",
+    "u_in_w3",
+    "v_in_w3",
+    "w_in_wth",
+]
+# Standard name, units and presence of vertical levels of synthetic UM fields
+UM_FIELD_SPECS = {
+    "m01s00i024": ("surface_temperature", "K", False),
+    "m01s01i208": ("toa_outgoing_shortwave_flux", "W m-2", False),
+    "m01s02i205": ("toa_outgoing_longwave_flux", "W m-2", False),
+    "m01s00i002": ("x_wind", "m s-1", True),
+    "m01s00i003": ("y_wind", "m s-1", True),
+    "m01s00i004": ("air_potential_temperature", "K", True),
+    "m01s00i010": ("specific_humidity", "kg kg-1", True),
+    "m01s00i408": ("air_pressure", "Pa", True),
+    "m01s16i004": ("air_temperature", "K", True),
+}
+# UM output streams of single-level and multi-level fields
+UM_STREAMS = {False: "a", True: "b"}
+# Shape of the lat-lon grid to which LFRic data are regridded
+REGRID_SHAPE = (90, 144)
+# Largest relative difference from ESMF regridding accepted by --check_esmf
+ESMF_RTOL = 1e-6
+# Benchmarks in the order of the processing pipeline
+BENCHMARKS = ["pp_lfric", "aggr_lfric", "pp_um", "sigma_p", "time_mean"]
+# Benchmarks that need the output of another one
+DEPENDS = {"sigma_p": "pp_lfric", "time_mean": "sigma_p"}
+
+
+def parse_args(args=None):
+    """Argument parser."""
+    ap = argparse.ArgumentParser(
+        SCRIPT,
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        epilog=f"""Usage:
+./{SCRIPT} -c 24 -d 4 -n 10
+./{SCRIPT} -c 48 -d 10 -b pp_lfric aggr_lfric -r 3 -w ~/path/to/work/dir
+""",
+    )
+    ap.add_argument(
+        "-b",
+        "--benchmarks",
+        type=str,
+        nargs="+",
+        default=BENCHMARKS,
+        choices=BENCHMARKS,
+        help="Benchmarks to run",
+    )
+    ap.add_argument(
+        "-c", "--cnum", type=int, default=24, help="Cubed sphere C-number"
+    )
+    ap.add_argument(
+        "-d", "--days", type=int, default=4, help="Number of days of output"
+    )
+    ap.add_argument(
+        "--chunk_days",
+        type=int,
+        default=1,
+        help="Number of days in each LFRic restart chunk",
+    )
+    ap.add_argument(
+        "--steps_per_day",
+        type=int,
+        default=4,
+        help="Number of output time steps per day",
+    )
+    ap.add_argument(
+        "-n",
+        "--nfields",
+        type=int,
+        default=None,
+        help=(
+            "Number of LFRic fields, including the required ones"
+            f" (all fields to regrid in {VARPACK_FILE.name} if not given)"
+        ),
+    )
+    ap.add_argument(
+        "--nlat",
+        type=int,
+        default=90,
+        help="Number of latitudes of the UM grid",
+    )
+    ap.add_argument(
+        "--nlon",
+        type=int,
+        default=144,
+        help="Number of longitudes of the UM grid",
+    )
+    ap.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=1,
+        help="Number of times to run each benchmark",
+    )
+    ap.add_argument(
+        "-w",
+        "--workdir",
+        type=str,
+        default=str(paths.data / "benchmark"),
+        help="Directory for the synthetic data and the script output",
+    )
+    ap.add_argument(
+        "--history",
+        type=str,
+        default=str(paths.data / "benchmark_history.json"),
+        help="JSON file to which the results are appended",
+    )
+    ap.add_argument(
+        "--check_esmf",
+        action="store_true",
+        default=False,
+        help=(
+            "Compare the sparse regridding of the synthetic LFRic fields"
+            " on mesh faces with MeshToGridESMFRegridder (requires ESMF);"
+            " exit with an error status if they differ"
+        ),
+    )
+    ap.add_argument(
+        "--regenerate",
+        action="store_true",
+        default=False,
+        help="Regenerate the synthetic data even if they exist",
+    )
+    return ap.parse_args(args)
+
+
+def load_levels(fname):
+    """Read heights of theta and rho levels from a UM vertical levels file."""
+    vertlevs = f90nml.read(fname)["vertlevs"]
+    z_top = vertlevs["z_top_of_model"]
+    z_theta = np.asarray(vertlevs["eta_theta"]) * z_top
+    z_rho = np.asarray(vertlevs["eta_rho"]) * z_top
+    return z_theta, z_rho
+
+
+def _to_lonlat(xyz):
+    """Convert Cartesian coordinates on a unit sphere to degrees."""
+    lons = np.rad2deg(np.arctan2(xyz[..., 1], xyz[..., 0]))
+    lats = np.rad2deg(np.arcsin(np.clip(xyz[..., 2], -1, 1)))
+    return lons, lats
+
+
+def make_cubed_sphere(c_num):
+    """
+    Create an equiangular cubed sphere mesh.
+
+    Returns
+    -------
+    dict
+        Node, face and edge coordinates (in degrees)
+        and face-node and edge-node connectivities.
+    """
+    ticks = np.tan(np.linspace(-np.pi / 4, np.pi / 4, c_num + 1))
+    u, v = np.meshgrid(ticks, ticks, indexing="ij")
+    one = np.ones_like(u)
+    panels = [
+        (one, u, v),
+        (-u, one, v),
+        (-one, -u, v),
+        (u, -one, v),
+        (-v, u, one),
+        (v, u, -one),
+    ]
+    xyz = np.stack([np.stack(i, axis=-1) for i in panels])
+    xyz /= np.linalg.norm(xyz, axis=-1, keepdims=True)
+    # Merge nodes shared by neighbouring panels
+    nodes, inverse = np.unique(
+        xyz.reshape(-1, 3).round(10), axis=0, return_inverse=True
+    )
+    node_idx = inverse.reshape(6, c_num + 1, c_num + 1)
+    face_nodes = np.stack(
+        [
+            node_idx[:, :-1, :-1],
+            node_idx[:, 1:, :-1],
+            node_idx[:, 1:, 1:],
+            node_idx[:, :-1, 1:],
+        ],
+        axis=-1,
+    ).reshape(-1, 4)
+    # Make all faces anticlockwise when seen from outside
+    corners = nodes[face_nodes]
+    face_xyz = corners.mean(axis=1)
+    normal = np.cross(
+        corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]
+    )
+    clockwise = (normal * face_xyz).sum(axis=-1) < 0
+    face_nodes[clockwise] = face_nodes[clockwise, ::-1]
+    edge_nodes = np.unique(
+        np.sort(
+            np.stack([face_nodes, np.roll(face_nodes, -1, axis=1)], axis=-1),
+            axis=-1,
+        ).reshape(-1, 2),
+        axis=0,
+    )
+    edge_xyz = nodes[edge_nodes].mean(axis=1)
+    return {
+        "node": _to_lonlat(nodes),
+        "face": _to_lonlat(
+            face_xyz / np.linalg.norm(face_xyz, axis=-1)[:, None]
+        ),
+        "edge": _to_lonlat(
+            edge_xyz / np.linalg.norm(edge_xyz, axis=-1)[:, None]
+        ),
+        "face_nodes": face_nodes,
+        "edge_nodes": edge_nodes,
+    }
+
+
+def synthetic_values(units, lons, lats, heights, times, rng):
+    """
+    Generate a smooth field with noise, broadcast to (time, [level,] cell).
+
+    The values are roughly realistic for the given units, so that
+    unit-dependent calculations downstream do not fail.
+    """
+    lons, lats, times = np.deg2rad(lons), np.deg2rad(lats), times / 86400
+    pattern = np.cos(lats) * np.cos(lons - 2 * np.pi * times[:, None])
+    if heights is not None:
+        pattern = pattern[:, None, :]
+        z = heights[None, :, None]
+    else:
+        z = 0.0
+    if units == "K":
+        values = 250 + 30 * pattern - 6.5e-3 * np.minimum(z, 12e3)
+    elif units == "Pa":
+        values = 1e5 * np.exp(-z / 7e3) * (1 + 1e-2 * pattern)
+    else:
+        values = pattern * (1 + z / 1e4)
+    noise = 1e-2 * rng.standard_normal(np.shape(values))
+    return (values * (1 + noise)).astype(np.float32)
+
+
+def write_lfric_chunk(fname, mesh, fields, levels, times, rng):
+    """Write a synthetic `lfric_diag.nc` file with fields on a UGRID mesh."""
+    z_theta, z_rho = levels
+    with netCDF4.Dataset(fname, "w") as ds:
+        ds.Conventions = "UGRID-1.0"
+        ds.createDimension("nMesh2d_node", mesh["node"][0].size)
+        ds.createDimension("nMesh2d_edge", mesh["edge"][0].size)
+        ds.createDimension("nMesh2d_face", mesh["face"][0].size)
+        ds.createDimension("nMesh2d_vertex", 4)
+        ds.createDimension("Two", 2)
+        ds.createDimension("full_levels", z_theta.size)
+        ds.createDimension("half_levels", z_rho.size)
+        ds.createDimension("time_counter", None)
+
+        topo = ds.createVariable("Mesh2d", "i4")
+        topo.setncatts(
+            {
+                "cf_role": "mesh_topology",
+                "long_name": "Topology data of 2D unstructured mesh",
+                "topology_dimension": 2,
+                "node_coordinates": "Mesh2d_node_x Mesh2d_node_y",
+                "edge_coordinates": "Mesh2d_edge_x Mesh2d_edge_y",
+                "face_coordinates": "Mesh2d_face_x Mesh2d_face_y",
+                "face_node_connectivity": "Mesh2d_face_nodes",
+                "edge_node_connectivity": "Mesh2d_edge_nodes",
+                "face_dimension": "nMesh2d_face",
+                "edge_dimension": "nMesh2d_edge",
+            }
+        )
+        for location in ("node", "edge", "face"):
+            for axis, data in zip("xy", mesh[location]):
+                var = ds.createVariable(
+                    f"Mesh2d_{location}_{axis}", "f8", (f"nMesh2d_{location}",)
+                )
+                if axis == "x":
+                    var.standard_name = "longitude"
+                    var.units = "degrees_east"
+                else:
+                    var.standard_name = "latitude"
+                    var.units = "degrees_north"
+                var[:] = data
+        for location, dim in (("face", "nMesh2d_vertex"), ("edge", "Two")):
+            var = ds.createVariable(
+                f"Mesh2d_{location}_nodes", "i4", (f"nMesh2d_{location}", dim)
+            )
+            var.cf_role = f"{location}_node_connectivity"
+            var.start_index = 0
+            var[:] = mesh[f"{location}_nodes"]
+
+        for name, heights in (
+            ("full_levels", z_theta),
+            ("half_levels", z_rho),
+        ):
+            var = ds.createVariable(name, "f4", (name,))
+            var.positive = "up"
+            var[:] = np.arange(heights.size) + (0.5 * (name == "half_levels"))
+        var = ds.createVariable("time_counter", "f8", ("time_counter",))
+        var.standard_name = "time"
+        var.units = "seconds since 2000-01-01 00:00:00"
+        var.calendar = "gregorian"
+        var[:] = times
+
+        for name in fields:
+            std_name, units, level = LFRIC_FIELD_SPECS[name]
+            heights = {"full": z_theta, "half": z_rho}.get(level)
+            dims = ("time_counter",)
+            if heights is not None:
+                dims += (f"{level}_levels",)
+            var = ds.createVariable(
+                name, "f4", dims + ("nMesh2d_face",), zlib=False
+            )
+            if std_name is not None:
+                var.standard_name = std_name
+            var.long_name = name
+            var.units = units
+            var.mesh = "Mesh2d"
+            var.location = "face"
+            var.coordinates = "Mesh2d_face_y Mesh2d_face_x"
+            var[:] = synthetic_values(
+                units, *mesh["face"], heights, times, rng
+            )
+
+
+def make_um_cube(stash, lats, lons, heights, time, rng):
+    """Create a synthetic UM cube that can be saved to a PP file."""
+    std_name, units, multi_level = UM_FIELD_SPECS[stash]
+    crs = iris.coord_systems.GeogCS(EARTH_RADIUS)
+    t_units = "hours since 2000-01-01 00:00:00"
+    aux_coords = [
+        (iris.coords.AuxCoord(time / 3600, "time", units=t_units), None),
+        (
+            iris.coords.AuxCoord(
+                0.0, "forecast_reference_time", units=t_units
+            ),
+            None,
+        ),
+        (
+            iris.coords.AuxCoord(time / 3600, "forecast_period", units="h"),
+            None,
+        ),
+    ]
+    dim_coords = [
+        iris.coords.DimCoord(
+            lats, "latitude", units="degrees", coord_system=crs
+        ),
+        iris.coords.DimCoord(
+            lons, "longitude", units="degrees", coord_system=crs
+        ),
+    ]
+    if multi_level:
+        dim_coords.insert(
+            0,
+            iris.coords.DimCoord(
+                np.arange(1, heights.size + 1),
+                "model_level_number",
+                units="1",
+            ),
+        )
+        level_height = iris.coords.AuxCoord(
+            heights,
+            var_name="level_height",
+            units="m",
+            attributes={"positive": "up"},
+        )
+        sigma = iris.coords.AuxCoord(
+            1 - heights / heights[-1], long_name="sigma", units="1"
+        )
+        for coord in (level_height, sigma):
+            coord.guess_bounds()
+            aux_coords.append((coord, 0))
+    else:
+        heights = None
+    lon2d, lat2d = np.meshgrid(lons, lats)
+    data = synthetic_values(
+        units, lon2d.ravel(), lat2d.ravel(), heights, np.array([time]), rng
+    )
+    return iris.cube.Cube(
+        data.reshape([i.shape[0] for i in dim_coords]),
+        standard_name=std_name,
+        units=units,
+        dim_coords_and_dims=[(coord, i) for i, coord in enumerate(dim_coords)],
+        aux_coords_and_dims=aux_coords,
+        attributes={"STASH": STASH.from_msi(stash)},
+    )
+
+
+def generate_data(workdir, args, L):
+    """
+    Generate synthetic LFRic and UM output unless it already exists.
+
+    LFRic output is split into restart chunks in the `<day>/<cnum>/`
+    directory structure expected by the LFRic scripts. UM output consists
+    of one file per stream and day, named like the `atmosa` files.
+    """
+    config = {
+        "cnum": args.cnum,
+        "days": args.days,
+        "chunk_days": args.chunk_days,
+        "steps_per_day": args.steps_per_day,
+        "nfields": args.nfields,
+        "nlat": args.nlat,
+        "nlon": args.nlon,
+    }
+    raw_dir = workdir / "raw"
+    config_file = raw_dir / "config.json"
+    if (not args.regenerate) and config_file.exists():
+        with open(config_file, "r") as fobj:
+            if json.load(fobj) == config:
+                L.info(f"Reusing synthetic data in {raw_dir}")
+                return config
+    shutil.rmtree(raw_dir, ignore_errors=True)
+    rng = np.random.default_rng(0)
+    levels = load_levels(paths.vert / LEVELS_FILE)
+    # Output times of each day
+    times = (
+        np.arange(1, args.days * args.steps_per_day + 1).reshape(args.days, -1)
+        * 86400
+        / args.steps_per_day
+    )
+
+    # LFRic output
+    L.info(f"Generating C{args.cnum} LFRic output")
+    mesh = make_cubed_sphere(args.cnum)
+    fields = load_field_pack(VARPACK_FILE)["regrid"]
+    fields = [
+        *REQUIRED_FIELDS,
+        *[i for i in fields if i not in REQUIRED_FIELDS],
+    ][: max(args.nfields or len(fields), len(REQUIRED_FIELDS))]
+    for day0 in range(0, args.days, args.chunk_days):
+        day1 = day0 + args.chunk_days
+        chunk_dir = raw_dir / "lfric" / LABEL / f"{day0}" / f"C{args.cnum}"
+        chunk_dir.mkdir(parents=True, exist_ok=True)
+        write_lfric_chunk(
+            chunk_dir / "lfric_diag.nc",
+            mesh,
+            fields,
+            levels,
+            times[day0:day1].ravel(),
+            rng,
+        )
+
+    # UM output
+    L.info(f"Generating {args.nlat}x{args.nlon} UM output")
+    um_dir = raw_dir / "um" / LABEL
+    um_dir.mkdir(parents=True, exist_ok=True)
+    dlat, dlon = 180 / args.nlat, 360 / args.nlon
+    lats = np.linspace(-90 + dlat / 2, 90 - dlat / 2, args.nlat)
+    lons = np.linspace(dlon / 2, 360 - dlon / 2, args.nlon)
+    # UM theta levels above the surface
+    heights = levels[0][1:]
+    for day, day_times in enumerate(times):
+        for multi_level, stream in UM_STREAMS.items():
+            cubes = [
+                make_um_cube(stash, lats, lons, heights, time, rng)
+                for time in day_times
+                for stash, spec in UM_FIELD_SPECS.items()
+                if spec[-1] == multi_level
+            ]
+            iris.save(
+                cubes, um_dir / f"atmosa.p{stream}{day:010d}_00", saver="pp"
+            )
+
+    with open(config_file, "w") as fobj:
+        json.dump(config, fobj, indent=2)
+    return config
+
+
+def check_esmf(workdir, L):
+    """
+    Compare the sparse regridding of LFRic fields with ESMF.
+
+    Returns
+    -------
+    bool
+        True if all fields agree within `ESMF_RTOL` and have the same mask.
+    """
+    fname = sorted((workdir / "raw" / "lfric" / LABEL).glob("*/*/*.nc"))[0]
+    cubes = load_lfric_fields([fname], fields=find_mesh_fields(fname))
+    tgt_cube = create_dummy_cube(
+        nlat=REGRID_SHAPE[0], nlon=REGRID_SHAPE[1], pm180=True
+    )
+    ok = True
+    for cube in cubes:
+        if cube.location == "edge":
+            # Not regridded by ESMF
+            continue
+        diff, same_mask = compare_with_esmf(
+            cube, tgt_cube, cache_dir=workdir / "regrid_weights"
+        )
+        rel_diff = diff / max(float(np.ma.abs(cube.data).max()), 1e-30)
+        if (rel_diff <= ESMF_RTOL) and same_mask:
+            L.info(f"{cube.var_name:<30} {rel_diff=:.2e}")
+        else:
+            L.error(f"{cube.var_name:<30} {rel_diff=:.2e} {same_mask=}")
+            ok = False
+    return ok
+
+
+def benchmark_setup(name, workdir, config):
+    """
+    Get the module, command-line arguments and problem size of a benchmark.
+
+    The problem size is the number of horizontal grid cells and the number
+    of time steps of the input data.
+    """
+    raw_dir = workdir / "raw"
+    proc_dir = workdir / "proc"
+    n_steps = config["days"] * config["steps_per_day"]
+    lfric_args = [
+        *("-p", PLANET, "-l", LABEL, "-c", f"C{config['cnum']}"),
+        *("-i", raw_dir / "lfric" / LABEL, "-o", proc_dir / "lfric" / LABEL),
+        *("--level_height", "um_L38_29t_9s_40km"),
+    ]
+    if name == "pp_lfric":
+        module = "pp_lfric_data"
+        argv = [
+            *lfric_args,
+            *("--model_top", load_levels(paths.vert / LEVELS_FILE)[0][-1]),
+            *("--weights_dir", workdir / "regrid_weights"),
+        ]
+        n_cells = 6 * config["cnum"] ** 2
+    elif name == "aggr_lfric":
+        module = "aggr_raw_lfric_data"
+        argv = lfric_args
+        n_cells = 6 * config["cnum"] ** 2
+    elif name == "pp_um":
+        module = "pp_um_data"
+        argv = [
+            *(
+                "-p",
+                PLANET,
+                "-l",
+                LABEL,
+                "--letter",
+                "".join(UM_STREAMS.values()),
+            ),
+            *("-i", raw_dir / "um" / LABEL, "-o", proc_dir / "um" / LABEL),
+        ]
+        n_cells = config["nlat"] * config["nlon"]
+    elif name == "sigma_p":
+        module = "interp_to_sigma_p"
+        argv = ["-m", "lfric", "-i", proc_dir / "lfric" / LABEL]
+        n_cells = np.prod(REGRID_SHAPE)
+    elif name == "time_mean":
+        module = "time_mean_proc_data"
+        argv = ["-m", "lfric", "-c", LABEL]
+        n_cells = np.prod(REGRID_SHAPE)
+    else:
+        raise ValueError(f"name={name} is not valid.")
+    return module, [str(i) for i in argv], int(n_cells) * n_steps
+
+
+def _run_main(module_name, argv, workdir):
+    """
+    Run the main function of a script and measure its performance.
+
+    Meant to be run in a fresh process, so that the peak memory usage
+    is not affected by other benchmarks.
+    """
+    # Keep the output of scripts with hard-coded paths in the work directory
+    import shared
+
+    for model_key, model_prop in shared.MODELS.items():
+        model_prop["data_proc_path"] = workdir / "proc" / model_key
+    paths.data_final = workdir / "final"
+
+    module = importlib.import_module(module_name)
+    t0 = perf_counter()
+    module.main(argv)
+    wall_time = perf_counter() - t0
+    # Maximum resident set size in KiB of this process or of the largest
+    # worker process. Memory of concurrent workers is not added up, because
+    # `RUSAGE_CHILDREN` only reports the peak of the largest child.
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return wall_time, peak_rss / 1024
+
+
+def run_benchmark(module_name, argv, workdir):
+    """Run `_run_main` in a new process."""
+    with ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        return executor.submit(_run_main, module_name, argv, workdir).result()
+
+
+def _package_versions():
+    """Versions of packages that affect the performance of the scripts."""
+    result = {}
+    for package in (
+        "aeolus",
+        "dask",
+        "esmf_regrid",
+        "netCDF4",
+        "numpy",
+        "scitools-iris",
+        "stratify",
+    ):
+        try:
+            result[package] = version(package)
+        except PackageNotFoundError:
+            result[package] = None
+    return result
+
+
+def update_history(fname, record, L):
+    """Append a record to the history and compare it with the previous one."""
+    fname = Path(fname)
+    try:
+        with open(fname, "r") as fobj:
+            history = json.load(fobj)
+    except FileNotFoundError:
+        history = []
+    previous = [i for i in history if i["config"] == record["config"]]
+    if previous:
+        L.info(f"Compared to the run on {previous[-1]['date']}:")
+        for name, result in record["results"].items():
+            if (prev := previous[-1]["results"].get(name)) is not None:
+                ratio = result["wall_time_min"] / prev["wall_time_min"]
+                L.info(f"{name:<12} {100 * (ratio - 1):+7.1f}% wall time")
+    history.append(record)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    with open(fname, "w") as fobj:
+        json.dump(history, fobj, indent=2)
+    L.success(f"Saved to {fname}")
+
+
+def main(args=None):
+    """Main entry point of the script."""
+    t0 = time()
+    L = create_logger(Path(__file__))
+    # Parse command-line arguments
+    args = parse_args(args)
+    workdir = Path(args.workdir).absolute()
+    L.info(f"{workdir=}")
+
+    config = generate_data(workdir, args, L)
+    esmf_ok = True
+    if args.check_esmf:
+        esmf_ok = check_esmf(workdir, L)
+        if esmf_ok:
+            L.success("Sparse regridding agrees with ESMF")
+        else:
+            L.error("Sparse regridding differs from ESMF")
+
+    # Run the upstream scripts first if their benchmarks are not selected
+    names = []
+    for name in args.benchmarks:
+        dep = DEPENDS.get(name)
+        while (dep is not None) and (dep not in names):
+            names.insert(0, dep)
+            dep = DEPENDS.get(dep)
+        names.append(name)
+    names = sorted(set(names), key=BENCHMARKS.index)
+
+    results = {}
+    for name in names:
+        module_name, argv, size = benchmark_setup(name, workdir, config)
+        if name not in args.benchmarks:
+            L.info(f"Running {module_name} to prepare input data")
+            run_benchmark(module_name, argv, workdir)
+            continue
+        wall_times, peak_rss = [], 0.0
+        for _ in range(args.repeat):
+            L.info(f"Running {module_name} {' '.join(argv)}")
+            wall_time, rss = run_benchmark(module_name, argv, workdir)
+            wall_times.append(wall_time)
+            peak_rss = max(peak_rss, rss)
+        results[name] = {
+            "wall_time": wall_times,
+            "wall_time_min": min(wall_times),
+            "peak_rss_mb": peak_rss,
+            "cells_timesteps": size,
+            "throughput": size / min(wall_times),
+        }
+        L.info(
+            f"{name:<12} {min(wall_times):8.2f}s"
+            f" {peak_rss:8.0f}MiB (largest process)"
+            f" {results[name]['throughput']:10.3g} cells*timesteps/s"
+        )
+
+    record = {
+        "date": f"{datetime.now(timezone.utc):%Y-%m-%d %H:%M:%S}",
+        "host": platform.node(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "versions": _package_versions(),
+        "config": config,
+        "results": results,
+    }
+    update_history(args.history, record, L)
+    L.info(f"Execution time: {time() - t0:.1f}s")
+    if not esmf_ok:
+        L.critical("The ESMF comparison failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
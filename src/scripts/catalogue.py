@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Index raw LFRic output in an SQLite catalogue."""
+# Standard library
+import argparse
+from contextlib import closing
+from pathlib import Path
+import re
+import sqlite3
+from time import time
+
+# External modules
+from aeolus.log import create_logger
+import netCDF4
+
+# Local modules
+from lfric_chunks import chunk_day
+import paths
+
+SCRIPT = Path(__file__).name
+# Default location of the catalogue
+CATALOGUE = paths.cache / "raw_lfric.sqlite"
+# Change to rebuild catalogues made by previous versions
+SCHEMA_VERSION = 2
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    inpdir TEXT NOT NULL,
+    chunk_dir TEXT NOT NULL,
+    c_num TEXT,
+    day INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    ntime INTEGER,
+    time_start REAL,
+    time_end REAL,
+    time_units TEXT
+);
+CREATE INDEX IF NOT EXISTS files_day ON files (inpdir, c_num, day);
+CREATE TABLE IF NOT EXISTS variables (
+    path TEXT NOT NULL REFERENCES files (path) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    ndim INTEGER NOT NULL,
+    PRIMARY KEY (path, name)
+);
+"""
+# Cubed sphere mesh C number in a chunk directory name, e.g. "C48"
+C_NUM_REGEX = re.compile(r"(?<![A-Za-z0-9])C[0-9]+(?![0-9])")
+
+
+def parse_args(args=None):
+    """Argument parser."""
+    ap = argparse.ArgumentParser(
+        SCRIPT,
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        epilog=f"""Usage:
+./{SCRIPT} -i ~/data/raw/lfric/hab1 ~/data/raw/lfric/hab2
+""",
+    )
+    ap.add_argument(
+        "-i",
+        "--inpdirs",
+        type=str,
+        nargs="+",
+        required=True,
+        help="Directories with restart chunks in <day>/<chunk>/ folders",
+    )
+    ap.add_argument(
+        "--catalogue",
+        type=str,
+        default=str(CATALOGUE),
+        help="SQLite file with the catalogue",
+    )
+    ap.add_argument(
+        "--fname",
+        type=str,
+        default="lfric_diag.nc",
+        help="Name of the output files in each chunk",
+    )
+    return ap.parse_args(args)
+
+
+def connect(catalogue):
+    """Open the catalogue, creating its tables if needed."""
+    Path(catalogue).parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(catalogue)
+    con.execute("PRAGMA foreign_keys = ON")
+    if con.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+        # The catalogue is rebuilt from the files by `update_catalogue`
+        con.executescript(
+            "DROP TABLE IF EXISTS variables; DROP TABLE IF EXISTS files;"
+        )
+        con.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    con.executescript(SCHEMA)
+    return con
+
+
+def chunk_c_num(fname):
+    """Get the C number from a chunk's `<day>/<cnum>/` directory, if any."""
+    match = C_NUM_REGEX.search(Path(fname).parent.name)
+    return None if match is None else match.group()
+
+
+def read_header(fname):
+    """
+    Read the time range and variables on the mesh from a file's header.
+
+    Returns
+    -------
+    dict
+        Time information, as in the columns of the "files" table.
+    list of tuple
+        Name and number of dimensions of each variable.
+    """
+    info = {"ntime": None, "time_start": None, "time_end": None}
+    info["time_units"] = None
+    with netCDF4.Dataset(fname) as ds:
+        for var in ds.variables.values():
+            if getattr(var, "standard_name", None) == "time":
+                info["ntime"] = var.size
+                if var.size > 0:
+                    info["time_start"] = float(var[0])
+                    info["time_end"] = float(var[-1])
+                info["time_units"] = getattr(var, "units", None)
+                break
+        variables = [
+            (name, var.ndim)
+            for name, var in ds.variables.items()
+            if "mesh" in var.ncattrs()
+        ]
+    return info, variables
+
+
+def update_catalogue(con, inpdir, fname="lfric_diag.nc", L=None):
+    """
+    Add new and changed files in a directory to the catalogue.
+
+    Only the files whose size or modification time have changed since
+    the last update are opened. Files that no longer exist are removed.
+
+    Returns
+    -------
+    int
+        Number of files added or updated.
+    """
+    inpdir = Path(inpdir).resolve()
+    known = {
+        path: (mtime_ns, size)
+        for path, mtime_ns, size in con.execute(
+            "SELECT path, mtime_ns, size FROM files WHERE inpdir = ?",
+            (str(inpdir),),
+        )
+    }
+    n_updated = 0
+    for path in inpdir.glob(f"*/*/{fname}"):
+        try:
+            day = chunk_day(path)
+        except ValueError:
+            # Not a <day>/<chunk>/ directory
+            continue
+        stat = path.stat()
+        if known.pop(str(path), None) == (stat.st_mtime_ns, stat.st_size):
+            continue
+        info, variables = read_header(path)
+        con.execute("DELETE FROM files WHERE path = ?", (str(path),))
+        con.execute(
+            "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                str(path),
+                str(inpdir),
+                path.parent.name,
+                chunk_c_num(path),
+                day,
+                stat.st_mtime_ns,
+                stat.st_size,
+                info["ntime"],
+                info["time_start"],
+                info["time_end"],
+                info["time_units"],
+            ),
+        )
+        con.executemany(
+            "INSERT INTO variables VALUES (?, ?, ?)",
+            [(str(path), name, ndim) for name, ndim in variables],
+        )
+        n_updated += 1
+        if L is not None:
+            L.debug(f"Indexed {path}")
+    # Forget deleted files
+    con.executemany(
+        "DELETE FROM files WHERE path = ?", [(path,) for path in known]
+    )
+    con.commit()
+    return n_updated
+
+
+def query_chunks(
+    catalogue,
+    inpdir,
+    c_num,
+    fname="lfric_diag.nc",
+    startday=None,
+    endday=None,
+    fields=None,
+    L=None,
+):
+    """
+    Find LFRic output files in the catalogue and sort them by day.
+
+    Same as `lfric_chunks.find_chunks`, but only new or changed files
+    are opened to update the catalogue before it is queried.
+
+    Parameters
+    ----------
+    catalogue: pathlib.Path
+        SQLite file updated by `update_catalogue`.
+    inpdir: pathlib.Path
+        Directory with restart chunks.
+    c_num: str
+        Cubed sphere mesh C number, part of the chunk directory names.
+    fname: str, optional
+        Name of the output files in each chunk.
+    startday, endday: int, optional
+        Select chunks starting within this range of days (inclusive).
+    fields: list of str, optional
+        Select files with at least one of these variables.
+
+    Returns
+    -------
+    list of pathlib.Path
+    """
+    query = "SELECT path FROM files WHERE inpdir = ? AND c_num = ?"
+    params = [str(Path(inpdir).resolve()), c_num]
+    if startday is not None:
+        query += " AND day >= ?"
+        params.append(startday)
+    if endday is not None:
+        query += " AND day <= ?"
+        params.append(endday)
+    if fields is not None:
+        query += (
+            " AND path IN (SELECT path FROM variables WHERE name IN"
+            f" ({', '.join('?' * len(fields))}))"
+        )
+        params.extend(fields)
+    query += " ORDER BY day"
+    with closing(connect(catalogue)) as con:
+        n_updated = update_catalogue(con, inpdir, fname=fname, L=L)
+        if (L is not None) and (n_updated > 0):
+            L.info(f"{inpdir}: {n_updated} files added to the catalogue")
+        return [Path(path) for (path,) in con.execute(query, params)]
+
+
+def query_fields(catalogue, fnames, ndim=None):
+    """
+    Find variables present in all of the files.
+
+    Same as `lfric_chunks.find_mesh_fields`, but no files are accessed,
+    and variables missing from some files are left out, so that the cubes
+    loaded from all files can be concatenated.
+    """
+    query = "SELECT name FROM variables WHERE path IN ({})".format(
+        ", ".join("?" * len(fnames))
+    )
+    params = [str(i) for i in fnames]
+    if ndim is not None:
+        query += " AND ndim = ?"
+        params.append(ndim)
+    query += " GROUP BY name HAVING COUNT(DISTINCT path) = ? ORDER BY name"
+    params.append(len({str(i) for i in fnames}))
+    with closing(connect(catalogue)) as con:
+        return [name for (name,) in con.execute(query, params)]
+
+
+def main(args=None):
+    """Main entry point of the script."""
+    t0 = time()
+    L = create_logger(Path(__file__))
+    # Parse command-line arguments
+    args = parse_args(args)
+    with closing(connect(args.catalogue)) as con:
+        for inpdir in args.inpdirs:
+            n_updated = update_catalogue(con, inpdir, fname=args.fname, L=L)
+            L.info(f"{inpdir}: {n_updated} files added or updated")
+    L.success(f"Saved to {args.catalogue}")
+    L.info(f"Execution time: {time() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
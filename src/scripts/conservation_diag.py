@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""Load LFRic conservation diagnostics and calculate global integrals."""
+# Standard library
+import os
+from pathlib import Path
+
+# External modules
+import iris
+from iris.coords import DimCoord
+import numpy as np
+
+# Local modules
+from lfric_chunks import chunk_day
+from ugrid_utils import ugrid_area_integral
+
+# Columns of `conservation_diag.dat` after the time step, and their units
+DIAGS = {
+    "total_atmosphere_mass": "kg",
+    "total_axial_angular_momentum": "kg m**2 s**-1",
+    "total_kinetic_energy": "kg m**2 s**-2",
+}
+CACHE_VERSION = 1
+# Column-integrated LFRic diagnostics and names of their global integrals
+COLUMN_INTEGRALS = {
+    "tot_col_dry_air_mass": "total_dry_air_mass",
+    "tot_col_int_energy": "total_internal_energy",
+    "tot_col_pot_energy": "total_potential_energy",
+    "tot_col_m_v": "total_water_vapour_mass",
+    "tot_col_m_cl": "total_cloud_liquid_water_mass",
+    "tot_col_m_ci": "total_cloud_ice_mass",
+}
+
+
+def read_conservation_diag(fname):
+    """
+    Parse one `conservation_diag.dat` file.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (rows, columns), with the time step in the first
+        column followed by the diagnostics in the order of `DIAGS`.
+    """
+    with open(fname, "rb") as fobj:
+        text = fobj.read()
+    ncols = len(text.split(b"\n", 1)[0].split())
+    ncols_out = 1 + len(DIAGS)
+    if ncols == 0:
+        return np.empty((0, ncols_out))
+    # Parse all numbers at once instead of line by line
+    values = np.array(text.split(), dtype=np.float64)
+    if values.size % ncols != 0:
+        raise ValueError(f"Rows have different lengths in {fname}")
+    return values.reshape(-1, ncols)[:, :ncols_out]
+
+
+def _sources(fnames):
+    """Paths and modification times of the source files."""
+    fnames = sorted(map(Path, fnames), key=chunk_day)
+    mtimes = [fname.stat().st_mtime_ns for fname in fnames]
+    return np.array([str(i) for i in fnames]), np.array(mtimes, dtype=int)
+
+
+def _load_cache(cache_file, sources, mtimes):
+    """Load the cached table if it is built from the same files."""
+    try:
+        with np.load(cache_file) as npz:
+            if (
+                (int(npz["version"]) == CACHE_VERSION)
+                and np.array_equal(npz["sources"], sources)
+                and np.array_equal(npz["mtimes"], mtimes)
+            ):
+                return npz["table"]
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+def _save_cache(cache_file, table, sources, mtimes):
+    """Save the table to a binary file, replacing it atomically."""
+    cache_file = Path(cache_file)
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    fname_tmp = cache_file.with_name(f".{cache_file.name}.tmp")
+    with open(fname_tmp, "wb") as fobj:
+        np.savez(
+            fobj,
+            version=CACHE_VERSION,
+            table=table,
+            sources=sources,
+            mtimes=mtimes,
+        )
+    os.replace(fname_tmp, cache_file)
+
+
+def load_conservation_table(fnames, cache_file=None):
+    """
+    Load conservation diagnostics from a series of restart chunks.
+
+    The chunks are concatenated in day order and sorted by time step.
+    Time steps repeated after a restart are taken from the later chunk.
+
+    Parameters
+    ----------
+    fnames: list-like
+        Paths to `conservation_diag.dat` files.
+    cache_file: pathlib.Path, optional
+        Binary file to store the result in. Reused while the list
+        of files and their modification times stay the same.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (time steps, 1 + len(DIAGS)).
+    """
+    sources, mtimes = _sources(fnames)
+    if len(sources) == 0:
+        raise ValueError("No files to load.")
+    if cache_file is not None:
+        if (table := _load_cache(cache_file, sources, mtimes)) is not None:
+            return table
+    table = np.concatenate([read_conservation_diag(i) for i in sources])
+    # Sort by time step (the first column), keeping the last occurrences
+    _, idx = np.unique(table[::-1, 0], return_index=True)
+    table = table[::-1][idx]
+    if cache_file is not None:
+        _save_cache(cache_file, table, sources, mtimes)
+    return table
+
+
+def load_conservation_diag(fnames, cache_file=None):
+    """
+    Load conservation diagnostics as cubes.
+
+    Same as `aeolus.io.load_conservation_diag`, but the text files
+    are parsed faster and the result can be cached.
+
+    Parameters
+    ----------
+    fnames: list-like
+        Paths to `conservation_diag.dat` files.
+    cache_file: pathlib.Path, optional
+        Binary file to store the parsed data in.
+
+    Returns
+    -------
+    iris.cube.CubeList
+        One cube for each of `DIAGS` with a "timestep" coordinate.
+    """
+    table = load_conservation_table(fnames, cache_file=cache_file)
+    timestep = DimCoord(table[:, 0].astype(int), long_name="timestep")
+    cubes = iris.cube.CubeList()
+    for i, (name, units) in enumerate(DIAGS.items(), start=1):
+        cubes.append(
+            iris.cube.Cube(
+                table[:, i],
+                long_name=name,
+                units=units,
+                dim_coords_and_dims=[(timestep.copy(), 0)],
+            )
+        )
+    return cubes
+
+
+def integrate_column_diags(cubelist, const=None, planet=None):
+    """
+    Calculate global integrals of column-integrated LFRic diagnostics.
+
+    This is a check of conservation independent of `conservation_diag.dat`,
+    computed on the native mesh from the diagnostic output.
+
+    Parameters
+    ----------
+    cubelist: iris.cube.CubeList
+        Raw LFRic output with variables listed in `COLUMN_INTEGRALS`.
+    const: aeolus.const.const.ConstContainer, optional
+        Planet constants.
+    planet: str, optional
+        Name of the planet configuration, used if `const` is not given.
+        By default, the `planet_conf` attribute of the cubes.
+
+    Returns
+    -------
+    iris.cube.CubeList
+        Time series of the global integrals of the available variables.
+    """
+    cubes = iris.cube.CubeList()
+    for var_name, name in COLUMN_INTEGRALS.items():
+        try:
+            cube = cubelist.extract_cube(
+                iris.NameConstraint(var_name=var_name)
+            )
+        except iris.exceptions.ConstraintMismatchError:
+            continue
+        total = ugrid_area_integral(cube, const=const, planet=planet)
+        total.standard_name = None
+        total.long_name = total.var_name = name
+        cubes.append(total)
+    return cubes
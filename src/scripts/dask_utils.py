@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Keep LFRic data lazy and control how dask computes them."""
+# External modules
+from aeolus.model import lfric
+import dask
+import iris
+from loguru import logger
+
+
+# Schedulers that can be used to compute the results
+SCHEDULERS = ("threads", "processes", "synchronous", "distributed")
+
+
+def _level_dims(cube, model=lfric):
+    """Find dimensions of vertical level or height coordinates."""
+    return {
+        cube.coord_dims(coord)[0]
+        for coord in cube.dim_coords
+        if coord.name().endswith("_levels") or coord.name() == model.z
+    }
+
+
+def rechunk_cube(cube, time_chunk=None, level_chunk=None, model=lfric):
+    """
+    Rechunk lazy data of a cube along time and vertical levels.
+
+    All other dimensions, including the UGRID mesh dimension, are put
+    in one chunk, as needed by the regridders.
+
+    Parameters
+    ----------
+    cube: iris.cube.Cube
+        Cube with lazy data. Modified in place.
+    time_chunk: int, optional
+        Number of time steps in a chunk. Chosen by dask if not given.
+    level_chunk: int, optional
+        Number of vertical levels in a chunk. All levels if not given.
+    model: aeolus.model.Model, optional
+        Model class with relevant coordinate names.
+
+    Returns
+    -------
+    iris.cube.Cube
+        The same cube.
+    """
+    t_dims = cube.coord_dims(model.t) if cube.coords(model.t) else ()
+    z_dims = _level_dims(cube, model=model)
+    chunks = []
+    for dim in range(cube.ndim):
+        if dim in t_dims:
+            chunks.append(time_chunk or "auto")
+        elif dim in z_dims:
+            chunks.append(level_chunk or -1)
+        else:
+            chunks.append(-1)
+    cube.data = cube.lazy_data().rechunk(tuple(chunks))
+    return cube
+
+
+def _same_except_data(cube, other):
+    """Compare metadata, shape and coordinates of two cubes."""
+    return (
+        (cube.metadata == other.metadata)
+        and (cube.shape == other.shape)
+        and (cube.coords() == other.coords())
+    )
+
+
+def unique_cubes_lazy(cubelist):
+    """
+    Remove duplicate cubes without realising their data.
+
+    Same as `aeolus.subset.unique_cubes`, but cubes are compared
+    by their metadata and coordinates only, not by their data. Of two
+    cubes with the same metadata and coordinates but different data,
+    only the first one is kept.
+    """
+    result = iris.cube.CubeList()
+    for cube in cubelist:
+        if not any(_same_except_data(cube, other) for other in result):
+            result.append(cube)
+    return result
+
+
+def setup_scheduler(scheduler="threads", workers=None):
+    """
+    Use the given scheduler for all dask computations in this process.
+
+    Parameters
+    ----------
+    scheduler: str, optional
+        One of `SCHEDULERS`. "distributed" starts a local cluster.
+    workers: int, optional
+        Number of threads, processes or cluster workers.
+        Chosen by dask if not given.
+
+    Returns
+    -------
+    dask.distributed.Client or None
+        Client of the local cluster if `scheduler` is "distributed".
+    """
+    if scheduler not in SCHEDULERS:
+        raise ValueError(f"scheduler={scheduler} is not valid.")
+    if scheduler == "distributed":
+        from dask.distributed import Client, LocalCluster
+
+        client = Client(LocalCluster(n_workers=workers))
+        logger.info(f"Dask dashboard: {client.dashboard_link}")
+        return client
+    dask.config.set(scheduler=scheduler, num_workers=workers)
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Precompute global and zonal mean diagnostics of the time-mean data."""
+# Standard library
+import argparse
+import json
+from pathlib import Path
+from time import time
+import warnings
+
+# External modules
+from aeolus.calc import bond_albedo, spatial_mean, zonal_mean
+from aeolus.core import AtmoSim
+from aeolus.exceptions import AeolusError
+from aeolus.io import load_data
+from aeolus.log import create_logger
+import iris
+import numpy as np
+
+# Local modules
+import paths
+from profiling import PROFILER, stage
+from shared import MODELS, TF_CASES, THAI_CASES
+
+# Ignore warnings about time coordinate bounds
+warnings.filterwarnings("ignore")
+SCRIPT = Path(__file__).name
+
+# Combine all experiments into one dictionary
+SIM_CASES = {**TF_CASES, **THAI_CASES}
+# File with all diagnostics
+STORE = paths.data_final / "global_diags.nc"
+# Diagnostics that could not be computed from each time-mean file
+FAILED = paths.data_final / "global_diags_failed.json"
+# Diagnostics computed from an `AtmoSim` instance and its model class.
+# Add entries here to make them available in the store.
+DIAGS = {
+    "t_sfc": lambda AS, model: spatial_mean(AS.t_sfc, model=model),
+    "toa_olr": lambda AS, model: spatial_mean(AS.toa_olr, model=model),
+    "bond_albedo": lambda AS, model: spatial_mean(
+        bond_albedo(AS._cubes, model=model), model=model
+    ),
+    "toa_net_energy": lambda AS, model: spatial_mean(
+        AS.toa_net_energy, model=model
+    ),
+    "t_sfc_zm": lambda AS, model: zonal_mean(AS.t_sfc, model=model),
+    "u_zm": lambda AS, model: zonal_mean(AS.u, model=model),
+}
+
+
+def parse_args(args=None):
+    """Argument parser."""
+    ap = argparse.ArgumentParser(
+        SCRIPT,
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        epilog=f"""Usage:
+./{SCRIPT} -m lfric -c thai_ben1 thai_hab1
+./{SCRIPT} -d t_sfc toa_olr --force
+""",
+    )
+    ap.add_argument(
+        "-m",
+        "--models",
+        type=str,
+        nargs="+",
+        default=[*MODELS],
+        choices=[*MODELS],
+        help="Models",
+    )
+    ap.add_argument(
+        "-c",
+        "--cases",
+        type=str,
+        nargs="+",
+        default=[*SIM_CASES],
+        choices=[*SIM_CASES],
+        help="Simulation labels",
+    )
+    ap.add_argument(
+        "-d",
+        "--diags",
+        type=str,
+        nargs="+",
+        default=[*DIAGS],
+        choices=[*DIAGS],
+        help="Diagnostics",
+    )
+    ap.add_argument(
+        "--force",
+        action="store_true",
+        default=False,
+        help="Recompute diagnostics even if the time-mean files are unchanged",
+    )
+    ap.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help=(
+            "Directory to which a report on the time, memory and I/O"
+            " of each processing stage is written"
+        ),
+    )
+    ap.add_argument(
+        "--cprofile",
+        action="store_true",
+        default=False,
+        help="Also save cProfile statistics to the --profile directory",
+    )
+    return ap.parse_args(args)
+
+
+def time_mean_file(model_key, sim_label):
+    """Path to the time-mean file of an experiment."""
+    suffix = SIM_CASES[sim_label]["proc_fname_suffix"]
+    return (
+        paths.data_final
+        / model_key
+        / sim_label
+        / f"{sim_label}_{suffix}_time_mean.nc"
+    )
+
+
+def _key(cube):
+    """Get the (model, case, diagnostic) key of a stored cube."""
+    return tuple(cube.attributes[i] for i in ("model", "case", "diagnostic"))
+
+
+def load_global_diags(store=STORE, models=None, cases=None, diags=None):
+    """
+    Load precomputed diagnostics.
+
+    Parameters
+    ----------
+    store: pathlib.Path, optional
+        File with the diagnostics.
+    models, cases, diags: list of str, optional
+        Select only these models, experiments and diagnostics.
+
+    Returns
+    -------
+    dict
+        Cubes keyed by (model, case, diagnostic).
+    """
+    if not Path(store).exists():
+        return {}
+    result = {}
+    for cube in iris.load(store):
+        model_key, sim_label, diag_key = key = _key(cube)
+        if (
+            ((models is None) or (model_key in models))
+            and ((cases is None) or (sim_label in cases))
+            and ((diags is None) or (diag_key in diags))
+        ):
+            result[key] = cube
+    return result
+
+
+def scalar_table(store=STORE, **kwargs):
+    """
+    Load the scalar diagnostics as a table.
+
+    Keyword arguments are passed to `load_global_diags`.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Values and units indexed by (model, case, diagnostic).
+    """
+    import pandas as pd
+
+    rows = {
+        key: {"value": float(cube.data), "units": str(cube.units)}
+        for key, cube in load_global_diags(store, **kwargs).items()
+        if cube.ndim == 0
+    }
+    names = ["model", "case", "diagnostic"]
+    if len(rows) == 0:
+        index = pd.MultiIndex.from_arrays([[], [], []], names=names)
+        return pd.DataFrame(index=index, columns=["value", "units"])
+    index = pd.MultiIndex.from_tuples(rows.keys(), names=names)
+    return pd.DataFrame(rows.values(), index=index).sort_index()
+
+
+def load_failed(fname=FAILED):
+    """Load the diagnostics that failed, keyed by "model/case"."""
+    try:
+        with open(fname, "r") as fobj:
+            return json.load(fobj)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_failed(failed, fname=FAILED):
+    """Save the diagnostics that failed."""
+    with open(fname, "w") as fobj:
+        json.dump(failed, fobj, indent=2)
+
+
+def failed_diags(failed, fname):
+    """Diagnostics that could not be computed from the current file."""
+    if (failed is None) or (failed["source_mtime"] != fname.stat().st_mtime):
+        return []
+    return failed["diags"]
+
+
+def is_up_to_date(cubes, fname, diags, failed=None):
+    """
+    Check if all diagnostics are computed from the current file.
+
+    Diagnostics that could not be computed from the same file,
+    as recorded in `failed`, are not computed again.
+    """
+    mtime = fname.stat().st_mtime
+    skipped = failed_diags(failed, fname)
+    return all(
+        (diag_key in skipped)
+        or (
+            (diag_key in cubes)
+            and (cubes[diag_key].attributes["source_mtime"] == mtime)
+        )
+        for diag_key in diags
+    )
+
+
+def compute_diags(fname, model_key, sim_label, diags, L):
+    """
+    Compute the diagnostics of one experiment.
+
+    Returns
+    -------
+    dict
+        Cubes keyed by diagnostic.
+    list of str
+        Diagnostics that could not be computed.
+    """
+    model = MODELS[model_key]["model"]
+    with stage("load"):
+        dset = load_data(fname)
+    AS = AtmoSim(
+        dset,
+        name=sim_label,
+        vert_coord="z",
+        planet=SIM_CASES[sim_label]["planet"],
+        const_dir=paths.const,
+        model=model,
+    )
+    attrs = {
+        "model": model_key,
+        "case": sim_label,
+        "source": fname.name,
+        "source_mtime": fname.stat().st_mtime,
+    }
+    result = {}
+    failed = []
+    for diag_key in diags:
+        with stage(f"diag_{diag_key}"):
+            try:
+                cube = iris.util.squeeze(DIAGS[diag_key](AS, model))
+            except (
+                AeolusError,
+                AttributeError,
+                iris.exceptions.ConstraintMismatchError,
+            ):
+                L.warning(f"Cannot compute {diag_key} for {fname}")
+                failed.append(diag_key)
+                continue
+            # Store only the data, not the planet constants etc.
+            cube = cube.copy(data=np.asarray(cube.data))
+            cube.attributes.clear()
+            cube.attributes.update(diagnostic=diag_key, **attrs)
+            cube.var_name = f"{model_key}__{sim_label}__{diag_key}"
+            result[diag_key] = cube
+    return result, failed
+
+
+def main(args=None):
+    """Main entry point of the script."""
+    t0 = time()
+    L = create_logger(Path(__file__))
+    # Parse command-line arguments
+    args = parse_args(args)
+    PROFILER.start(
+        track_memory=args.profile is not None,
+        cprofile=(args.profile is not None) and args.cprofile,
+    )
+    with stage("load_store"):
+        stored = load_global_diags(STORE)
+    L.info(f"Loaded {len(stored)} diagnostics from {STORE}")
+    failed = load_failed(FAILED)
+
+    n_updated = 0
+    for model_key in args.models:
+        for sim_label in args.cases:
+            fname = time_mean_file(model_key, sim_label)
+            if not fname.exists():
+                L.warning(f"File not found: {fname}")
+                continue
+            cubes = {
+                key[-1]: cube
+                for key, cube in stored.items()
+                if key[:2] == (model_key, sim_label)
+            }
+            failed_key = f"{model_key}/{sim_label}"
+            if not args.force and is_up_to_date(
+                cubes, fname, args.diags, failed=failed.get(failed_key)
+            ):
+                L.info(f"{model_key} {sim_label}: up to date")
+                continue
+            new, new_failed = compute_diags(
+                fname, model_key, sim_label, args.diags, L
+            )
+            # Keep failures of other diagnostics from the same file
+            skipped = set(failed_diags(failed.get(failed_key), fname))
+            skipped = (skipped - set(args.diags)) | set(new_failed)
+            if skipped:
+                failed[failed_key] = {
+                    "source_mtime": fname.stat().st_mtime,
+                    "diags": sorted(skipped),
+                }
+            else:
+                failed.pop(failed_key, None)
+            if any(
+                i.attributes["source_mtime"] != fname.stat().st_mtime
+                for i in cubes.values()
+            ):
+                # Drop all diagnostics of the previous version of the file
+                for diag_key in cubes:
+                    stored.pop((model_key, sim_label, diag_key))
+            for diag_key, cube in new.items():
+                stored[(model_key, sim_label, diag_key)] = cube
+            n_updated += 1
+            L.success(f"{model_key} {sim_label}: {[*new]}")
+
+    if n_updated > 0:
+        STORE.parent.mkdir(parents=True, exist_ok=True)
+        fname_tmp = STORE.with_name(f".{STORE.name}")
+        with stage("save"):
+            iris.save(iris.cube.CubeList(stored.values()), fname_tmp)
+            fname_tmp.replace(STORE)
+            save_failed(failed, FAILED)
+        L.success(f"Saved to {STORE}")
+    PROFILER.finish(args.profile, Path(__file__).stem, L=L)
+    L.info(f"Execution time: {time() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,23 +4,27 @@
 
 # Commonly used standard library tools
 import argparse
-from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
 from pathlib import Path
 from time import time
 
 # External modules
 from aeolus.const import init_const
-from aeolus.io import load_data, save_cubelist
+from aeolus.io import load_data
 from aeolus.model import lfric
-from aeolus.calc import calc_derived_cubes
 from aeolus.log import create_logger
 import iris
 from iris.experimental import stratify
+from loguru import logger
 import numpy as np
 
 # Local modules
+from io_utils import CHUNK_LAYOUTS, save_output
+from memo_cache import calc_derived_cubes_cached
 import paths
-from shared import MODELS
+from profiling import PROFILER, WorkerTask, gather, stage
+from shared import MODELS, TF_CASES, THAI_CASES
 
 # Global definitions and styles
 # Self name
@@ -37,6 +41,129 @@ INTERPOLATOR = partial(
 SIGMA_LEVELS = np.linspace(1, 0.01, 34)
 
 
+def _interp_weights(src, tgt):
+    """
+    Find linear interpolation indices and weights for each column at once.
+
+    Parameters
+    ----------
+    src: numpy.ndarray
+        Source levels, monotonic along the last axis.
+    tgt: numpy.ndarray
+        1D array of target levels.
+
+    Returns
+    -------
+    idx: numpy.ndarray
+        Index of the lower bracketing source level, shape (..., len(tgt)).
+    weights: numpy.ndarray
+        Weight of the upper bracketing source level, shape (..., len(tgt)).
+    """
+    *shape, nz = src.shape
+    src = src.reshape(-1, nz).astype(np.float64)
+    ncol = src.shape[0]
+    # Make each column increasing
+    sign = np.where(src[:, -1] >= src[:, 0], 1.0, -1.0)[:, np.newaxis]
+    src = src * sign
+    tgt = np.asarray(tgt, dtype=np.float64)[np.newaxis, :] * sign
+    # Shift the columns apart, so that one sorted search covers all of them
+    lower = min(src.min(), tgt.min())
+    span = max(src.max(), tgt.max()) - lower + 1
+    offset = np.arange(ncol)[:, np.newaxis] * span - lower
+    n_below = np.searchsorted(
+        (src + offset).ravel(), (tgt + offset).ravel()
+    ).reshape(tgt.shape) - (np.arange(ncol)[:, np.newaxis] * nz)
+    # Use the outermost pairs of levels for linear extrapolation
+    idx = np.clip(n_below - 1, 0, nz - 2)
+    src_lo = np.take_along_axis(src, idx, axis=-1)
+    src_hi = np.take_along_axis(src, idx + 1, axis=-1)
+    delta = src_hi - src_lo
+    weights = np.divide(
+        tgt - src_lo, delta, out=np.zeros_like(delta), where=delta != 0
+    )
+    ntgt = tgt.shape[-1]
+    return idx.reshape(*shape, ntgt), weights.reshape(*shape, ntgt)
+
+
+def relevel_batched(cubes, src_levels, tgt_levels, axis):
+    """
+    Interpolate cubes to new levels reusing the interpolation weights.
+
+    Same as calling `iris.experimental.stratify.relevel` for each cube
+    with linear interpolation and extrapolation, but the bracketing levels
+    are found only once and all cubes of the same shape as `src_levels`
+    are interpolated together as a stacked array.
+
+    Parameters
+    ----------
+    cubes: iris.cube.CubeList
+        Cubes to interpolate.
+    src_levels: iris.cube.Cube
+        Source levels of each column, monotonic along `axis`.
+    tgt_levels: numpy.ndarray
+        1D array of target levels.
+    axis: str
+        Name of the vertical coordinate.
+
+    Returns
+    -------
+    iris.cube.CubeList
+        Interpolated cubes.
+    """
+    (z_dim,) = src_levels.coord_dims(axis)
+    idx, weights = _interp_weights(
+        np.moveaxis(src_levels.data, z_dim, -1), tgt_levels
+    )
+    batch = [
+        i
+        for i, cube in enumerate(cubes)
+        if (cube.shape == src_levels.shape)
+        and (cube.coord_dims(axis) == (z_dim,))
+    ]
+    if batch:
+        stacked = np.ma.stack(
+            [np.moveaxis(cubes[i].data, z_dim, -1) for i in batch]
+        )
+        mask = np.ma.getmaskarray(stacked)
+        stacked = np.ma.getdata(stacked)
+        val_lo = np.take_along_axis(stacked, idx[np.newaxis], axis=-1)
+        val_hi = np.take_along_axis(stacked, idx[np.newaxis] + 1, axis=-1)
+        stacked = val_lo + weights * (val_hi - val_lo)
+        if mask.any():
+            # Mask the points interpolated from a masked level
+            stacked = np.ma.masked_array(
+                stacked,
+                mask=np.take_along_axis(mask, idx[np.newaxis], axis=-1)
+                | np.take_along_axis(mask, idx[np.newaxis] + 1, axis=-1),
+            )
+        # Skip the first dimension of the stack
+        stacked = np.moveaxis(stacked, -1, z_dim + 1)
+    result = iris.cube.CubeList()
+    for i, cube in enumerate(cubes):
+        if i in batch:
+            # Let stratify build the output cube from the ready data
+            interpolator = partial(
+                _precomputed, stacked[batch.index(i)].astype(cube.dtype)
+            )
+        else:
+            interpolator = INTERPOLATOR
+        result.append(
+            stratify.relevel(
+                cube,
+                src_levels,
+                tgt_levels,
+                axis=axis,
+                interpolator=interpolator,
+            )
+        )
+    return result
+
+
+def _precomputed(data, *args, **kwargs):
+    """Interpolator returning already interpolated data."""
+    return data
+
+
 def parse_args(args=None):
     """Argument parser."""
     ap = argparse.ArgumentParser(
@@ -45,6 +172,8 @@ def parse_args(args=None):
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         epilog=f"""Usage:
 ./{SCRIPT} -m lfric -i ~/path/to/inp/dir/ [-o ~/path/to/out/dir]
+./{SCRIPT} -m lfric -i ~/path/to/inp/dir1/ ~/path/to/inp/dir2/ -w 2
+./{SCRIPT} -m lfric -c tf thai_ben1 -w 4
 """,
     )
 
@@ -57,10 +186,153 @@ def parse_args(args=None):
         choices=["um", "lfric"],
     )
     ap.add_argument(
-        "-i", "--inpdir", type=str, help="Input directory", required=True
+        "-i", "--inpdir", type=str, nargs="+", help="Input directories"
+    )
+    ap.add_argument(
+        "-c",
+        "--cases",
+        type=str,
+        nargs="+",
+        help=(
+            "Simulation labels or groups of them ('tf', 'thai', 'all')"
+            " to process from the model's processed data directory"
+        ),
     )
     ap.add_argument("-o", "--outdir", type=str, help="Output directory")
-    return ap.parse_args(args)
+    ap.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to handle files in parallel",
+    )
+    ap.add_argument(
+        "--no_cache",
+        action="store_true",
+        default=False,
+        help="Do NOT reuse derived fields cached by previous runs",
+    )
+    ap.add_argument(
+        "--complevel",
+        type=int,
+        default=4,
+        help="Compression level of the output, from 0 (none) to 9",
+    )
+    ap.add_argument(
+        "--chunk_layout",
+        type=str,
+        default="slice",
+        choices=CHUNK_LAYOUTS,
+        help=(
+            "Chunk shape of the output: 'slice' for maps and cross-sections,"
+            " 'column' for vertical profiles and time series"
+        ),
+    )
+    ap.add_argument(
+        "--zarr",
+        action="store_true",
+        default=False,
+        help=(
+            "Write a Zarr store instead of a netCDF file"
+            " (for notebooks; not read by the other scripts)"
+        ),
+    )
+    ap.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help=(
+            "Directory to which a report on the time, memory and I/O"
+            " of each processing stage is written"
+        ),
+    )
+    ap.add_argument(
+        "--cprofile",
+        action="store_true",
+        default=False,
+        help="Also save cProfile statistics to the --profile directory",
+    )
+    args = ap.parse_args(args)
+    if not (args.inpdir or args.cases):
+        ap.error("at least one of --inpdir or --cases is required")
+    return args
+
+
+def get_inpdirs(model_key, inpdirs=None, cases=None):
+    """Make a list of input directories from paths and simulation labels."""
+    result = [Path(i) for i in inpdirs or []]
+    groups = {
+        "tf": [*TF_CASES],
+        "thai": [*THAI_CASES],
+        "all": [*TF_CASES, *THAI_CASES],
+    }
+    for case in cases or []:
+        for sim_label in groups.get(case, [case]):
+            result.append(MODELS[model_key]["data_proc_path"] / sim_label)
+    return result
+
+
+def get_inpfiles(inpdir):
+    """Find processed files in a directory that need relevelling."""
+    return sorted(
+        i
+        for i in inpdir.glob("*.nc")
+        if ("_sigma_p" not in i.stem)
+        and ("conservation" not in i.stem)
+        and ("_aggr" not in i.stem)
+    )
+
+
+@lru_cache
+def get_const(planet):
+    """Initialise planet constants once per process."""
+    return init_const(planet, directory=paths.const)
+
+
+def process_file(fname, model_key, use_cache=True, **kw_out):
+    """
+    Interpolate fields from one file to sigma-p levels.
+
+    Derived fields are reused from the cache if `use_cache` is True.
+    Other keyword arguments are passed to `io_utils.save_output`.
+    """
+    model = MODELS[model_key]["model"]
+    logger.info(f"{fname=}")
+    with stage("load"):
+        dset = load_data(fname)
+    if len(dset) == 0:
+        logger.critical(f"The file is empty: {fname}")
+        return
+    planet = dset[0].attributes["planet"]
+
+    const = get_const(planet)
+    with stage("calc_derived_cubes"):
+        calc_derived_cubes_cached(
+            dset, const=const, model=model, use_cache=use_cache
+        )
+
+    # Interpolation / relevelling
+    with stage("relevel"):
+        pres = dset.extract_cube(model.pres)
+        p_sfc = pres.extract(iris.Constraint(**{model.z: 0}))
+        sigma_p = pres / p_sfc
+        sigma_p.rename(lfric.s)
+
+        dset_interp = relevel_batched(
+            dset.extract(
+                [model.temp, model.u, model.v, model.w, model.pres, model.dens]
+            ),
+            sigma_p,
+            SIGMA_LEVELS,
+            axis=model.z,
+        )
+
+    # Write the data to a netCDF file
+    fname_out = fname.with_stem(f"{fname.stem}_sigma_p")
+    with stage("save"):
+        fname_out = save_output(dset_interp, fname_out, **kw_out)
+    logger.success(f"Saved to {fname_out}")
+    return fname_out
 
 
 def main(args=None):
@@ -69,69 +341,53 @@ def main(args=None):
     L = create_logger(Path(__file__))
     # Parse command-line arguments
     args = parse_args(args)
+    PROFILER.start(
+        track_memory=args.profile is not None,
+        cprofile=(args.profile is not None) and args.cprofile,
+    )
     model_key = args.model
     L.info(f"{model_key=}")
-    model = MODELS[model_key]["model"]
 
-    # Input directory
-    inpdir = Path(args.inpdir)
+    # Input directories
+    inpdirs = get_inpdirs(model_key, inpdirs=args.inpdir, cases=args.cases)
 
     if outdir := args.outdir:
         # If given, create a subdirectory for processed data
         outdir = Path(args.outdir)
         outdir.mkdir(parents=True, exist_ok=True)
-        L.info(f"{inpdir=}")
+        L.info(f"{inpdirs=}")
         L.info(f"{outdir=}")
     else:
-        outdir = inpdir
-        L.info(f"inpdir=outdir={inpdir}")
-
-    # Get the input file
-    try:
-        fname = sorted(
-            i
-            for i in inpdir.glob("*.nc")
-            if ("_sigma_p" not in i.stem) and ("conservation" not in i.stem)
-        )[
-            0
-        ]  # Assume only 1 file
-    except IndexError:
-        L.critical("No file found")
-
-    L.info(f"{fname=}")
-    dset = load_data(fname)
-    if len(dset) == 0:
-        L.critical("The file is empty")
-        return
-    planet = dset[0].attributes["planet"]
-
-    const = init_const(planet, directory=paths.const)
-    calc_derived_cubes(dset, const=const, model=model)
+        L.info(f"inpdirs=outdirs={inpdirs}")
 
-    # Interpolation / relevelling
-    dset_interp = iris.cube.CubeList()
-    pres = dset.extract_cube(model.pres)
-    p_sfc = pres.extract(iris.Constraint(**{model.z: 0}))
-    sigma_p = pres / p_sfc
-    sigma_p.rename(lfric.s)
-
-    for cube in dset.extract(
-        [model.temp, model.u, model.v, model.w, model.pres, model.dens]
-    ):
-        dset_interp.append(
-            stratify.relevel(
-                cube,
-                sigma_p,
-                SIGMA_LEVELS,
-                axis=model.z,
-                interpolator=INTERPOLATOR,
-            )
-        )
+    # Get the input files
+    fnames = []
+    with stage("find_files"):
+        for inpdir in inpdirs:
+            if len(inpdir_fnames := get_inpfiles(inpdir)) == 0:
+                L.critical(f"No file found in {inpdir}")
+            fnames.extend(inpdir_fnames)
+    if len(fnames) == 0:
+        return
 
-    # Write the data to a netCDF file
-    fname_out = fname.with_stem(f"{fname.stem}_sigma_p")
-    save_cubelist(dset_interp, fname_out)
-    L.success(f"Saved to {fname_out}")
+    func = partial(
+        process_file,
+        model_key=model_key,
+        use_cache=not args.no_cache,
+        layout=args.chunk_layout,
+        complevel=args.complevel,
+        zarr=args.zarr,
+    )
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            fnames_out = [*gather(executor.map(WorkerTask(func), fnames))]
+    else:
+        fnames_out = [*map(func, fnames)]
+    L.info(
+        f"Processed {sum(i is not None for i in fnames_out)}"
+        f" of {len(fnames)} files"
+    )
+    PROFILER.finish(args.profile, f"{Path(__file__).stem}_{model_key}", L=L)
     L.info(f"Execution time: {time() - t0:.1f}s")
 
 
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""Write processed data to compressed and chunked files."""
+# Standard library
+from pathlib import Path
+import shutil
+
+# External modules
+import dask
+import iris
+from iris.fileformats.netcdf import CF_CONVENTIONS_VERSION, Saver
+import numpy as np
+
+
+# Chunk shapes for different access patterns:
+# "slice" - one time step and level per chunk, for maps and cross-sections;
+# "column" - all times and levels of a tile of grid points, for profiles
+#  and time series; "auto" - chosen by the netCDF library.
+CHUNK_LAYOUTS = ("slice", "column", "auto")
+# Number of grid points along each side of a lat-lon tile in a column chunk
+COLUMN_TILE = 32
+# Upper limit of the size of a column chunk, in bytes
+COLUMN_CHUNK_BYTES = 2**24
+
+
+def _horizontal_dims(cube):
+    """Find dimensions of the mesh or of the x and y coordinates."""
+    dims = set()
+    if cube.mesh is not None:
+        dims.add(cube.mesh_dim())
+    for coord in cube.dim_coords:
+        if iris.util.guess_coord_axis(coord) in ("X", "Y"):
+            dims.update(cube.coord_dims(coord))
+    return dims
+
+
+def chunk_shape(cube, layout="slice"):
+    """
+    Get the chunk shape of a variable for the given access pattern.
+
+    Parameters
+    ----------
+    cube: iris.cube.Cube
+        Cube to save.
+    layout: str, optional
+        One of `CHUNK_LAYOUTS`.
+
+    Returns
+    -------
+    tuple of int or None
+        Chunk shape, or None to use the default chunking.
+    """
+    if layout not in CHUNK_LAYOUTS:
+        raise ValueError(f"layout={layout} is not valid.")
+    h_dims = _horizontal_dims(cube)
+    if (layout == "auto") or (not h_dims):
+        return None
+    if layout == "slice":
+        return tuple(
+            size if dim in h_dims else 1 for dim, size in enumerate(cube.shape)
+        )
+    # Square tiles on a lat-lon grid, the same number of cells on a mesh
+    tile = COLUMN_TILE ** (2 // len(h_dims))
+    shape = [
+        min(size, tile) if dim in h_dims else size
+        for dim, size in enumerate(cube.shape)
+    ]
+    # Shorten the chunk along the leading (time) dimension if it is too big
+    if 0 not in h_dims:
+        other = np.prod(shape[1:]) * cube.dtype.itemsize
+        shape[0] = int(max(1, min(shape[0], COLUMN_CHUNK_BYTES // other)))
+    return tuple(shape)
+
+
+def _prepare_cubes(cubelist, **gl_attrs):
+    """Drop the `planet_conf` container and add global attributes."""
+    result = iris.cube.CubeList()
+    for cube in cubelist:
+        # Do not copy the data
+        cube_out = cube.copy(data=cube.core_data())
+        cube_out.attributes.pop("planet_conf", None)
+        cube_out.attributes.update(gl_attrs)
+        result.append(cube_out)
+    return result
+
+
+def _local_keys(cubes):
+    """Find attributes not shared by all cubes, to save them per variable."""
+    all_keys = set().union(*[cube.attributes for cube in cubes])
+    result = set()
+    for key in all_keys:
+        values = [cube.attributes.get(key, None) for cube in cubes]
+        if any(
+            (key not in cube.attributes) or np.any(value != values[0])
+            for cube, value in zip(cubes, values)
+        ):
+            result.add(key)
+    return result
+
+
+def save_netcdf(cubes, path, layout="slice", complevel=4, shuffle=True):
+    """Save cubes to a netCDF4 file with per-variable chunks."""
+    with Saver(str(path), "NETCDF4") as sman:
+        local_keys = _local_keys(cubes)
+        for cube in cubes:
+            sman.write(
+                cube,
+                local_keys=local_keys,
+                zlib=complevel > 0,
+                complevel=max(complevel, 1),
+                shuffle=shuffle,
+                chunksizes=chunk_shape(cube, layout=layout),
+            )
+        sman.update_global_attributes(Conventions=CF_CONVENTIONS_VERSION)
+
+
+def save_zarr(cubes, path, layout="slice", complevel=4, shuffle=True):
+    """
+    Save cubes to a Zarr store, one group per variable.
+
+    The chunks of all variables are written at once by the active dask
+    scheduler, so that several workers can write to the store in parallel.
+    """
+    import xarray as xr
+    from zarr.codecs import BloscCodec
+
+    if complevel > 0:
+        compressors = [
+            BloscCodec(
+                cname="zstd",
+                clevel=complevel,
+                shuffle="shuffle" if shuffle else "noshuffle",
+            )
+        ]
+    else:
+        compressors = None
+    shutil.rmtree(path, ignore_errors=True)
+    writes = []
+    for cube in cubes:
+        arr = xr.DataArray.from_iris(cube)
+        name = arr.name or cube.name()
+        encoding = {"compressors": compressors}
+        if (chunks := chunk_shape(cube, layout=layout)) is not None:
+            encoding["chunks"] = chunks
+            arr = arr.chunk(dict(zip(arr.dims, chunks)))
+        writes.append(
+            arr.to_dataset(name=name).to_zarr(
+                path,
+                group=name,
+                mode="w",
+                encoding={name: encoding},
+                compute=False,
+            )
+        )
+    dask.compute(*writes)
+
+
+def save_output(
+    cubelist,
+    path,
+    layout="slice",
+    complevel=4,
+    shuffle=True,
+    zarr=False,
+    **gl_attrs,
+):
+    """
+    Save a cube list to a compressed netCDF file or a Zarr store.
+
+    Same as `aeolus.io.save_cubelist`, but each variable is chunked
+    for the given access pattern and compressed.
+
+    Parameters
+    ----------
+    cubelist: iris.cube.CubeList
+        Cubes to save.
+    path: pathlib.Path
+        Output file. Its suffix is replaced with ".zarr" if `zarr` is True.
+    layout: str, optional
+        Chunk layout, one of `CHUNK_LAYOUTS`.
+    complevel: int, optional
+        Compression level from 0 (no compression) to 9.
+    shuffle: bool, optional
+        Apply the byte shuffle filter before compression.
+    zarr: bool, optional
+        Write a Zarr store instead of a netCDF file.
+        Requires xarray and zarr>=3.
+    **gl_attrs: dict, optional
+        Global attributes.
+
+    Returns
+    -------
+    pathlib.Path
+        Path to the saved file or store.
+    """
+    cubes = _prepare_cubes(cubelist, **gl_attrs)
+    kw = {"layout": layout, "complevel": complevel, "shuffle": shuffle}
+    if zarr:
+        path = Path(path).with_suffix(".zarr")
+        save_zarr(cubes, path, **kw)
+    else:
+        save_netcdf(cubes, path, **kw)
+    return path
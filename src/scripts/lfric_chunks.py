@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""Handle raw LFRic output split into restart chunks."""
+# Standard library
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import json
+from pathlib import Path
+
+# External modules
+from aeolus.io import load_data, save_cubelist
+from aeolus.lfric import clean_attrs
+import dask
+import iris
+from loguru import logger
+import netCDF4
+
+# Local modules
+from manifest import (
+    forget_partial,
+    is_up_to_date,
+    load_manifest,
+    match_options,
+    record_partial,
+    save_manifest,
+)
+from mesh_cache import load_mesh_index, save_mesh_index, share_mesh
+from profiling import WorkerTask, gather, stage
+
+
+def chunk_day(fname):
+    """Get the start day of a chunk from its `<day>/<cnum>/` directory."""
+    return int(Path(fname).parent.parent.name)
+
+
+def find_chunks(
+    inpdir, c_num, fname="lfric_diag.nc", startday=None, endday=None
+):
+    """
+    Find LFRic output files in `inpdir` and sort them by day.
+
+    If given, `startday` and `endday` select the chunks starting
+    within this range of days (inclusive).
+    """
+    fnames = sorted(Path(inpdir).glob(f"*/*{c_num}*/{fname}"), key=chunk_day)
+    return [
+        i
+        for i in fnames
+        if ((startday is None) or (chunk_day(i) >= startday))
+        and ((endday is None) or (chunk_day(i) <= endday))
+    ]
+
+
+def load_field_pack(fname):
+    """Load lists of netCDF variable names to process from a JSON file."""
+    with open(fname, "r") as fobj:
+        return json.load(fobj)
+
+
+def find_mesh_fields(fname, ndim=None):
+    """
+    Find variables on the mesh by reading the header of a file.
+
+    Parameters
+    ----------
+    fname: pathlib.Path
+        LFRic output file.
+    ndim: int, optional
+        Select only the variables with this number of dimensions,
+        e.g. 2 for single-level fields with a time dimension.
+
+    Returns
+    -------
+    list of str
+        Variable names.
+    """
+    with netCDF4.Dataset(fname) as ds:
+        return [
+            name
+            for name, var in ds.variables.items()
+            if ("mesh" in var.ncattrs())
+            and ((ndim is None) or (var.ndim == ndim))
+        ]
+
+
+def load_lfric_fields(
+    fnames, fields=None, callback=None, drop_coord=(), mesh_index=None
+):
+    """
+    Load raw LFRic data, reading only the selected variables.
+
+    Same as `aeolus.lfric.load_lfric_raw`, but only the variables
+    in `fields` and their coordinates are read from the files,
+    and all cubes on the same mesh share one mesh object.
+
+    Parameters
+    ----------
+    fnames: list of pathlib.Path
+        LFRic output files.
+    fields: list of str, optional
+        Names of netCDF variables to load. If None, load all variables.
+    callback: callable, optional
+        Function applied to each cube when it is loaded.
+    drop_coord: list of str, optional
+        Coordinates to remove before concatenating the cubes.
+    mesh_index: pathlib.Path, optional
+        JSON file with mesh fingerprints of previously loaded files,
+        so that the mesh is read only from the first file in a process.
+
+    Returns
+    -------
+    iris.cube.CubeList
+        Cubes concatenated along time.
+    """
+    if fields is None:
+        constraints = None
+    else:
+        # A list of variable names lets iris skip all other variables
+        constraints = [iris.NameConstraint(var_name=name) for name in fields]
+
+    def _callback(cube, field, filename):
+        share_mesh(cube, field, filename)
+        if callback is not None:
+            return callback(cube, field, filename)
+        return cube
+
+    if mesh_index is not None:
+        load_mesh_index(mesh_index)
+    cl_raw = iris.load(fnames, constraints, callback=_callback)
+    if mesh_index is not None:
+        save_mesh_index(mesh_index)
+    cl_raw = iris.cube.CubeList(
+        clean_attrs(cube, None, None) for cube in cl_raw
+    )
+    for coord in drop_coord:
+        for cube in cl_raw:
+            try:
+                cube.remove_coord(coord)
+            except iris.exceptions.CoordinateNotFoundError:
+                pass
+    return cl_raw.concatenate(check_aux_coords=False)
+
+
+def split_into_windows(fnames, window=None):
+    """Split a sorted list of files into windows of `window` chunks."""
+    if window is None:
+        return [fnames]
+    if window < 1:
+        raise ValueError(f"window={window} should be a positive integer.")
+    starts = range(0, len(fnames), window)
+    return [fnames[i0:i1] for i0, i1 in zip(starts, [*starts[1:], None])]
+
+
+def partial_fname(outdir, label, fnames, suffix):
+    """Path to a partial output file for a window of chunks."""
+    day_str = f"days{chunk_day(fnames[0])}"
+    if len(fnames) > 1:
+        day_str += f"_{chunk_day(fnames[-1])}"
+    return (
+        Path(outdir) / f"_{label}_partial" / f"{label}_{day_str}_{suffix}.nc"
+    )
+
+
+def save_partial(cubelist, fname, **gl_attrs):
+    """Save a partial output of one window of chunks."""
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    save_cubelist(cubelist, fname, **gl_attrs)
+
+
+def _init_worker():
+    """Avoid oversubscribing cores by dask threads within each worker."""
+    dask.config.set(scheduler="synchronous")
+
+
+def _process_window(fnames, func, fname_part, gl_attrs):
+    """Process one window of chunks and save the result."""
+    logger.info(f"Processing {fnames[0]} ... {fnames[-1]}")
+    cubelist = func(fnames)
+    if len(cubelist) == 0:
+        logger.warning(f"Files are empty: {fnames[0]} ... {fnames[-1]}")
+        return None
+    with stage("save_partial"):
+        save_partial(cubelist, fname_part, **gl_attrs)
+    return fname_part
+
+
+def process_windows(
+    func,
+    windows,
+    fnames_part,
+    gl_attrs,
+    workers=1,
+    manifest_file=None,
+    options=None,
+):
+    """
+    Apply a function to windows of chunks and save partial outputs.
+
+    Parameters
+    ----------
+    func: callable
+        Function taking a list of files and returning a cube list.
+        Must be picklable if `workers` > 1.
+    windows: list of lists of pathlib.Path
+        Windows of chunks sorted by day, e.g. from `split_into_windows`.
+    fnames_part: list of pathlib.Path
+        Partial output file for each window, e.g. from `partial_fname`.
+    gl_attrs: dict
+        Global attributes of the partial output files.
+    workers: int, optional
+        Number of worker processes.
+    manifest_file: pathlib.Path, optional
+        If given, only the windows whose input files have changed since
+        the last run are processed, and the manifest is updated.
+    options: str, optional
+        Hash of the processing options, e.g. from `manifest.options_hash`.
+        If it differs from the one in the manifest, all windows are
+        processed again.
+
+    Returns
+    -------
+    list of pathlib.Path
+        Non-empty partial output files in the same order as `windows`.
+    """
+    if manifest_file is None:
+        todo = [*range(len(windows))]
+    else:
+        manifest = load_manifest(manifest_file)
+        if match_options(manifest, options):
+            logger.info("Processing options have changed")
+        todo = [
+            i
+            for i, (fnames, fname_part) in enumerate(zip(windows, fnames_part))
+            if not is_up_to_date(manifest, fnames, fname_part)
+        ]
+        logger.info(
+            f"{len(windows) - len(todo)} of {len(windows)} windows"
+            " are up to date"
+        )
+    args = (
+        [windows[i] for i in todo],
+        repeat(func),
+        [fnames_part[i] for i in todo],
+        repeat(gl_attrs),
+    )
+    if workers > 1:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker
+        ) as executor:
+            # `map` preserves the order of windows
+            result = dict(
+                zip(
+                    todo,
+                    gather(executor.map(WorkerTask(_process_window), *args)),
+                )
+            )
+    else:
+        result = dict(zip(todo, map(_process_window, *args)))
+    if manifest_file is not None:
+        for i, fname_part in result.items():
+            if fname_part is None:
+                forget_partial(manifest, fnames_part[i])
+                fnames_part[i].unlink(missing_ok=True)
+            else:
+                record_partial(manifest, windows[i], fname_part)
+        save_manifest(manifest, manifest_file)
+    # Reuse the partial outputs that have not been processed this time
+    return [
+        fname_part
+        for i, fname_part in enumerate(fnames_part)
+        if result.get(i, fname_part) is not None
+    ]
+
+
+def load_partials(fnames):
+    """Load partial outputs lazily and concatenate them along time."""
+    if len(fnames) == 0:
+        return iris.cube.CubeList()
+    return load_data([str(i) for i in fnames]).concatenate()
+
+
+def remove_partials(fnames):
+    """Delete partial outputs and their directory if it is empty."""
+    parents = {Path(i).parent for i in fnames}
+    for fname in fnames:
+        Path(fname).unlink(missing_ok=True)
+    for parent in parents:
+        if not any(parent.iterdir()):
+            parent.rmdir()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""Keep track of processed input files to allow incremental re-processing."""
+# Standard library
+import json
+import os
+from pathlib import Path
+import shutil
+
+# External modules
+import xxhash
+
+
+MANIFEST_VERSION = 1
+# Read files in blocks of this size when hashing
+HASH_BLOCK_SIZE = 2**24
+
+
+def manifest_path(outdir, label, suffix):
+    """Path to the manifest stored next to the output files."""
+    return Path(outdir) / f"{label}_{suffix}_manifest.json"
+
+
+def file_hash(fname):
+    """Calculate xxhash digest of a file's content."""
+    h = xxhash.xxh3_64()
+    with open(fname, "rb") as fobj:
+        while block := fobj.read(HASH_BLOCK_SIZE):
+            h.update(block)
+    return h.hexdigest()
+
+
+def options_hash(options, files=()):
+    """
+    Calculate xxhash digest of processing options.
+
+    Parameters
+    ----------
+    options: dict
+        JSON-serialisable options that affect the processed data.
+    files: list of pathlib.Path, optional
+        Files referred to by the options, e.g. variable packs,
+        whose content is included in the hash.
+    """
+    h = xxhash.xxh3_64(json.dumps(options, sort_keys=True).encode())
+    for fname in files:
+        h.update(file_hash(fname).encode())
+    return h.hexdigest()
+
+
+def file_record(fname, content_hash=None):
+    """Describe a file by its path, size, modification time and hash."""
+    stat = Path(fname).stat()
+    return {
+        "path": str(Path(fname).resolve()),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "hash": content_hash or file_hash(fname),
+    }
+
+
+def is_unchanged(record):
+    """Check if a file still matches its manifest record."""
+    fname = Path(record["path"])
+    try:
+        stat = fname.stat()
+    except FileNotFoundError:
+        return False
+    if stat.st_size != record["size"]:
+        return False
+    if stat.st_mtime == record["mtime"]:
+        return True
+    # Touched, but the content might be the same
+    return file_hash(fname) == record["hash"]
+
+
+def load_manifest(fname):
+    """Load a manifest or create an empty one."""
+    try:
+        with open(fname, "r") as fobj:
+            manifest = json.load(fobj)
+    except FileNotFoundError:
+        manifest = {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        manifest = {"version": MANIFEST_VERSION, "partials": {}}
+    return manifest
+
+
+def save_manifest(manifest, fname):
+    """Write a manifest to a JSON file."""
+    fname = Path(fname)
+    fname_tmp = fname.with_suffix(f".{os.getpid()}.tmp")
+    with open(fname_tmp, "w") as fobj:
+        json.dump(manifest, fobj, indent=2)
+    os.replace(fname_tmp, fname)
+
+
+def match_options(manifest, options):
+    """
+    Forget all partial outputs if they were made with other options.
+
+    Returns
+    -------
+    bool
+        True if partial outputs made with other options were forgotten.
+    """
+    if manifest.get("options") == options:
+        return False
+    changed = len(manifest["partials"]) > 0
+    manifest["options"] = options
+    manifest["partials"] = {}
+    return changed
+
+
+def is_up_to_date(manifest, fnames, fname_part):
+    """Check if a partial output exists and was made from `fnames` as is."""
+    if not Path(fname_part).exists():
+        return False
+    try:
+        records = manifest["partials"][Path(fname_part).name]
+    except KeyError:
+        return False
+    if [i["path"] for i in records] != [
+        str(Path(i).resolve()) for i in fnames
+    ]:
+        return False
+    return all(is_unchanged(record) for record in records)
+
+
+def record_partial(manifest, fnames, fname_part):
+    """Record the input files used to make a partial output."""
+    old = {
+        i["path"]: i
+        for i in manifest["partials"].get(Path(fname_part).name, [])
+    }
+    records = []
+    for fname in fnames:
+        prev = old.get(str(Path(fname).resolve()))
+        if (prev is not None) and is_unchanged(prev):
+            records.append(file_record(fname, content_hash=prev["hash"]))
+        else:
+            records.append(file_record(fname))
+    manifest["partials"][Path(fname_part).name] = records
+
+
+def forget_partial(manifest, fname_part):
+    """Remove a partial output from the manifest."""
+    manifest["partials"].pop(Path(fname_part).name, None)
+
+
+def replace_output(manifest_file, fname_out):
+    """Record a new output file and delete the one it supersedes."""
+    manifest = load_manifest(manifest_file)
+    if (old := manifest.get("output")) is not None:
+        old = Path(fname_out).parent / old
+        if old.is_dir() and old != Path(fname_out):
+            shutil.rmtree(old)
+        elif old != Path(fname_out):
+            old.unlink(missing_ok=True)
+    manifest["output"] = Path(fname_out).name
+    save_manifest(manifest, manifest_file)
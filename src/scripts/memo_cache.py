@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""Cache results of calculations with cubes on disk."""
+# Standard library
+from dataclasses import is_dataclass
+from functools import wraps
+import os
+from pathlib import Path
+import weakref
+
+# External modules
+from aeolus.calc import calc_derived_cubes
+from aeolus.model import um
+import dask.array as da
+import iris
+from loguru import logger
+import numpy as np
+import xxhash
+
+# Local modules
+import paths
+
+# Directory with cached results
+CACHE_DIR = paths.cache / "derived"
+# Least recently used results are deleted when the cache exceeds this size
+MAX_SIZE = 2**33
+# Change to invalidate all cached results
+CACHE_VERSION = 1
+# Attributes that cannot be saved to netCDF
+SKIP_ATTRS = ("planet_conf",)
+# Cubes with lazy data loaded from each cached file in this process
+_LAZY_RESULTS = {}
+
+
+def _update_hash(h, obj):
+    """
+    Add an object to a hash, including data of cubes and arrays.
+
+    Lazy data are read one dask block at a time and are not kept
+    in memory, so that the data of input cubes stay lazy.
+    """
+    if isinstance(obj, iris.cube.Cube):
+        h.update(repr((obj.name(), obj.units, obj.shape)).encode())
+        attrs = {
+            k: v for k, v in obj.attributes.items() if k not in SKIP_ATTRS
+        }
+        h.update(repr(sorted(attrs.items())).encode())
+        _update_hash(h, obj.core_data())
+        for coord in obj.coords():
+            h.update(repr((coord.name(), coord.units)).encode())
+            h.update(repr(obj.coord_dims(coord)).encode())
+            _update_hash(h, coord.core_points())
+            _update_hash(h, coord.core_bounds())
+    elif isinstance(obj, da.Array):
+        h.update(repr((obj.dtype, obj.chunks)).encode())
+        for index in np.ndindex(*obj.numblocks):
+            _update_hash(h, np.asanyarray(obj.blocks[index].compute()))
+    elif isinstance(obj, np.ndarray):
+        arr = np.ascontiguousarray(np.ma.getdata(obj))
+        h.update(repr((arr.dtype, arr.shape)).encode())
+        h.update(arr.tobytes())
+        if np.ma.is_masked(obj):
+            _update_hash(h, np.ma.getmaskarray(obj))
+    elif isinstance(obj, (list, tuple)):
+        h.update(f"{type(obj).__name__}{len(obj)}".encode())
+        for item in obj:
+            _update_hash(h, item)
+    elif isinstance(obj, dict):
+        h.update(f"dict{len(obj)}".encode())
+        for key in sorted(obj):
+            h.update(repr(key).encode())
+            _update_hash(h, obj[key])
+    elif is_dataclass(obj):
+        # E.g. model classes or containers of planet constants
+        h.update(type(obj).__name__.encode())
+        _update_hash(h, vars(obj))
+    else:
+        h.update(repr(obj).encode())
+
+
+def cache_key(func, *args, **kwargs):
+    """Get a hex digest identifying a function call and its arguments."""
+    h = xxhash.xxh3_128()
+    h.update(f"{CACHE_VERSION}{func.__module__}.{func.__qualname__}".encode())
+    _update_hash(h, args)
+    _update_hash(h, kwargs)
+    return h.hexdigest()
+
+
+def _save_result(result, fname):
+    """Save a cube or a cube list, dropping attributes not fit for netCDF."""
+    is_cube = isinstance(result, iris.cube.Cube)
+    cubes = iris.cube.CubeList()
+    for i, cube in enumerate([result] if is_cube else result):
+        cube = cube.copy()
+        for key in SKIP_ATTRS:
+            cube.attributes.pop(key, None)
+        cube.attributes["memo_index"] = i
+        cube.attributes["memo_type"] = "cube" if is_cube else "cubelist"
+        cubes.append(cube)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    fname_tmp = fname.with_name(f".{os.getpid()}.{fname.name}")
+    iris.save(cubes, fname_tmp)
+    os.replace(fname_tmp, fname)
+
+
+def _load_result(fname, attrs):
+    """
+    Load a saved result lazily and restore the dropped attributes.
+
+    The data are read into memory only if the file is evicted from the
+    cache by this process, see `evict`.
+    """
+    cubes = sorted(
+        iris.load(fname), key=lambda cube: cube.attributes["memo_index"]
+    )
+    result = iris.cube.CubeList()
+    is_cube = False
+    for cube in cubes:
+        is_cube = cube.attributes.pop("memo_type") == "cube"
+        cube.attributes.pop("memo_index")
+        cube.attributes.pop("Conventions", None)
+        cube.attributes.update(attrs)
+        result.append(cube)
+    _LAZY_RESULTS.setdefault(Path(fname).resolve(), weakref.WeakSet()).update(
+        result
+    )
+    return result[0] if is_cube else result
+
+
+def _skipped_attrs(args, kwargs):
+    """Find attributes not saved to netCDF in the input cubes."""
+    for arg in [*args, *kwargs.values()]:
+        if isinstance(arg, iris.cube.Cube):
+            arg = [arg]
+        if isinstance(arg, (list, tuple)):
+            for cube in arg:
+                if isinstance(cube, iris.cube.Cube):
+                    attrs = {
+                        key: cube.attributes[key]
+                        for key in SKIP_ATTRS
+                        if key in cube.attributes
+                    }
+                    if attrs:
+                        return attrs
+    return {}
+
+
+def evict(cache_dir=CACHE_DIR, max_size=MAX_SIZE):
+    """Delete least recently used files until the cache fits `max_size`."""
+    fnames = []
+    for fname in Path(cache_dir).glob("*.nc"):
+        try:
+            fnames.append((fname.stat(), fname))
+        except FileNotFoundError:
+            # Deleted by another process
+            pass
+    total = sum(stat.st_size for stat, _ in fnames)
+    for stat, fname in sorted(fnames, key=lambda x: x[0].st_mtime):
+        if total <= max_size:
+            break
+        # Keep the data of results still in use
+        for cube in _LAZY_RESULTS.pop(fname.resolve(), ()):
+            cube.data
+        fname.unlink(missing_ok=True)
+        total -= stat.st_size
+        logger.debug(f"Evicted {fname} from the cache")
+
+
+def memoise(cache_dir=CACHE_DIR, max_size=MAX_SIZE):
+    """
+    Decorate a function returning cubes to cache its results on disk.
+
+    Results are saved to netCDF files named by a hash of the function name
+    and its arguments, including the data and coordinates of input cubes.
+    Attributes that cannot be saved to netCDF (`SKIP_ATTRS`) are copied
+    from the input cubes. Pass `use_cache=False` to bypass the cache.
+
+    Parameters
+    ----------
+    cache_dir: pathlib.Path, optional
+        Directory with cached results.
+    max_size: int, optional
+        Maximum total size of the files in bytes.
+
+    Examples
+    --------
+    >>> from aeolus.calc import zonal_mean
+    >>> zonal_mean_cached = memoise()(zonal_mean)
+    >>> u_zm = zonal_mean_cached(cubelist.extract_cube("u"), model=lfric)
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, use_cache=True, **kwargs):
+            if not use_cache:
+                return func(*args, **kwargs)
+            fname = Path(cache_dir) / f"{cache_key(func, *args, **kwargs)}.nc"
+            attrs = _skipped_attrs(args, kwargs)
+            try:
+                result = _load_result(fname, attrs)
+            except (OSError, ValueError, KeyError):
+                pass
+            else:
+                # Mark as recently used
+                os.utime(fname)
+                logger.debug(f"Loaded {func.__name__} result from {fname}")
+                return result
+            result = func(*args, **kwargs)
+            if isinstance(result, iris.cube.Cube) or (
+                isinstance(result, iris.cube.CubeList) and len(result) > 0
+            ):
+                _save_result(result, fname)
+                evict(cache_dir, max_size)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+@memoise()
+def _derived_cubes(cubelist, const=None, model=um):
+    """Calculate cubes added by `aeolus.calc.calc_derived_cubes`."""
+    n_input = len(cubelist)
+    result = iris.cube.CubeList(cubelist)
+    calc_derived_cubes(result, const=const, model=model)
+    return iris.cube.CubeList(result[n_input:])
+
+
+def calc_derived_cubes_cached(cubelist, const=None, model=um, use_cache=True):
+    """
+    Calculate additional variables and append them to the cube list.
+
+    Same as `aeolus.calc.calc_derived_cubes`, but the results are cached.
+    """
+    cubelist.extend(
+        _derived_cubes(cubelist, const=const, model=model, use_cache=use_cache)
+    )
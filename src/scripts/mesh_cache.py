@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""Share UGRID meshes and vertical coordinates between LFRic cubes."""
+# Standard library
+from functools import lru_cache
+import json
+import os
+from pathlib import Path
+
+# External modules
+from aeolus.io import load_vert_lev
+import iris
+import numpy as np
+
+# Local modules
+from regrid_utils import mesh_fingerprint
+
+# Meshes with realised arrays shared by all cubes within a process
+_MESHES = {}
+# Mesh fingerprints of the files seen in this process
+_FILE_MESHES = {}
+
+
+def _file_key(filename, mesh_name):
+    """Identify a mesh in a file by the file's path and modification time."""
+    path = Path(filename).resolve()
+    return f"{path}:{path.stat().st_mtime_ns}:{mesh_name}"
+
+
+def load_mesh_index(fname):
+    """Load fingerprints of meshes in previously seen files."""
+    try:
+        with open(fname, "r") as fobj:
+            _FILE_MESHES.update(json.load(fobj))
+    except (OSError, ValueError):
+        pass
+
+
+def save_mesh_index(fname):
+    """Save fingerprints of meshes in all files seen so far."""
+    fname = Path(fname)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    # Keep entries added by other processes
+    index = {}
+    try:
+        with open(fname, "r") as fobj:
+            index.update(json.load(fobj))
+    except (OSError, ValueError):
+        pass
+    index.update(_FILE_MESHES)
+    fname_tmp = fname.with_name(f".{os.getpid()}.{fname.name}")
+    with open(fname_tmp, "w") as fobj:
+        json.dump(index, fobj)
+    os.replace(fname_tmp, fname)
+
+
+def _realise_mesh(mesh):
+    """Read all arrays of a mesh into memory."""
+    for coord in mesh.all_coords:
+        if coord is not None:
+            coord.points
+            coord.bounds
+    for conn in mesh.all_connectivities:
+        if conn is not None:
+            conn.indices
+
+
+def share_mesh(cube, field, filename):
+    """
+    Callback for `iris.load` replacing the mesh with a shared copy.
+
+    Meshes of all files are compared by their fingerprint, and cubes
+    on equal meshes get the same mesh object with arrays in memory.
+    This saves memory and avoids reading the mesh arrays again
+    whenever iris compares the meshes while merging and concatenating.
+    If the file's fingerprint is known from `load_mesh_index`,
+    its mesh arrays are not read at all.
+    """
+    mesh = cube.mesh
+    if mesh is None:
+        return cube
+    key = _file_key(filename, mesh.var_name)
+    if (fingerprint := _FILE_MESHES.get(key)) not in _MESHES:
+        _realise_mesh(mesh)
+        fingerprint = mesh_fingerprint(cube)
+        _FILE_MESHES[key] = fingerprint
+        _MESHES.setdefault(fingerprint, mesh)
+    shared = _MESHES[fingerprint]
+    if shared is not mesh:
+        mesh_dim = cube.mesh_dim()
+        location = cube.location
+        for coord in cube.coords(mesh_coords=True):
+            cube.remove_coord(coord)
+        for coord in shared.to_MeshCoords(location):
+            cube.add_aux_coord(coord, mesh_dim)
+    return cube
+
+
+@lru_cache
+def _height_coord(full, nlev, model_top_height=None, path_to_levels_file=None):
+    """Make a level height coordinate of full or half levels."""
+    if path_to_levels_file is not None:
+        points = load_vert_lev(
+            Path(path_to_levels_file), lev_type="theta" if full else "rho"
+        )
+    elif full:
+        points = np.linspace(0, model_top_height, nlev)
+    else:
+        points = np.linspace(0, model_top_height, nlev + 1)
+        points = 0.5 * (points[:-1] + points[1:])
+    coord = iris.coords.AuxCoord(
+        points,
+        long_name="level_height",
+        units="m",
+        attributes={"positive": "up"},
+    )
+    coord.guess_bounds()
+    return coord
+
+
+def add_height_coord(
+    cube, field, filename, model_top_height=None, path_to_levels_file=None
+):
+    """
+    Callback for `iris.load` adding a level height coordinate.
+
+    Same as `aeolus.lfric.add_equally_spaced_height_coord` if
+    `model_top_height` is given, or as `aeolus.lfric.add_um_height_coord`
+    if `path_to_levels_file` is given, but the coordinate is created once
+    per process and copied to each cube.
+
+    Examples
+    --------
+    >>> from functools import partial
+    >>> iris.load(
+        filename,
+        callback=partial(add_height_coord, model_top_height=32000)
+    )
+    """
+    lev_coords = [
+        i.name() for i in cube.dim_coords if i.name().endswith("_levels")
+    ]
+    if len(lev_coords) == 1:
+        lev_coord = cube.coord(lev_coords[0])
+        hgt_coord = _height_coord(
+            "full" in lev_coord.name().lower(),
+            lev_coord.shape[0],
+            model_top_height=model_top_height,
+            path_to_levels_file=path_to_levels_file,
+        )
+        cube.add_aux_coord(
+            hgt_coord.copy(), data_dims=cube.coord_dims(lev_coord)
+        )
+    return cube
@@ -32,6 +32,12 @@ results_proc_um = data / "proc" / "um"
 results_raw_lfric = data / "raw" / "lfric"
 results_proc_lfric = data / "proc" / "lfric"
 
+# Cached regridding weights
+regrid_weights = data / "regrid_weights"
+
+# Cached intermediate results
+cache = data / "cache"
+
 # Vertical levels
 # vert = data / "vert"
 vert = data_final / "vert"
@@ -3,6 +3,7 @@
 """Process LFRic output by interpolating selected fields to a common grid."""
 # Standard library
 import argparse
+from contextlib import ExitStack
 from functools import partial
 from pathlib import Path
 from time import time
@@ -11,22 +12,41 @@ import warnings
 # External libraries
 from aeolus.const import add_planet_conf_to_cubes, init_const
 from aeolus.coord import get_cube_rel_days
-from aeolus.io import save_cubelist, create_dummy_cube
+from aeolus.io import create_dummy_cube
 from aeolus.subset import unique_cubes
 from aeolus.log import create_logger
-from aeolus.lfric import (
-    add_equally_spaced_height_coord,
-    add_um_height_coord,
-    load_lfric_raw,
-    simple_regrid_lfric,
-)
 
 # Local modules
+from dask_utils import (
+    SCHEDULERS,
+    rechunk_cube,
+    setup_scheduler,
+    unique_cubes_lazy,
+)
+from lfric_chunks import (
+    chunk_day,
+    find_chunks,
+    load_field_pack,
+    load_lfric_fields,
+    load_partials,
+    partial_fname,
+    process_windows,
+    remove_partials,
+    split_into_windows,
+)
+from io_utils import CHUNK_LAYOUTS, save_output
+from catalogue import query_chunks
+from manifest import manifest_path, options_hash, replace_output
+from mesh_cache import add_height_coord
 import paths
+from profiling import PROFILER, stage
+from regrid_utils import regrid_lfric_cached
 
 # Global definitions and styles
 warnings.filterwarnings("ignore")
 SCRIPT = Path(__file__).name
+# Names of netCDF variables to regrid, unless `--varpack` is given
+VARPACK_FILE = paths.scripts / "varpack_lfric.json"
 
 
 def parse_args(args=None):
@@ -55,12 +75,44 @@ def parse_args(args=None):
         help="Cubed Sphere Mesh Number",
         default="C48",
     )
+    ap.add_argument(
+        "-s",
+        "--startday",
+        type=int,
+        default=None,
+        help="Load chunks starting on or after this day",
+    )
+    ap.add_argument(
+        "-e",
+        "--endday",
+        type=int,
+        default=None,
+        help="Load chunks starting on or before this day",
+    )
+    ap.add_argument(
+        "--catalogue",
+        type=str,
+        default=None,
+        help=(
+            "SQLite catalogue of raw files made by catalogue.py, to find"
+            " files without opening them (new files are added to it)"
+        ),
+    )
     ap.add_argument(
         "--ref_cube",
         type=str,
         default="air_potential_temperature",
         help="Reference cube, to which coordinates all data will be regridded",
     )
+    ap.add_argument(
+        "--varpack",
+        type=str,
+        default=VARPACK_FILE,
+        help=(
+            "JSON file with names of netCDF variables to regrid;"
+            " other variables are not read"
+        ),
+    )
     ap.add_argument(
         "--level_height",
         type=str,
@@ -73,15 +125,200 @@ def parse_args(args=None):
         default="uniform",
         help="If level_height=uniform,set the model top height.",
     )
+    ap.add_argument(
+        "--weights_dir",
+        type=str,
+        default=str(paths.regrid_weights),
+        help="Directory with cached regridding weights",
+    )
+    ap.add_argument(
+        "--mesh_index",
+        type=str,
+        default=None,
+        help=(
+            "JSON file with mesh fingerprints of raw files, so that"
+            " the mesh is read only once in each process"
+        ),
+    )
+    ap.add_argument(
+        "--window",
+        type=int,
+        default=None,
+        help=(
+            "Process this many restart chunks at a time and concatenate"
+            " the partial outputs at the end (all at once if not given)"
+        ),
+    )
+    ap.add_argument(
+        "--keep_partial",
+        action="store_true",
+        default=False,
+        help="Do NOT delete partial outputs after concatenating them",
+    )
+    ap.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to handle windows of chunks in parallel",
+    )
+    ap.add_argument(
+        "--incremental",
+        action="store_true",
+        default=False,
+        help=(
+            "Only process new or changed chunks and reuse partial outputs"
+            " listed in the manifest from previous runs"
+        ),
+    )
+    ap.add_argument(
+        "--lazy",
+        action="store_true",
+        default=False,
+        help=(
+            "Keep all data lazy until they are written, without comparing"
+            " data of duplicate fields"
+        ),
+    )
+    ap.add_argument(
+        "--time_chunk",
+        type=int,
+        default=None,
+        help="With --lazy, number of time steps in a dask chunk",
+    )
+    ap.add_argument(
+        "--level_chunk",
+        type=int,
+        default=None,
+        help="With --lazy, number of vertical levels in a dask chunk",
+    )
+    ap.add_argument(
+        "--scheduler",
+        type=str,
+        default=None,
+        choices=SCHEDULERS,
+        help=(
+            "Dask scheduler used to compute the data;"
+            " not compatible with --workers > 1"
+        ),
+    )
+    ap.add_argument(
+        "--dask_workers",
+        type=int,
+        default=None,
+        help="Number of threads, processes or workers of the dask scheduler",
+    )
+    ap.add_argument(
+        "--complevel",
+        type=int,
+        default=4,
+        help="Compression level of the output, from 0 (none) to 9",
+    )
+    ap.add_argument(
+        "--chunk_layout",
+        type=str,
+        default="slice",
+        choices=CHUNK_LAYOUTS,
+        help=(
+            "Chunk shape of the output: 'slice' for maps and cross-sections,"
+            " 'column' for vertical profiles and time series"
+        ),
+    )
+    ap.add_argument(
+        "--zarr",
+        action="store_true",
+        default=False,
+        help=(
+            "Write a Zarr store instead of a netCDF file"
+            " (for notebooks; not read by the other scripts)"
+        ),
+    )
+    ap.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help=(
+            "Directory to which a report on the time, memory and I/O"
+            " of each processing stage is written"
+        ),
+    )
+    ap.add_argument(
+        "--cprofile",
+        action="store_true",
+        default=False,
+        help="Also save cProfile statistics to the --profile directory",
+    )
     return ap.parse_args(args)
 
 
+def process_files(
+    fnames,
+    add_levs,
+    ref_cube,
+    weights_dir,
+    fields,
+    mesh_index=None,
+    lazy=False,
+    time_chunk=None,
+    level_chunk=None,
+):
+    """
+    Load LFRic files and regrid the selected fields to a common grid.
+
+    Only the netCDF variables listed in `fields` are read from the files.
+
+    If `lazy` is True, the result has lazy data chunked along time
+    and vertical levels, and nothing is computed until it is saved.
+    """
+    with stage("load"):
+        cl_raw = load_lfric_fields(
+            fnames,
+            fields=fields,
+            callback=add_levs,
+            mesh_index=mesh_index,
+            drop_coord=["forecast_reference_time"],
+        )
+    if len(cl_raw) == 0:
+        return cl_raw
+    # L.info(f"{cl_raw=}")
+    with stage("extract"):
+        cubes_to_regrid = cl_raw.extract(fields)
+        if lazy:
+            cubes_to_regrid = unique_cubes_lazy(cubes_to_regrid)
+            for cube in cubes_to_regrid:
+                rechunk_cube(
+                    cube, time_chunk=time_chunk, level_chunk=level_chunk
+                )
+        else:
+            cubes_to_regrid = unique_cubes(cubes_to_regrid)
+        if len(w_cubes := cubes_to_regrid.extract("w_in_wth")) == 2:
+            cubes_to_regrid.remove(w_cubes[-1])
+        for cube in cubes_to_regrid:
+            if cube.units == "ms-1":
+                cube.units = "m s-1"
+    # L.info(f"{cubes_to_regrid=}")
+    with stage("regrid"):
+        # Create a dummy cube with a target grid
+        tgt_cube = create_dummy_cube(nlat=90, nlon=144, pm180=True)
+        # Regrid all cubes reusing the weights for this mesh and grid
+        cl_proc = regrid_lfric_cached(
+            cubes_to_regrid,
+            tgt_cube=tgt_cube,
+            ref_cube_constr=ref_cube,
+            cache_dir=weights_dir,
+        )
+    return cl_proc
+
+
 def main(args=None):
     """Main entry point of the script."""
     t0 = time()
     L = create_logger(Path(__file__))
     # Parse command-line arguments
     args = parse_args(args)
+    PROFILER.start(
+        track_memory=args.profile is not None,
+        cprofile=(args.profile is not None) and args.cprofile,
+    )
     planet = args.planet
     L.info(f"{planet=}")
 
@@ -93,12 +330,10 @@ def main(args=None):
 
     # Height coordinate
     if args.level_height == "uniform":
-        add_levs = partial(
-            add_equally_spaced_height_coord, model_top_height=args.model_top
-        )
+        add_levs = partial(add_height_coord, model_top_height=args.model_top)
     elif args.level_height == "um_L38_29t_9s_40km":
         add_levs = partial(
-            add_um_height_coord,
+            add_height_coord,
             path_to_levels_file=paths.vert / "vertlevs_L38_29t_9s_40km",
         )
     else:
@@ -114,88 +349,125 @@ def main(args=None):
     # outdir = mypaths.sadir / label / "_processed"
     outdir.mkdir(parents=True, exist_ok=True)
 
-    # Make a list of files matching the file mask and the start day threshold
-    fnames = sorted(
-        inpdir.glob(f"*/*{c_num}*/lfric_diag.nc"),
-        key=lambda x: int(x.parent.parent.name),
-    )
+    # Names of netCDF variables to regrid
+    fields = load_field_pack(args.varpack)["regrid"]
+    # Make a list of files matching the file mask and the range of days
+    with stage("find_files"):
+        if args.catalogue is None:
+            fnames = find_chunks(
+                inpdir, c_num, startday=args.startday, endday=args.endday
+            )
+        else:
+            fnames = query_chunks(
+                args.catalogue,
+                inpdir,
+                c_num,
+                startday=args.startday,
+                endday=args.endday,
+                fields=fields,
+                L=L,
+            )
     if len(fnames) == 0:
         L.critical("No files found!")
         return
     L.info(f"fnames({len(fnames)}) = {fnames[0]} ... {fnames[-1]}")
 
-    cl_raw = load_lfric_raw(
-        fnames,
-        callback=add_levs,
-        drop_coord=["forecast_reference_time"],
-    )
-    if len(cl_raw) == 0:
-        L.critical("Files are empty!")
-        return
-    # L.info(f"{cl_raw=}")
-    cubes_to_regrid = cl_raw.extract(
-        [
-            # "rho",
-            # "exner",
-            # "exner_in_wth",
-            "cloud_amount_maxrnd",
-            "divergence",
-            "grid_surface_temperature",
-            "lw_down_surf",
-            "lw_up_surf",
-            "lw_up_toa",
-            "lw_up_clear_toa_rts",
-            "pressure_in_wth",
-            "sw_direct_toa",
-            "sw_down_surf",
-            "sw_up_surf",
-            "sw_up_toa",
-            "sw_up_clear_toa_rts",
-            "temperature",
-            "theta",
-            "tot_col_int_energy",
-            "tot_col_dry_air_mass",
-            "tot_col_pot_energy",
-            "tot_col_m_ci",
-            "tot_col_m_cl",
-            "tot_col_m_v",
-            "u_in_w3",
-            "v_in_w3",
-            "w_in_wth"
-            # "u_in_w2h",
-            # "v_in_w2h",
-        ]
-    )
-    cubes_to_regrid = unique_cubes(cubes_to_regrid)
-    if len(w_cubes := cubes_to_regrid.extract("w_in_wth")) == 2:
-        cubes_to_regrid.remove(w_cubes[-1])
-    for cube in cubes_to_regrid:
-        if cube.units == "ms-1":
-            cube.units = "m s-1"
-    # L.info(f"{cubes_to_regrid=}")
-    # Create a dummy cube with a target grid
-    tgt_cube = create_dummy_cube(nlat=90, nlon=144, pm180=True)
-    # Regrid all cubes
-    cl_proc = simple_regrid_lfric(
-        cubes_to_regrid, tgt_cube=tgt_cube, ref_cube_constr=args.ref_cube
-    )
-    const = init_const(planet, directory=paths.const)
-    add_planet_conf_to_cubes(cl_proc, const=const)
-
-    time_prof = "inst"
-    # Write the data to a netCDF file
     gl_attrs = {
         "name": label,
         "planet": planet,
         "processed": "True",
     }
-    days = 0 + get_cube_rel_days(cl_proc[0]).astype(int)
-    day_str = f"days{days[0]}"
-    if len(days) > 1:
-        day_str += f"_{days[-1]}"
-    fname_out = outdir / f"{label}_{time_prof}_{day_str}_regr.nc"
-    save_cubelist(cl_proc, fname_out, **gl_attrs)
-    L.success(f"Saved to {fname_out}")
+    kw_proc = {
+        "add_levs": add_levs,
+        "mesh_index": args.mesh_index,
+        "ref_cube": args.ref_cube,
+        "weights_dir": args.weights_dir,
+        "fields": fields,
+        "lazy": args.lazy,
+        "time_chunk": args.time_chunk,
+        "level_chunk": args.level_chunk,
+    }
+    if (args.scheduler is not None) and (args.workers > 1):
+        # Worker processes always use the synchronous scheduler
+        raise ValueError("--scheduler cannot be used with --workers > 1.")
+    # Process all files at once or in windows of restart chunks
+    if (args.workers > 1 or args.incremental) and (args.window is None):
+        # Give each worker one chunk at a time
+        args.window = 1
+    windows = split_into_windows(fnames, args.window)
+    if args.incremental:
+        manifest_file = manifest_path(outdir, label, "regr")
+        # Options that affect the partial outputs
+        options = options_hash(
+            {
+                "level_height": args.level_height,
+                "model_top": args.model_top,
+                "ref_cube": args.ref_cube,
+                "fields": fields,
+                "time_chunk": args.time_chunk,
+                "level_chunk": args.level_chunk,
+            }
+        )
+    else:
+        manifest_file = None
+        options = None
+    streaming = (len(windows) > 1) or args.incremental
+    with ExitStack() as stack:
+        if args.scheduler is not None:
+            # Compute the data with the given dask scheduler
+            client = setup_scheduler(args.scheduler, workers=args.dask_workers)
+            if client is not None:
+                # Shut down the local cluster after saving the data
+                stack.enter_context(client.cluster)
+                stack.enter_context(client)
+        if not streaming:
+            cl_proc = process_files(fnames, **kw_proc)
+        else:
+            fnames_part = process_windows(
+                partial(process_files, **kw_proc),
+                windows,
+                [partial_fname(outdir, label, i, "regr") for i in windows],
+                gl_attrs,
+                workers=args.workers,
+                manifest_file=manifest_file,
+                options=options,
+            )
+            # Concatenate the partial outputs lazily
+            with stage("load_partials"):
+                cl_proc = load_partials(fnames_part)
+        if len(cl_proc) == 0:
+            L.critical("Files are empty!")
+            return
+        const = init_const(planet, directory=paths.const)
+        add_planet_conf_to_cubes(cl_proc, const=const)
+
+        time_prof = "inst"
+        # Write the data to a netCDF file
+        if args.startday is None:
+            day0 = 0
+        else:
+            # Count days from the start of the first selected chunk
+            day0 = chunk_day(fnames[0])
+        days = day0 + get_cube_rel_days(cl_proc[0]).astype(int)
+        day_str = f"days{days[0]}"
+        if len(days) > 1:
+            day_str += f"_{days[-1]}"
+        fname_out = outdir / f"{label}_{time_prof}_{day_str}_regr.nc"
+        with stage("save"):
+            fname_out = save_output(
+                cl_proc,
+                fname_out,
+                layout=args.chunk_layout,
+                complevel=args.complevel,
+                zarr=args.zarr,
+                **gl_attrs,
+            )
+        L.success(f"Saved to {fname_out}")
+    if manifest_file is not None:
+        replace_output(manifest_file, fname_out)
+    elif streaming and not args.keep_partial:
+        remove_partials(fnames_part)
+    PROFILER.finish(args.profile, f"{Path(__file__).stem}_{label}", L=L)
     L.info(f"Execution time: {time() - t0:.1f}s")
 
 
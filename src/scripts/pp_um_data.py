@@ -3,20 +3,30 @@
 """Process global UM output by interpolating selected fields to common grid."""
 # Standard library
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import json
 from pathlib import Path
+import re
 from time import time
 import warnings
 
 # External libraries
 from aeolus.const import add_planet_conf_to_cubes, init_const
 from aeolus.coord import get_cube_rel_days
-from aeolus.io import load_data, save_cubelist, get_filename_list
+from aeolus.io import get_filename_list
 from aeolus.model import um
 from aeolus.log import create_logger
 from aeolus.proc_um_output import process_cubes
+import iris
+from iris.fileformats.pp import STASH
 
 # Local modules
+from lfric_chunks import load_partials, process_windows, remove_partials
+from io_utils import CHUNK_LAYOUTS, save_output
+from manifest import manifest_path, options_hash, replace_output
 import paths
+from profiling import PROFILER, WorkerTask, gather, stage
 
 # Global definitions and styles
 warnings.filterwarnings("ignore")
@@ -28,6 +38,8 @@ GLM_RUNID = "atmosa"
 # GLM_RUNID = r"[atmosa,umglaa]"
 # GLM_RUNID = "umglaa"
 GLM_START_DAY = 0
+# STASH codes of the fields to keep if `--use_varpack` is given
+VARPACK_FILE = paths.scripts / "varpack_um.json"
 
 
 def parse_args(args=None):
@@ -80,7 +92,7 @@ def parse_args(args=None):
         "--letter",
         type=str,
         default="a,b,c,d,e,f,g",
-        help="Letter(s) to identify files.",
+        help="Letter(s) to identify files, e.g. 'abc' or 'a-g'.",
     )
     ap.add_argument(
         "--ref_cube",
@@ -122,18 +134,251 @@ def parse_args(args=None):
         "--use_varpack",
         action="store_true",
         default=False,
-        help="Include only the variables from the `varpack`",
+        help=(
+            "Load only the variables from the `--varpack` file"
+            " and the streams containing them"
+        ),
+    )
+    ap.add_argument(
+        "--varpack",
+        type=str,
+        default=VARPACK_FILE,
+        help="JSON file with STASH codes of multi- and single-level fields",
+    )
+    ap.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to load files or timestamps in parallel",
+    )
+    ap.add_argument(
+        "--per_timestamp",
+        action="store_true",
+        default=False,
+        help=(
+            "Process the files of each timestamp separately, in parallel"
+            " if --workers > 1, and concatenate the partial outputs"
+        ),
+    )
+    ap.add_argument(
+        "--keep_partial",
+        action="store_true",
+        default=False,
+        help="Do NOT delete partial outputs after concatenating them",
+    )
+    ap.add_argument(
+        "--incremental",
+        action="store_true",
+        default=False,
+        help=(
+            "Only process files with new or changed timestamps and reuse"
+            " partial outputs listed in the manifest from previous runs"
+        ),
     )
 
+    ap.add_argument(
+        "--complevel",
+        type=int,
+        default=4,
+        help="Compression level of the output, from 0 (none) to 9",
+    )
+    ap.add_argument(
+        "--chunk_layout",
+        type=str,
+        default="slice",
+        choices=CHUNK_LAYOUTS,
+        help=(
+            "Chunk shape of the output: 'slice' for maps and cross-sections,"
+            " 'column' for vertical profiles and time series"
+        ),
+    )
+    ap.add_argument(
+        "--zarr",
+        action="store_true",
+        default=False,
+        help=(
+            "Write a Zarr store instead of a netCDF file"
+            " (for notebooks; not read by the other scripts)"
+        ),
+    )
+    ap.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help=(
+            "Directory to which a report on the time, memory and I/O"
+            " of each processing stage is written"
+        ),
+    )
+    ap.add_argument(
+        "--cprofile",
+        action="store_true",
+        default=False,
+        help="Also save cProfile statistics to the --profile directory",
+    )
     return ap.parse_args(args)
 
 
+def load_varpack(fname):
+    """Load STASH codes of multi-level and single-level fields to keep."""
+    with open(fname, "r") as fobj:
+        return json.load(fobj)
+
+
+def _is_increment(stash):
+    """Check if a STASH code is of a temperature or humidity increment."""
+    # Called with strings when filtering fields and STASH objects for cubes
+    stash = STASH.from_msi(str(stash))
+    return (stash.item in [181, 182, 233]) and (stash.section not in [0])
+
+
+def stash_constraints(varpack, extract_incr=True):
+    """
+    Make constraints selecting fields by their STASH codes.
+
+    When passed to `iris.load`, fields of other variables in PP files
+    and fieldsfiles are skipped before they are converted to cubes.
+    """
+    constraints = [
+        iris.AttributeConstraint(STASH=stash)
+        for key in ("multi_level", "single_level")
+        for stash in varpack[key]
+    ]
+    if extract_incr:
+        constraints.append(iris.AttributeConstraint(STASH=_is_increment))
+    return constraints
+
+
+def _stash_codes(fname):
+    """Read STASH codes of all fields in a file without reading the data."""
+    with open(fname, "rb") as fh:
+        spec = iris.fileformats.FORMAT_AGENT.get_spec(Path(fname).name, fh)
+    if "(PP)" in spec.name:
+        fields = iris.fileformats.pp.load(fname, read_data=False)
+    else:
+        fields = iris.fileformats.um.um_to_pp(fname, read_data=False)
+    return {str(field.stash) for field in fields}
+
+
+def expand_letters(letter):
+    """
+    Get a list of stream letters from a string such as "a-dmz".
+
+    Ranges are expanded as in a regular expression character class.
+    """
+    result = []
+    i = 0
+    while i < len(letter):
+        if i + 2 < len(letter) and letter[i + 1] == "-":
+            first, last = letter[i], letter[i + 2]
+            if first > last:
+                raise ValueError(f"Invalid range of letters: {first}-{last}")
+            result.extend(chr(j) for j in range(ord(first), ord(last) + 1))
+            i += 3
+        else:
+            result.append(letter[i])
+            i += 1
+    invalid = [i for i in result if not i.isalnum()]
+    if invalid:
+        raise ValueError(f"Invalid stream letters: {invalid}")
+    return list(dict.fromkeys(result))
+
+
+def select_streams(inpdir, letters, varpack, extract_incr=True):
+    """
+    Find output streams with any of the fields in the variable pack.
+
+    The streams are identified by the letter after "p" in the file names.
+    Only the first file of each stream is inspected.
+    """
+    wanted = {*varpack["multi_level"], *varpack["single_level"]}
+    result = []
+    for letter in letters:
+        fnames = sorted(Path(inpdir).glob(f"{GLM_RUNID}.p{letter}*"))
+        if len(fnames) == 0:
+            continue
+        codes = _stash_codes(fnames[0])
+        if (codes & wanted) or (
+            extract_incr and any(_is_increment(i) for i in codes)
+        ):
+            result.append(letter)
+    return result
+
+
+def load_um(fnames, constraints=None):
+    """Load UM files, decoding only the fields matching `constraints`."""
+    with iris.FUTURE.context(datum_support=True):
+        return iris.load([str(i) for i in fnames], constraints)
+
+
+def load_files_parallel(fnames, workers, constraints=None):
+    """
+    Load UM files in worker processes and combine the cubes.
+
+    Each file is loaded separately, so that their PP headers are decoded
+    in parallel. The cubes stay lazy and are merged and concatenated
+    in the parent process, as `iris.load` would do.
+    """
+    func = WorkerTask(partial(load_um, constraints=constraints))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        cl_raw = iris.cube.CubeList(
+            cube
+            for cubelist in gather(executor.map(func, [[i] for i in fnames]))
+            for cube in cubelist
+        )
+    return cl_raw.merge().concatenate()
+
+
+def process_files(fnames, args, workers=1):
+    """Load UM files and process the cubes."""
+    if args.use_varpack:
+        varpack = load_varpack(args.varpack)
+        # Skip other variables already when reading the files
+        constraints = stash_constraints(
+            varpack, extract_incr=(not args.no_extract_incr)
+        )
+        varpack = {
+            key: [iris.AttributeConstraint(STASH=i) for i in codes]
+            for key, codes in varpack.items()
+        }
+    else:
+        varpack = None
+        constraints = None
+    with stage("load"):
+        if workers > 1:
+            cl_raw = load_files_parallel(fnames, workers, constraints)
+        else:
+            cl_raw = load_um(fnames, constraints)
+    if len(cl_raw) == 0:
+        return cl_raw
+    # Regrid & interpolate data
+    with stage("process_cubes"):
+        cl_proc = process_cubes(
+            cl_raw,
+            timestep=args.timestep,
+            ref_cube_constr=args.ref_cube,
+            extract_incr=(not args.no_extract_incr),
+            extract_mean=(not args.extract_inst),
+            regrid_multi_lev=(not args.no_regrid_multi_lev),
+            roll_pm180=(not args.no_roll_cube_pm180),
+            add_calendar=args.add_calendar,
+            planet=args.planet,
+            use_varpack=args.use_varpack,
+            varpack=varpack,
+        )
+    return cl_proc
+
+
 def main(args=None):
     """Main entry point of the script."""
     t0 = time()
     L = create_logger(Path(__file__))
     # Parse command-line arguments
     args = parse_args(args)
+    PROFILER.start(
+        track_memory=args.profile is not None,
+        cprofile=(args.profile is not None) and args.cprofile,
+    )
     planet = args.planet
     L.info(f"{planet=}")
 
@@ -150,65 +395,126 @@ def main(args=None):
     # outdir = mypaths.sadir / label / "_processed"
     outdir.mkdir(parents=True, exist_ok=True)
 
+    letters = expand_letters(args.letter)
+    if args.use_varpack:
+        # Read only the streams with the requested variables
+        with stage("select_streams"):
+            letters = select_streams(
+                inpdir,
+                letters,
+                load_varpack(args.varpack),
+                extract_incr=(not args.no_extract_incr),
+            )
+        L.info(f"Streams with the variables from {args.varpack}: {letters}")
+        if len(letters) == 0:
+            L.critical("No files with the requested variables found!")
+            return
     # Make a list of files matching the file mask and the start day threshold
-    regex = GLM_RUNID + r".p" + r"[{}]".format(args.letter) + DEFAULT_REGEX
-    L.info(regex)
-    fnames = get_filename_list(
-        inpdir,
-        ts_start=args.startday,
-        ts_end=args.endday,
-        every=1,
-        regex=regex,
-        glob_pattern=f"{GLM_RUNID}*",
+    regex = (
+        GLM_RUNID + r".p" + r"[{}]".format("".join(letters)) + DEFAULT_REGEX
     )
+    L.info(regex)
+    with stage("find_files"):
+        fnames = get_filename_list(
+            inpdir,
+            ts_start=args.startday,
+            ts_end=args.endday,
+            every=1,
+            regex=regex,
+            glob_pattern=f"{GLM_RUNID}*",
+        )
     if len(fnames) == 0:
         L.critical("No files found!")
         return
     L.info(f"fnames({len(fnames)}) = {fnames[0]} ... {fnames[-1]}")
 
-    cl_raw = load_data(fnames)
-    if len(cl_raw) == 0:
-        L.critical("Files are empty!")
-        return
-
-    # L.info(f"{cl_raw=}")
-
     timestep = args.timestep
 
-    # Regrid & interpolate data
-    cl_proc = process_cubes(
-        cl_raw,
-        timestep=timestep,
-        ref_cube_constr=args.ref_cube,
-        extract_incr=(not args.no_extract_incr),
-        extract_mean=(not args.extract_inst),
-        regrid_multi_lev=(not args.no_regrid_multi_lev),
-        roll_pm180=(not args.no_roll_cube_pm180),
-        add_calendar=args.add_calendar,
-        planet=planet,
-        use_varpack=args.use_varpack,
-    )
-    const = init_const(planet, directory=paths.const)
-    add_planet_conf_to_cubes(cl_proc, const=const)
-
     if args.extract_inst:
         time_prof = "inst"
     else:
         time_prof = "mean"
-    # Write the data to a netCDF file
     gl_attrs = {
         "name": label,
         "planet": planet,
         "timestep": timestep,
         "processed": "True",
     }
+    streaming = args.incremental or args.per_timestamp
+    if streaming:
+        # Process files in windows of the same timestamp
+        if args.incremental:
+            manifest_file = manifest_path(outdir, label, f"{time_prof}_regr")
+            # Options that affect the partial outputs
+            options = options_hash(
+                {
+                    "timestep": args.timestep,
+                    "ref_cube": args.ref_cube,
+                    "no_extract_incr": args.no_extract_incr,
+                    "extract_inst": args.extract_inst,
+                    "no_regrid_multi_lev": args.no_regrid_multi_lev,
+                    "no_roll_cube_pm180": args.no_roll_cube_pm180,
+                    "add_calendar": args.add_calendar,
+                    "use_varpack": args.use_varpack,
+                    "per_timestamp": args.per_timestamp,
+                },
+                files=[args.varpack] if args.use_varpack else [],
+            )
+        else:
+            manifest_file = None
+            options = None
+        windows = {}
+        for fname in fnames:
+            tstamp = re.match(regex, fname.name)["timestamp"]
+            windows.setdefault(tstamp, []).append(fname)
+        fnames_part = process_windows(
+            partial(process_files, args=args),
+            [*windows.values()],
+            [
+                outdir
+                / f"_{label}_partial"
+                / f"{label}_{time_prof}_ts{tstamp}_regr.nc"
+                for tstamp in windows
+            ],
+            gl_attrs,
+            workers=args.workers,
+            manifest_file=manifest_file,
+            options=options,
+        )
+        # Concatenate the partial outputs lazily
+        with stage("load_partials"):
+            cl_proc = load_partials(fnames_part)
+    else:
+        manifest_file = None
+        cl_proc = process_files(fnames, args, workers=args.workers)
+    if len(cl_proc) == 0:
+        L.critical("Files are empty!")
+        return
+
+    const = init_const(planet, directory=paths.const)
+    add_planet_conf_to_cubes(cl_proc, const=const)
+
+    # Write the data to a netCDF file
     days = args.startday + get_cube_rel_days(cl_proc[0]).astype(int)
     day_str = f"days{days[0]}"
     if len(days) > 1:
         day_str += f"_{days[-1]}"
     fname_out = outdir / f"{label}_{time_prof}_{day_str}_regr.nc"
-    save_cubelist(cl_proc, fname_out, **gl_attrs)
+    with stage("save"):
+        fname_out = save_output(
+            cl_proc,
+            fname_out,
+            layout=args.chunk_layout,
+            complevel=args.complevel,
+            zarr=args.zarr,
+            **gl_attrs,
+        )
     L.success(f"Saved to {fname_out}")
+    if manifest_file is not None:
+        replace_output(manifest_file, fname_out)
+    elif streaming and not args.keep_partial:
+        remove_partials(fnames_part)
+    PROFILER.finish(args.profile, f"{Path(__file__).stem}_{label}", L=L)
     L.info(f"Execution time: {time() - t0:.1f}s")
 
 
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""Record time, memory and I/O of the processing stages of a script."""
+# Standard library
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime, timezone
+from functools import wraps
+import json
+import os
+from pathlib import Path
+import platform
+from time import perf_counter
+import tracemalloc
+
+# External modules
+from loguru import logger
+
+
+def io_counters():
+    """
+    Get the number of bytes read and written by this process so far.
+
+    Counts all read and write system calls, including those served
+    from the page cache. Returns zeros if `/proc/self/io` is unavailable.
+    """
+    counters = {"rchar": 0, "wchar": 0}
+    try:
+        with open("/proc/self/io", "r") as fobj:
+            for line in fobj:
+                key, value = line.split(":")
+                if key in counters:
+                    counters[key] = int(value)
+    except OSError:
+        pass
+    return counters["rchar"], counters["wchar"]
+
+
+class Profiler:
+    """
+    Collect measurements of named stages of a run.
+
+    Each stage records its wall time and the bytes read and written.
+    Peak traced memory is recorded only if memory tracking is started,
+    since `tracemalloc` slows down code creating many Python objects.
+    Stages can be nested.
+
+    Examples
+    --------
+    >>> with PROFILER.stage("load"):
+    ...     cl_raw = load_data(fnames)
+    """
+
+    def __init__(self):
+        self.records = []
+        self._stack = []
+        self._cprofile = None
+        self.start_time = perf_counter()
+
+    def start(self, track_memory=False, cprofile=False):
+        """Start tracking memory and the cProfile profiler if requested."""
+        # Forget the stages of previous runs in the same process
+        self.records = []
+        self._stack = []
+        self.start_time = perf_counter()
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if cprofile:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    @contextmanager
+    def stage(self, name):
+        """Measure a stage of the run."""
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            # Remember the peak of the enclosing stage before resetting it
+            if self._stack:
+                peak = tracemalloc.get_traced_memory()[1]
+                self._stack[-1] = max(self._stack[-1], peak)
+            self._stack.append(0)
+            tracemalloc.reset_peak()
+        read0, written0 = io_counters()
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            wall_time = perf_counter() - t0
+            read1, written1 = io_counters()
+            record = {
+                "stage": name,
+                "pid": os.getpid(),
+                "wall_time": wall_time,
+                "bytes_read": read1 - read0,
+                "bytes_written": written1 - written0,
+                "peak_mem": None,
+            }
+            if tracing:
+                peak = max(
+                    tracemalloc.get_traced_memory()[1], self._stack.pop()
+                )
+                if self._stack:
+                    self._stack[-1] = max(self._stack[-1], peak)
+                record["peak_mem"] = peak
+            self.records.append(record)
+
+    def profiled(self, name=None):
+        """Decorate a function to measure each of its calls as a stage."""
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name or func.__name__):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def collect(self):
+        """Remove and return the records, e.g. to send them from a worker."""
+        records, self.records = self.records, []
+        return records
+
+    def extend(self, records):
+        """Add records collected elsewhere, e.g. in a worker process."""
+        self.records.extend(records)
+
+    def summary(self):
+        """
+        Aggregate the records by stage name.
+
+        Returns
+        -------
+        dict
+            Number of calls, total wall time, total bytes read and written,
+            and maximum peak memory of each stage in the order of first use.
+        """
+        result = {}
+        for record in self.records:
+            stage = result.setdefault(
+                record["stage"],
+                {
+                    "calls": 0,
+                    "wall_time": 0.0,
+                    "bytes_read": 0,
+                    "bytes_written": 0,
+                    "peak_mem": None,
+                },
+            )
+            stage["calls"] += 1
+            for key in ("wall_time", "bytes_read", "bytes_written"):
+                stage[key] += record[key]
+            if record["peak_mem"] is not None:
+                stage["peak_mem"] = max(
+                    stage["peak_mem"] or 0, record["peak_mem"]
+                )
+        return result
+
+    def log_summary(self, L=logger):
+        """Log a table of time, I/O and memory use of each stage."""
+        total = perf_counter() - self.start_time
+        L.info(
+            f"{'Stage':<24} {'Calls':>5} {'Time, s':>9} {'%':>5}"
+            f" {'Read, MiB':>10} {'Written, MiB':>12} {'Peak, MiB':>10}"
+        )
+        for name, stage in self.summary().items():
+            if stage["peak_mem"] is None:
+                peak = "-"
+            else:
+                peak = f"{stage['peak_mem'] / 2**20:.1f}"
+            L.info(
+                f"{name:<24} {stage['calls']:>5} {stage['wall_time']:>9.2f}"
+                f" {100 * stage['wall_time'] / total:>5.1f}"
+                f" {stage['bytes_read'] / 2**20:>10.1f}"
+                f" {stage['bytes_written'] / 2**20:>12.1f} {peak:>10}"
+            )
+
+    def write_report(self, outdir, label):
+        """
+        Write the records to a JSON file and the cProfile statistics if any.
+
+        Returns
+        -------
+        pathlib.Path
+            Path to the JSON report.
+        """
+        outdir = Path(outdir)
+        outdir.mkdir(parents=True, exist_ok=True)
+        stem = f"{label}_{datetime.now(timezone.utc):%Y%m%d_%H%M%S}"
+        report = {
+            "label": label,
+            "date": f"{datetime.now(timezone.utc):%Y-%m-%d %H:%M:%S}",
+            "host": platform.node(),
+            "total_wall_time": perf_counter() - self.start_time,
+            "summary": self.summary(),
+            "records": self.records,
+        }
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            fname_prof = outdir / f"{stem}.prof"
+            self._cprofile.dump_stats(fname_prof)
+            report["cprofile"] = str(fname_prof)
+        fname = outdir / f"{stem}_profile.json"
+        with open(fname, "w") as fobj:
+            json.dump(report, fobj, indent=2)
+        return fname
+
+    def finish(self, outdir, label, L=logger):
+        """Log the summary and write the report if `outdir` is given."""
+        self.log_summary(L)
+        if outdir is not None:
+            fname = self.write_report(outdir, label)
+            L.info(f"Saved profile to {fname}")
+
+
+class WorkerTask:
+    """
+    Wrap a function run in worker processes to send back its measurements.
+
+    Calling the wrapper returns the function's result and the records
+    of the stages measured during the call. Pass them to `gather`
+    in the parent process.
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args, **kwargs):
+        # Drop records inherited from the parent or sent back already
+        PROFILER.collect()
+        result = self.func(*args, **kwargs)
+        return result, PROFILER.collect()
+
+
+def gather(results):
+    """Unpack results of `WorkerTask` calls and keep their records."""
+    for result, records in results:
+        PROFILER.extend(records)
+        yield result
+
+
+# Profiler shared by all modules within a process
+PROFILER = Profiler()
+stage = PROFILER.stage
+profiled = PROFILER.profiled
@@ -0,0 +1,564 @@
+# -*- coding: utf-8 -*-
+"""Regridding of LFRic data with reusable weights."""
+# Standard library
+import os
+from pathlib import Path
+
+# External modules
+from aeolus.lfric import replace_level_coord_with_height
+from aeolus.model import lfric
+import dask.array as da
+import iris
+from iris.analysis.cartography import get_xy_grids
+from loguru import logger
+import numpy as np
+import scipy.sparse
+from scipy.spatial import Delaunay, cKDTree
+import xxhash
+
+
+# In-memory cache of regridders shared by all calls within a process
+_REGRIDDERS = {}
+# In-memory cache of sparse regridding operators
+_WEIGHTS = {}
+# Rounding error allowed in the fraction of masked data
+MDTOL_EPS = 1e-8
+
+
+def _hash_arrays(*arrays):
+    """Calculate a short hex digest of several numpy arrays."""
+    h = xxhash.xxh3_64()
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        h.update(str((arr.dtype, arr.shape)).encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def mesh_fingerprint(cube, location="face"):
+    """
+    Get a string uniquely identifying the UGRID mesh of a cube.
+
+    The fingerprint consists of the cubed sphere C-number followed by
+    a hash of the node coordinates and the face-node connectivity.
+    """
+    mesh = cube.mesh
+    node_x, node_y = mesh.node_coords
+    conn = mesh.face_node_connectivity
+    c_num = int(round((conn.shape[conn.location_axis] / 6) ** 0.5))
+    digest = _hash_arrays(
+        node_x.points, node_y.points, conn.indices_by_location()
+    )
+    return f"C{c_num}_{location}_{digest}"
+
+
+def grid_fingerprint(cube, model=lfric):
+    """Get a string uniquely identifying a lat-lon grid."""
+    lons = cube.coord(model.x)
+    lats = cube.coord(model.y)
+    return f"{lats.shape[0]}x{lons.shape[0]}_" + _hash_arrays(
+        lats.points, lats.bounds, lons.points, lons.bounds
+    )
+
+
+def get_mesh_to_grid_regridder(
+    src_cube, tgt_cube, method="conservative", cache_dir=None, model=lfric
+):
+    """
+    Create or reuse a regridder from a UGRID cube to a lat-lon grid.
+
+    Regridders are cached in memory. If `cache_dir` is given, the weights
+    are also stored there as sparse matrices and reused by other runs
+    and experiments with the same mesh, target grid and method.
+
+    Parameters
+    ----------
+    src_cube: iris.cube.Cube
+        Cube on the source mesh.
+    tgt_cube: iris.cube.Cube
+        Cube on the target lat-lon grid.
+    method: str, optional
+        Regridding method passed to `MeshToGridESMFRegridder`.
+    cache_dir: pathlib.Path, optional
+        Directory with cached regridding weights.
+    model: aeolus.model.Model, optional
+        Model class with relevant coordinate names.
+
+    Returns
+    -------
+    esmf_regrid.experimental.unstructured_scheme.MeshToGridESMFRegridder
+    """
+    from esmf_regrid.experimental.unstructured_scheme import (
+        MeshToGridESMFRegridder,
+    )
+
+    key = (
+        f"{mesh_fingerprint(src_cube, location=src_cube.location)}"
+        f"__{grid_fingerprint(tgt_cube, model=model)}__{method}"
+    )
+    try:
+        return _REGRIDDERS[key]
+    except KeyError:
+        pass
+
+    weights = None
+    if cache_dir is not None:
+        fname = Path(cache_dir) / f"{key}.npz"
+        if fname.exists():
+            logger.info(f"Loading regridding weights from {fname}")
+            weights = scipy.sparse.load_npz(fname)
+    regridder = MeshToGridESMFRegridder(
+        src_cube, tgt_cube, method=method, precomputed_weights=weights
+    )
+    if (cache_dir is not None) and (weights is None):
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, in case other processes
+        # are creating the same weights at the same time
+        fname_tmp = fname.with_suffix(f".{os.getpid()}.npz")
+        scipy.sparse.save_npz(
+            fname_tmp,
+            scipy.sparse.csr_matrix(regridder.regridder.weight_matrix),
+        )
+        os.replace(fname_tmp, fname)
+        logger.info(f"Saved regridding weights to {fname}")
+    _REGRIDDERS[key] = regridder
+    return regridder
+
+
+def _esmf_to_grid_order(weights, tgt_shape):
+    """Reorder rows of ESMF weights from Fortran to C order of the grid."""
+    perm = np.arange(np.prod(tgt_shape)).reshape(tgt_shape, order="F")
+    return scipy.sparse.csr_matrix(weights)[perm.ravel()]
+
+
+def _triangulation_weights(src_cube, tgt_cube):
+    """
+    Make linear interpolation weights from a Delaunay triangulation.
+
+    Same as `scipy.interpolate.griddata` with the linear method in the
+    lon-lat plane, filling points outside the triangulation with the
+    nearest neighbour, as in `aeolus.lfric.simple_regrid_lfric` for edges.
+    """
+    src_xy = np.column_stack(
+        [
+            np.ma.getdata(src_cube.coord(name).points)
+            for name in ("longitude", "latitude")
+        ]
+    )
+    tgt_xy = np.column_stack([i.ravel() for i in get_xy_grids(tgt_cube)])
+    tri = Delaunay(src_xy)
+    simplex = tri.find_simplex(tgt_xy)
+    inside = simplex >= 0
+    # Barycentric coordinates of the target points inside the triangles
+    trans = tri.transform[simplex[inside]]
+    bary = np.einsum("ijk,ik->ij", trans[:, :2], tgt_xy[inside] - trans[:, 2])
+    bary = np.column_stack([bary, 1 - bary.sum(axis=1)])
+    rows = np.repeat(np.flatnonzero(inside), 3)
+    cols = tri.simplices[simplex[inside]].ravel()
+    vals = bary.ravel()
+    # Nearest neighbours of the other points
+    outside = np.flatnonzero(~inside)
+    if outside.size > 0:
+        _, nearest = cKDTree(src_xy).query(tgt_xy[outside])
+        rows = np.concatenate([rows, outside])
+        cols = np.concatenate([cols, nearest])
+        vals = np.concatenate([vals, np.ones(outside.size)])
+    return scipy.sparse.csr_matrix(
+        (vals, (rows, cols)), shape=(tgt_xy.shape[0], src_xy.shape[0])
+    )
+
+
+def mesh_to_grid_weights(
+    src_cube, tgt_cube, method="conservative", cache_dir=None, model=lfric
+):
+    """
+    Get a sparse matrix regridding data on a mesh to a lat-lon grid.
+
+    Fields on mesh faces or nodes use ESMF weights with the given method,
+    read from `cache_dir` if available. Fields on edges are interpolated
+    linearly in the lon-lat plane, whatever the method.
+
+    Parameters
+    ----------
+    src_cube: iris.cube.Cube
+        Cube on the source mesh.
+    tgt_cube: iris.cube.Cube
+        Cube on the target lat-lon grid.
+    method: str, optional
+        Regridding method: "conservative" or "bilinear".
+    cache_dir: pathlib.Path, optional
+        Directory with cached ESMF regridding weights.
+    model: aeolus.model.Model, optional
+        Model class with relevant coordinate names.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Matrix of shape (lat * lon, mesh elements), with rows in C order
+        of the grid normalised to sum to 1.
+    """
+    location = src_cube.location
+    if location == "edge":
+        method = "linear"
+    key = (
+        f"{mesh_fingerprint(src_cube, location=location)}"
+        f"__{grid_fingerprint(tgt_cube, model=model)}__{method}"
+    )
+    try:
+        return _WEIGHTS[key]
+    except KeyError:
+        pass
+
+    tgt_shape = (
+        tgt_cube.coord(model.y).shape[0],
+        tgt_cube.coord(model.x).shape[0],
+    )
+    if location == "edge":
+        weights = _triangulation_weights(src_cube, tgt_cube)
+    else:
+        fname = None if cache_dir is None else Path(cache_dir) / f"{key}.npz"
+        if (fname is not None) and fname.exists():
+            # Reading the weights does not require ESMF
+            weights = scipy.sparse.load_npz(fname)
+        else:
+            regridder = get_mesh_to_grid_regridder(
+                src_cube,
+                tgt_cube,
+                method=method,
+                cache_dir=cache_dir,
+                model=model,
+            )
+            weights = regridder.regridder.weight_matrix
+        weights = _esmf_to_grid_order(weights, tgt_shape)
+    # Normalise by the fraction of each target cell covered by the mesh
+    row_sums = np.asarray(weights.sum(axis=1)).ravel()
+    row_sums[row_sums == 0] = 1
+    weights = scipy.sparse.diags(1 / row_sums) @ weights
+    _WEIGHTS[key] = weights.tocsr()
+    return _WEIGHTS[key]
+
+
+def _regrid_matrix(weights, flat, mdtol=0):
+    """
+    Multiply data of shape (mesh elements, other) by the weights.
+
+    Masked points are excluded. Target points are masked if the fraction
+    of their weight coming from masked source points exceeds `mdtol`,
+    as in `MeshToGridESMFRegridder`, or if there are no valid source
+    points.
+    """
+    if not np.ma.is_masked(flat):
+        return weights @ np.ma.getdata(flat)
+    valid = weights @ (~np.ma.getmaskarray(flat)).astype(weights.dtype)
+    result = weights @ np.ma.filled(flat, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = result / valid
+    # Rows of the weights sum to 1, allowing for rounding errors
+    masked_frac = 1 - valid
+    return np.ma.masked_where(
+        (valid <= 0) | (masked_frac > mdtol + MDTOL_EPS), result
+    )
+
+
+def _to_matrix(arr, mesh_dim):
+    """Reshape an array to (mesh elements, all other dimensions)."""
+    arr = np.moveaxis(arr, mesh_dim, 0)
+    return arr.reshape(arr.shape[0], -1), arr.shape[1:]
+
+
+def _from_matrix(flat, tgt_shape, extra_shape, mesh_dim):
+    """Reshape a regridded matrix, putting lat and lon at the mesh dim."""
+    return np.moveaxis(
+        flat.reshape(tgt_shape + extra_shape),
+        (0, 1),
+        (mesh_dim, mesh_dim + 1),
+    )
+
+
+def _regrid_block(block, weights, mesh_dim, tgt_shape, mdtol=0):
+    """Regrid an array along its mesh dimension in one multiplication."""
+    flat, extra_shape = _to_matrix(block, mesh_dim)
+    return _from_matrix(
+        _regrid_matrix(weights, flat, mdtol=mdtol),
+        tgt_shape,
+        extra_shape,
+        mesh_dim,
+    )
+
+
+def _grid_cube(data, src_cube, tgt_cube, model=lfric):
+    """Make a cube on the target grid with the metadata of a mesh cube."""
+    mesh_dim = src_cube.mesh_dim()
+    result = iris.cube.Cube(data)
+    result.metadata = src_cube.metadata
+
+    def new_dims(dims):
+        return tuple(i if i < mesh_dim else i + 1 for i in dims)
+
+    for coord in src_cube.dim_coords:
+        result.add_dim_coord(
+            coord.copy(), new_dims(src_cube.coord_dims(coord))
+        )
+    for coord in src_cube.aux_coords:
+        dims = src_cube.coord_dims(coord)
+        if mesh_dim not in dims:
+            result.add_aux_coord(coord.copy(), new_dims(dims))
+    result.add_dim_coord(tgt_cube.coord(model.y).copy(), mesh_dim)
+    result.add_dim_coord(tgt_cube.coord(model.x).copy(), mesh_dim + 1)
+    return result
+
+
+def _regrid_lazy(cube, weights, tgt_shape, mdtol=0):
+    """Regrid lazy data of a cube chunk by chunk."""
+    mesh_dim = cube.mesh_dim()
+    # Each chunk has to contain the whole mesh
+    data = cube.lazy_data().rechunk({mesh_dim: -1})
+    chunks = list(data.chunks)
+    chunks[mesh_dim] = (tgt_shape[0],)
+    chunks.insert(mesh_dim + 1, (tgt_shape[1],))
+    dtype = np.result_type(weights.dtype, data.dtype)
+    return da.map_blocks(
+        _regrid_block,
+        data,
+        weights,
+        mesh_dim,
+        tgt_shape,
+        mdtol,
+        chunks=chunks,
+        new_axis=mesh_dim + 1,
+        dtype=dtype,
+        meta=np.ma.array([], dtype=dtype),
+    )
+
+
+def sparse_regrid(
+    cube_list,
+    tgt_cube,
+    method="conservative",
+    cache_dir=None,
+    mdtol=0,
+    model=lfric,
+):
+    """
+    Regrid cubes from a mesh to a lat-lon grid by sparse matrix products.
+
+    Each field is reshaped to (mesh elements, times x levels) and
+    multiplied by the weights of its mesh location at once. Fields with
+    real data on the same location are stacked and regridded together.
+    Lazy data stay lazy and are regridded chunk by chunk.
+
+    Parameters
+    ----------
+    cube_list: iris.cube.CubeList
+        Cubes on a UGRID mesh.
+    tgt_cube: iris.cube.Cube
+        Cube on the target lat-lon grid.
+    method: str, optional
+        Regridding method of fields on faces, see `mesh_to_grid_weights`.
+    cache_dir: pathlib.Path, optional
+        Directory with cached ESMF regridding weights.
+    mdtol: float, optional
+        Tolerance of missing data, from 0 to 1. Target points are masked
+        if a larger fraction of their weight comes from masked source
+        points. The default, 0, is the default of
+        `MeshToGridESMFRegridder`; 1 masks only target points without
+        any valid source points.
+    model: aeolus.model.Model, optional
+        Model class with relevant coordinate names.
+
+    Returns
+    -------
+    iris.cube.CubeList
+        Regridded cubes in the same order as `cube_list`.
+    """
+    tgt_shape = (
+        tgt_cube.coord(model.y).shape[0],
+        tgt_cube.coord(model.x).shape[0],
+    )
+    result = [None] * len(cube_list)
+    batches = {}
+    for i, cube in enumerate(cube_list):
+        weights = mesh_to_grid_weights(
+            cube, tgt_cube, method=method, cache_dir=cache_dir, model=model
+        )
+        if cube.has_lazy_data():
+            data = _regrid_lazy(cube, weights, tgt_shape, mdtol=mdtol)
+            result[i] = _grid_cube(data, cube, tgt_cube, model=model)
+        else:
+            batches.setdefault(id(weights), (weights, []))[1].append(i)
+    for weights, idx in batches.values():
+        # Stack all fields on this location to multiply them at once
+        flats, extra_shapes = zip(
+            *[
+                _to_matrix(cube_list[i].data, cube_list[i].mesh_dim())
+                for i in idx
+            ]
+        )
+        regridded = _regrid_matrix(
+            weights, np.ma.concatenate(flats, axis=1), mdtol=mdtol
+        )
+        ends = np.cumsum([flat.shape[1] for flat in flats])
+        for i, flat, extra_shape in zip(
+            idx, np.split(regridded, ends[:-1], axis=1), extra_shapes
+        ):
+            cube = cube_list[i]
+            data = _from_matrix(flat, tgt_shape, extra_shape, cube.mesh_dim())
+            result[i] = _grid_cube(data, cube, tgt_cube, model=model)
+    return iris.cube.CubeList(result)
+
+
+def compare_with_esmf(
+    cube, tgt_cube, method="conservative", cache_dir=None, model=lfric
+):
+    """
+    Compare `sparse_regrid` with `MeshToGridESMFRegridder` for one cube.
+
+    Both use the default tolerance of missing data (`mdtol=0`).
+
+    Parameters
+    ----------
+    cube: iris.cube.Cube
+        Cube on mesh faces or nodes.
+    tgt_cube: iris.cube.Cube
+        Cube on the target lat-lon grid.
+    method: str, optional
+        Regridding method: "conservative" or "bilinear".
+    cache_dir: pathlib.Path, optional
+        Directory with cached ESMF regridding weights.
+    model: aeolus.model.Model, optional
+        Model class with relevant coordinate names.
+
+    Returns
+    -------
+    float
+        Maximum absolute difference of the unmasked values.
+    bool
+        True if the masks are the same.
+    """
+    regridder = get_mesh_to_grid_regridder(
+        cube, tgt_cube, method=method, cache_dir=cache_dir, model=model
+    )
+    expected = np.ma.masked_invalid(regridder(cube).data)
+    actual = sparse_regrid(
+        iris.cube.CubeList([cube]),
+        tgt_cube,
+        method=method,
+        cache_dir=cache_dir,
+        model=model,
+    )[0].data
+    same_mask = np.array_equal(
+        np.ma.getmaskarray(expected), np.ma.getmaskarray(actual)
+    )
+    diff = np.ma.masked_invalid(np.ma.abs(actual - expected))
+    return float(diff.max()) if diff.count() > 0 else 0.0, same_mask
+
+
+def _interp_levels_block(block, src_points, tgt_points, axis):
+    """Interpolate an array linearly along `axis`, extrapolating linearly."""
+    upper = np.clip(
+        np.searchsorted(src_points, tgt_points), 1, len(src_points) - 1
+    )
+    lower = upper - 1
+    frac = (tgt_points - src_points[lower]) / (
+        src_points[upper] - src_points[lower]
+    )
+    shape = [1] * block.ndim
+    shape[axis] = -1
+    frac = frac.reshape(shape)
+    return (
+        np.take(block, lower, axis=axis) * (1 - frac)
+        + np.take(block, upper, axis=axis) * frac
+    )
+
+
+def interp_levels(cube, tgt_points, model=lfric):
+    """
+    Interpolate a cube linearly to new heights, keeping its data lazy.
+
+    Same as `cube.interpolate([(model.z, tgt_points)], iris.analysis.Linear())`
+    for increasing heights, but lazy data are interpolated chunk by chunk.
+    Auxiliary coordinates spanning the height dimension are dropped, and
+    extrapolated points next to a masked point are masked.
+    """
+    src_coord = cube.coord(model.z)
+    (axis,) = cube.coord_dims(src_coord)
+    src_points = src_coord.points
+    tgt_points = np.asarray(tgt_points)
+    args = (src_points, tgt_points, axis)
+    if cube.has_lazy_data():
+        # Each chunk has to contain the whole column
+        data = cube.lazy_data().rechunk({axis: -1})
+        chunks = list(data.chunks)
+        chunks[axis] = (len(tgt_points),)
+        dtype = np.result_type(tgt_points.dtype, data.dtype)
+        data = da.map_blocks(
+            _interp_levels_block,
+            data,
+            *args,
+            chunks=chunks,
+            dtype=dtype,
+            meta=np.ma.array([], dtype=dtype),
+        )
+    else:
+        data = _interp_levels_block(cube.data, *args)
+    result = iris.cube.Cube(data)
+    result.metadata = cube.metadata
+    for coord in cube.dim_coords:
+        dims = cube.coord_dims(coord)
+        if coord is src_coord:
+            result.add_dim_coord(
+                coord.copy(points=tgt_points, bounds=None), dims
+            )
+        else:
+            result.add_dim_coord(coord.copy(), dims)
+    for coord in cube.aux_coords:
+        dims = cube.coord_dims(coord)
+        if axis not in dims:
+            result.add_aux_coord(coord.copy(), dims)
+    return result
+
+
+def regrid_lfric_cached(
+    cube_list,
+    tgt_cube,
+    ref_cube_constr="air_potential_temperature",
+    interp_vertically=True,
+    method="conservative",
+    cache_dir=None,
+    mdtol=0,
+    model=lfric,
+):
+    """
+    Regrid LFRic data to a common height/lat/lon grid using cached weights.
+
+    Same as `aeolus.lfric.simple_regrid_lfric`, but the horizontal
+    regridding is done by `sparse_regrid`, and the weights are reused.
+    Lazy data stay lazy, including after the vertical interpolation.
+    """
+    ref_cube = cube_list.extract_cube(ref_cube_constr)
+    # Horizontal regridding
+    result = sparse_regrid(
+        cube_list,
+        tgt_cube,
+        method=method,
+        cache_dir=cache_dir,
+        mdtol=mdtol,
+        model=model,
+    )
+    if interp_vertically:
+        # Vertical interpolation
+        result_v = iris.cube.CubeList()
+        tgt_points = ref_cube.coord(model.z).points
+        for cube in result:
+            if [i for i in cube.dim_coords if i.name().endswith("_levels")]:
+                result_v.append(
+                    interp_levels(
+                        replace_level_coord_with_height(cube),
+                        tgt_points,
+                        model=model,
+                    )
+                )
+            else:
+                result_v.append(cube)
+        result = result_v
+    return result
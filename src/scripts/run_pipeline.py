@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Run the post-processing scripts for all models and experiments."""
+# Standard library
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+import shlex
+import subprocess
+import sys
+from time import time
+
+# External modules
+from aeolus.log import create_logger
+
+# Local modules
+import paths
+from shared import MODELS, TF_CASES, THAI_CASES
+
+# Global definitions and styles
+SCRIPT = Path(__file__).name
+SIM_CASES = {**TF_CASES, **THAI_CASES}
+
+
+def parse_args(args=None):
+    """Argument parser."""
+    ap = argparse.ArgumentParser(
+        SCRIPT,
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        epilog=f"""Usage:
+./{SCRIPT} -m lfric -c hs el tle -w 4
+./{SCRIPT} --dry_run
+""",
+    )
+    ap.add_argument(
+        "-m",
+        "--models",
+        type=str,
+        nargs="+",
+        default=[*MODELS],
+        choices=[*MODELS],
+        help="Models",
+    )
+    ap.add_argument(
+        "-c",
+        "--cases",
+        type=str,
+        nargs="+",
+        default=[*SIM_CASES],
+        choices=[*SIM_CASES],
+        help="Simulation labels",
+    )
+    ap.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Maximum number of tasks running at the same time",
+    )
+    ap.add_argument(
+        "--no_aggr",
+        action="store_true",
+        default=False,
+        help="Do NOT compute spatial statistics of raw LFRic output",
+    )
+    ap.add_argument(
+        "--force",
+        action="store_true",
+        default=False,
+        help="Run all tasks even if their outputs are up to date",
+    )
+    ap.add_argument(
+        "--dry_run",
+        action="store_true",
+        default=False,
+        help="Only print the tasks that would be run",
+    )
+    return ap.parse_args(args)
+
+
+def _script(name, *args):
+    """Command to run one of the scripts in this directory."""
+    return [sys.executable, str(paths.scripts / name), *map(str, args)]
+
+
+def pp_args(sim_prop, model_key):
+    """Extra arguments of the model-specific processing scripts."""
+    if model_key == "lfric":
+        return (
+            *("--level_height", sim_prop["level_height"]),
+            *("--model_top", sim_prop["model_top"]),
+        )
+    return ("--timestep", sim_prop["timestep"])
+
+
+def build_tasks(models, cases, aggr=True):
+    """
+    Build a graph of processing tasks.
+
+    Each task is a dictionary with the command to run, the names of tasks
+    it depends on and lists of (directory, glob pattern) pairs describing
+    its input and output files.
+    """
+    tasks = {}
+    for model_key in models:
+        model_prop = MODELS[model_key]
+        for sim_label in cases:
+            sim_prop = SIM_CASES[sim_label]
+            raw_dir = model_prop["data_raw_path"] / sim_label
+            proc_dir = model_prop["data_proc_path"] / sim_label
+            io_args = ("-i", raw_dir, "-o", proc_dir)
+            case_args = ("-p", sim_prop["planet"], "-l", sim_label, *io_args)
+            if model_key == "lfric":
+                raw_files = [(raw_dir, "*/*/lfric_diag.nc")]
+            else:
+                raw_files = [(raw_dir, "atmosa*")]
+
+            # Interpolate model output to a common grid
+            pp_task = f"pp:{model_key}:{sim_label}"
+            tasks[pp_task] = {
+                "cmd": _script(
+                    f"pp_{model_key}_data.py",
+                    *case_args,
+                    *pp_args(sim_prop, model_key),
+                ),
+                "deps": [],
+                "inputs": raw_files,
+                "outputs": [(proc_dir, f"{sim_label}_*_regr.nc")],
+            }
+            last_task = pp_task
+
+            # Interpolate to sigma-p levels
+            if sim_prop["proc_fname_suffix"] == "sigma_p":
+                sigma_task = f"sigma_p:{model_key}:{sim_label}"
+                tasks[sigma_task] = {
+                    "cmd": _script(
+                        "interp_to_sigma_p.py", "-m", model_key, "-i", proc_dir
+                    ),
+                    "deps": [pp_task],
+                    "inputs": [(proc_dir, f"{sim_label}_*_regr.nc")],
+                    "outputs": [(proc_dir, f"{sim_label}_*_sigma_p.nc")],
+                }
+                last_task = sigma_task
+
+            # Average in time
+            suffix = sim_prop["proc_fname_suffix"]
+            tasks[f"time_mean:{model_key}:{sim_label}"] = {
+                "cmd": _script(
+                    "time_mean_proc_data.py", "-m", model_key, "-c", sim_label
+                ),
+                "deps": [last_task],
+                "inputs": [(proc_dir, f"{sim_label}*{suffix}.nc")],
+                "outputs": [
+                    (
+                        paths.data_final / model_key / sim_label,
+                        f"{sim_label}_{suffix}_time_mean.nc",
+                    )
+                ],
+            }
+
+            # Spatial statistics of raw output
+            if aggr and model_key == "lfric":
+                tasks[f"aggr:{model_key}:{sim_label}"] = {
+                    "cmd": _script(
+                        "aggr_raw_lfric_data.py",
+                        *case_args,
+                        *("--level_height", sim_prop["level_height"]),
+                        *("--model_top", sim_prop["model_top"]),
+                        "--zonal_mean",
+                        "--column_integrals",
+                    ),
+                    "deps": [],
+                    "inputs": raw_files,
+                    "outputs": [(proc_dir, f"{sim_label}_*_aggr.nc")],
+                }
+
+    # Global diagnostics of all time-mean files
+    time_mean_tasks = [i for i in tasks if i.startswith("time_mean:")]
+    tasks["global_diags"] = {
+        "cmd": _script("global_diags.py", "-m", *models, "-c", *cases),
+        "deps": time_mean_tasks,
+        "inputs": [j for i in time_mean_tasks for j in tasks[i]["outputs"]],
+        "outputs": [(paths.data_final, "global_diags.nc")],
+    }
+    return tasks
+
+
+def _mtimes(patterns):
+    """Modification times of files matching (directory, pattern) pairs."""
+    return [
+        fname.stat().st_mtime
+        for directory, pattern in patterns
+        for fname in Path(directory).glob(pattern)
+    ]
+
+
+def is_up_to_date(task):
+    """Check if all outputs of a task exist and are newer than its inputs."""
+    out_mtimes = _mtimes(task["outputs"])
+    if len(out_mtimes) == 0:
+        return False
+    return min(out_mtimes) >= max(_mtimes(task["inputs"]), default=0)
+
+
+def select_tasks(tasks, force=False):
+    """Find tasks that need running, including all downstream tasks."""
+    stale = set()
+    # Visit tasks in dependency order
+    for name in topological_order(tasks):
+        task = tasks[name]
+        if force or any(i in stale for i in task["deps"]):
+            stale.add(name)
+        elif not is_up_to_date(task):
+            stale.add(name)
+    return stale
+
+
+def topological_order(tasks):
+    """Sort task names so that every task comes after its dependencies."""
+    order = []
+    visited = set()
+
+    def visit(name):
+        if name in visited:
+            return
+        visited.add(name)
+        for dep in tasks[name]["deps"]:
+            visit(dep)
+        order.append(name)
+
+    for name in tasks:
+        visit(name)
+    return order
+
+
+def run_task(task):
+    """Run a task in a subprocess and return its exit code and run time."""
+    t0 = time()
+    proc = subprocess.run(task["cmd"], cwd=paths.scripts)
+    return proc.returncode, time() - t0
+
+
+def run_tasks(tasks, to_run, workers=1, logger=None):
+    """
+    Run the selected tasks respecting their dependencies.
+
+    Returns
+    -------
+    dict
+        Exit code and run time of each task that has been run.
+    """
+    results = {}
+    failed = set()
+    pending = [i for i in topological_order(tasks) if i in to_run]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        while pending or running:
+            # Submit all tasks whose dependencies have finished successfully
+            for name in [*pending]:
+                deps = [i for i in tasks[name]["deps"] if i in to_run]
+                if any(i in failed for i in deps):
+                    logger.warning(f"Skipping {name}: dependency failed")
+                    failed.add(name)
+                    pending.remove(name)
+                elif all(i in results for i in deps):
+                    logger.info(f"Starting {name}")
+                    running[executor.submit(run_task, tasks[name])] = name
+                    pending.remove(name)
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+                if results[name][0] != 0:
+                    logger.error(f"{name} failed")
+                    failed.add(name)
+                else:
+                    logger.success(f"{name} done in {results[name][1]:.1f}s")
+    return results
+
+
+def main(args=None):
+    """Main entry point of the script."""
+    t0 = time()
+    L = create_logger(Path(__file__))
+    # Parse command-line arguments
+    args = parse_args(args)
+
+    tasks = build_tasks(args.models, args.cases, aggr=not args.no_aggr)
+    to_run = select_tasks(tasks, force=args.force)
+    L.info(f"{len(to_run)} of {len(tasks)} tasks need running")
+    if args.dry_run:
+        for name in topological_order(tasks):
+            if name in to_run:
+                L.info(f"{name}: {shlex.join(tasks[name]['cmd'])}")
+        return
+
+    results = run_tasks(tasks, to_run, workers=args.workers, logger=L)
+    for name, (returncode, elapsed) in results.items():
+        L.info(f"{name:<30} {returncode=} {elapsed:8.1f}s")
+    L.info(f"Execution time: {time() - t0:.1f}s")
+    # Failed tasks and tasks skipped because of them
+    failed = [
+        name
+        for name in topological_order(tasks)
+        if (name in to_run) and (results.get(name, (1,))[0] != 0)
+    ]
+    if failed:
+        L.critical(f"{len(failed)} of {len(to_run)} tasks failed: {failed}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
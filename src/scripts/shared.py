@@ -37,6 +37,8 @@ TF_CASES = {
         "planet": "earth",
         "kw_plt": {"color": "C0"},
         "timestep": 1800,
+        "level_height": "uniform",
+        "model_top": 32000,
         "time_mean_period": 1000,
         "proc_fname_suffix": "sigma_p",
     },
@@ -46,6 +48,8 @@ TF_CASES = {
         "planet": "earth",
         "kw_plt": {"color": "C1"},
         "timestep": 1800,
+        "level_height": "uniform",
+        "model_top": 32000,
         "time_mean_period": 1000,
         "proc_fname_suffix": "sigma_p",
     },
@@ -55,6 +59,8 @@ TF_CASES = {
         "planet": "tle",
         "kw_plt": {"color": "C2"},
         "timestep": 1800,
+        "level_height": "uniform",
+        "model_top": 32000,
         "time_mean_period": 1000,
         "proc_fname_suffix": "sigma_p",
     },
@@ -67,6 +73,8 @@ THAI_CASES = {
         "planet": "ben1",
         "kw_plt": {"color": "C0"},
         "timestep": 1200,
+        "level_height": "um_L38_29t_9s_40km",
+        "model_top": 40000,
         "time_mean_period": 610,
         "proc_fname_suffix": "regr",
     },
@@ -76,6 +84,8 @@ THAI_CASES = {
         "planet": "ben2",
         "kw_plt": {"color": "C1"},
         "timestep": 1200,
+        "level_height": "um_L38_29t_9s_40km",
+        "model_top": 40000,
         "time_mean_period": 610,
         "proc_fname_suffix": "regr",
     },
@@ -85,6 +95,8 @@ THAI_CASES = {
         "planet": "hab1",
         "kw_plt": {"color": "C2"},
         "timestep": 1200,
+        "level_height": "um_L38_29t_9s_40km",
+        "model_top": 40000,
         "time_mean_period": 610,
         "proc_fname_suffix": "regr",
     },
@@ -94,6 +106,8 @@ THAI_CASES = {
         "planet": "hab2",
         "kw_plt": {"color": "C3"},
         "timestep": 1200,
+        "level_height": "um_L38_29t_9s_40km",
+        "model_top": 40000,
         "time_mean_period": 610,
         "proc_fname_suffix": "regr",
     },
@@ -1,21 +1,33 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """Average post-processed data in time and save as a netCDF file."""
-import warnings
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
+from functools import partial
+from pathlib import Path
+import sys
+from time import time
+import warnings
 
 # External modules
 import iris
-from aeolus.calc import last_n_day_mean
-from aeolus.io import load_data, save_cubelist
+from aeolus.calc import time_mean
+from aeolus.io import load_data
+from aeolus.log import create_logger
+from aeolus.subset import extract_last_n_days
+import numpy as np
 from tqdm import tqdm
 
 # Local modules
+from io_utils import CHUNK_LAYOUTS, save_output
 import paths
+from profiling import PROFILER, WorkerTask, stage
 from shared import MODELS, TF_CASES, THAI_CASES
 
 # Ignore warnings about time coordinate bounds
 warnings.filterwarnings("ignore")
+SCRIPT = Path(__file__).name
 
 # Define global attributes of the output file
 GLOBAL_ATTRS = {
@@ -30,38 +42,277 @@ GLOBAL_ATTRS = {
 
 # Combine all experiments into one dictionary
 SIM_CASES = {**TF_CASES, **THAI_CASES}
+# Number of time slices to read at once
+TIME_CHUNK = 24
+# Also save the variance of each field over the averaging period
+CALC_VARIANCE = False
+
+
+def _merge_moments(acc, chunk):
+    """Combine counts, means and sums of squared deviations of two samples."""
+    n_a, mean_a, m2_a = acc
+    n_b, mean_b, m2_b = chunk
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    frac = np.divide(n_b, n, out=np.zeros_like(mean_a), where=n > 0)
+    mean = mean_a + delta * frac
+    m2 = m2_a + m2_b + delta**2 * n_a * frac
+    return n, mean, m2
+
+
+def _to_output(arr, mask, dtype):
+    """Cast an accumulated array and mask points with too few samples."""
+    arr = arr.astype(dtype)
+    if mask.any():
+        arr = np.ma.masked_where(mask, arr)
+    return arr
+
+
+def stream_last_n_day_mean(
+    cube, days, model, time_chunk=TIME_CHUNK, variance=False
+):
+    """
+    Average the cube over the last `n` days reading a few time slices at once.
+
+    The result is the same as from `aeolus.calc.last_n_day_mean`, but only
+    the time slices within the averaging period are read, and no more than
+    `time_chunk` of them are held in memory. The mean (and the variance,
+    if requested) are accumulated using Welford's algorithm.
+
+    Returns
+    -------
+    iris.cube.CubeList
+        Time mean cube and, optionally, time variance cube.
+    """
+    cube_sub = extract_last_n_days(cube, days=days, model=model)
+    # Lazy collapse to get the metadata of the result
+    template = time_mean(cube_sub, model=model)
+    if template.shape == cube_sub.shape:
+        # Nothing to average
+        return iris.cube.CubeList([template])
+    (t_dim,) = cube_sub.coord_dims(model.t)
+    src = np.moveaxis(cube_sub.lazy_data(), t_dim, 0)
+    acc = (
+        np.zeros(template.shape),
+        np.zeros(template.shape),
+        np.zeros(template.shape),
+    )
+    for i0 in range(0, src.shape[0], time_chunk):
+        i1 = min(i0 + time_chunk, src.shape[0])
+        arr = np.ma.masked_invalid(src[i0:i1].compute().astype(np.float64))
+        n_b = arr.count(axis=0)
+        mean_b = np.ma.filled(arr.mean(axis=0), 0.0)
+        m2_b = np.ma.filled(((arr - mean_b) ** 2).sum(axis=0), 0.0)
+        acc = _merge_moments(acc, (n_b, mean_b, m2_b))
+    n, mean, m2 = acc
+    result = iris.cube.CubeList(
+        [template.copy(data=_to_output(mean, n == 0, template.dtype))]
+    )
+    if variance:
+        var = m2 / np.maximum(n - 1, 1)
+        cube_var = template.copy(data=_to_output(var, n < 2, template.dtype))
+        *cell_methods, mean_method = template.cell_methods
+        cube_var.cell_methods = (
+            *cell_methods,
+            iris.coords.CellMethod("variance", coords=mean_method.coord_names),
+        )
+        cube_var.units = template.units**2
+        cube_var.rename(f"{cube.name()}_time_variance")
+        result.append(cube_var)
+    return result
+
+
+def parse_args(args=None):
+    """Argument parser."""
+    ap = argparse.ArgumentParser(
+        SCRIPT,
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        epilog=f"""Usage:
+./{SCRIPT} -m lfric -c hs el tle -w 3
+""",
+    )
+    ap.add_argument(
+        "-m",
+        "--models",
+        type=str,
+        nargs="+",
+        default=["lfric"],
+        choices=[*MODELS],
+        help="Models",
+    )
+    ap.add_argument(
+        "-c",
+        "--cases",
+        type=str,
+        nargs="+",
+        default=[*SIM_CASES],
+        choices=[*SIM_CASES],
+        help="Simulation labels",
+    )
+    ap.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Maximum number of cases processed in parallel",
+    )
+    ap.add_argument(
+        "--time_chunk",
+        type=int,
+        default=TIME_CHUNK,
+        help="Number of time slices to read at once",
+    )
+    ap.add_argument(
+        "--variance",
+        action="store_true",
+        default=CALC_VARIANCE,
+        help="Also save the variance over the averaging period",
+    )
+    ap.add_argument(
+        "--complevel",
+        type=int,
+        default=4,
+        help="Compression level of the output, from 0 (none) to 9",
+    )
+    ap.add_argument(
+        "--chunk_layout",
+        type=str,
+        default="slice",
+        choices=CHUNK_LAYOUTS,
+        help=(
+            "Chunk shape of the output: 'slice' for maps and cross-sections,"
+            " 'column' for vertical profiles and time series"
+        ),
+    )
+    ap.add_argument(
+        "--zarr",
+        action="store_true",
+        default=False,
+        help=(
+            "Write a Zarr store instead of a netCDF file"
+            " (for notebooks; not read by the other scripts)"
+        ),
+    )
+    ap.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help=(
+            "Directory to which a report on the time, memory and I/O"
+            " of each processing stage is written"
+        ),
+    )
+    ap.add_argument(
+        "--cprofile",
+        action="store_true",
+        default=False,
+        help="Also save cProfile statistics to the --profile directory",
+    )
+    return ap.parse_args(args)
+
+
+def process_case(
+    model_key, sim_label, time_chunk=TIME_CHUNK, variance=False, **kw_out
+):
+    """
+    Average one experiment of one model in time and save the result.
 
-# Loop over models (UM, LFRic)
-for model_key, model_prop in tqdm(MODELS.items()):
-    if model_key != "lfric":
-        continue
+    Other keyword arguments are passed to `io_utils.save_output`.
+    """
+    t0 = time()
+    model_prop = MODELS[model_key]
+    sim_prop = SIM_CASES[sim_label]
     model = model_prop["model"]
 
-    # Loop over experiments
-    for sim_label, sim_prop in tqdm(SIM_CASES.items(), leave=False):
-        fname_mask = f"{sim_label}*{sim_prop['proc_fname_suffix']}.nc"
+    fname_mask = f"{sim_label}*{sim_prop['proc_fname_suffix']}.nc"
+    with stage("load"):
         dset = load_data(
             sorted((model_prop["data_proc_path"] / sim_label).glob(fname_mask))
         )
-        # Average each cube in time and append them to a new cube list
-        dset_tm = iris.cube.CubeList()
-        for cube in dset:
-            dset_tm.append(
-                last_n_day_mean(
-                    cube, days=sim_prop["time_mean_period"], model=model
+    # Average each cube in time and append them to a new cube list
+    dset_tm = iris.cube.CubeList()
+    for cube in dset:
+        with stage("time_mean"):
+            dset_tm.extend(
+                stream_last_n_day_mean(
+                    cube,
+                    days=sim_prop["time_mean_period"],
+                    model=model,
+                    time_chunk=time_chunk,
+                    variance=variance,
                 )
             )
-        # Define and create a new data directory
-        outdir = paths.data_final / model_key / sim_label
-        outdir.mkdir(parents=True, exist_ok=True)
-        fname_out = (
-            outdir
-            / f"{sim_label}_{sim_prop['proc_fname_suffix']}_time_mean.nc"
-        )
-        # Update global attributes to insert the name of the model
-        GLOBAL_ATTRS["title"] = f"Model Output from {model_prop['title']}"
-        GLOBAL_ATTRS[
-            "date_created"
-        ] = f"{datetime.utcnow():%Y-%m-%d %H:%M:%S} GMT"
-        # Save the result
-        save_cubelist(dset_tm, fname_out, **GLOBAL_ATTRS)
+    # Define and create a new data directory
+    outdir = paths.data_final / model_key / sim_label
+    outdir.mkdir(parents=True, exist_ok=True)
+    fname_out = (
+        outdir / f"{sim_label}_{sim_prop['proc_fname_suffix']}_time_mean.nc"
+    )
+    # Update global attributes to insert the name of the model
+    gl_attrs = {
+        **GLOBAL_ATTRS,
+        "title": f"Model Output from {model_prop['title']}",
+        "date_created": f"{datetime.utcnow():%Y-%m-%d %H:%M:%S} GMT",
+    }
+    # Save the result
+    with stage("save"):
+        fname_out = save_output(dset_tm, fname_out, **kw_out, **gl_attrs)
+    return fname_out, time() - t0
+
+
+def main(args=None):
+    """Main entry point of the script."""
+    t0 = time()
+    L = create_logger(Path(__file__))
+    # Parse command-line arguments
+    args = parse_args(args)
+    PROFILER.start(
+        track_memory=args.profile is not None,
+        cprofile=(args.profile is not None) and args.cprofile,
+    )
+    # Each (model, experiment) pair is independent
+    tasks = [
+        (model_key, sim_label)
+        for model_key in args.models
+        for sim_label in args.cases
+    ]
+    L.info(f"{tasks=}")
+    func = partial(
+        process_case,
+        time_chunk=args.time_chunk,
+        variance=args.variance,
+        layout=args.chunk_layout,
+        complevel=args.complevel,
+        zarr=args.zarr,
+    )
+    timings = {}
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(WorkerTask(func), *task): task for task in tasks
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            task = futures[future]
+            try:
+                (fname_out, timings[task]), records = future.result()
+            except Exception as e:
+                L.error(f"{task} failed: {e!r}")
+                failed.append(task)
+            else:
+                PROFILER.extend(records)
+                L.success(f"Saved to {fname_out}")
+    # Report the time taken by each task
+    for (model_key, sim_label), elapsed in sorted(
+        timings.items(), key=lambda x: x[1], reverse=True
+    ):
+        L.info(f"{model_key:>6} {sim_label:<10} {elapsed:8.1f}s")
+    PROFILER.finish(args.profile, Path(__file__).stem, L=L)
+    L.info(f"Execution time: {time() - t0:.1f}s")
+    if failed:
+        L.critical(f"{len(failed)} of {len(tasks)} tasks failed: {failed}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
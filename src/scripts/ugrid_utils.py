@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+"""Fast operations on LFRic data defined on a UGRID mesh."""
+# External modules
+from aeolus.const import init_const
+from aeolus.lfric import ugrid_spatial
+from aeolus.model import lfric
+import dask.array as da
+import iris
+from iris.coords import CellMethod, DimCoord
+import numpy as np
+import scipy.sparse
+
+# Local modules
+import paths
+from regrid_utils import mesh_fingerprint
+
+
+# Aggregators that can be computed by `ugrid_spatial_stats`
+FUSED_AGGREGATORS = ("max", "mean", "median", "min", "std_dev", "variance")
+# Default latitude and longitude bands, the same as the regridded output
+LAT_EDGES = np.linspace(-90, 90, 91)
+LON_EDGES = np.linspace(-180, 180, 145)
+# In-memory caches of face areas and binning matrices for each mesh
+_FACE_AREAS = {}
+_CELL_AREAS = {}
+_BAND_MATRICES = {}
+
+
+def _chunk_stats(arr, aggrs, ddof=1):
+    """Calculate several statistics of an array along its last axis."""
+    if np.ma.is_masked(arr):
+        xp = np.ma
+        count = arr.count(axis=-1)
+    else:
+        xp = np
+        arr = np.ma.getdata(arr)
+        count = arr.shape[-1]
+    result = {}
+    if "max" in aggrs:
+        result["max"] = xp.max(arr, axis=-1)
+    if "min" in aggrs:
+        result["min"] = xp.min(arr, axis=-1)
+    if "median" in aggrs:
+        result["median"] = xp.median(arr, axis=-1)
+    if {"mean", "std_dev", "variance"}.intersection(aggrs):
+        # The sum is shared by all moments
+        mean = xp.sum(arr, axis=-1, dtype=np.float64) / count
+        result["mean"] = mean
+        if {"std_dev", "variance"}.intersection(aggrs):
+            # Sum of squared deviations from the mean of the in-memory chunk
+            dev = arr - mean[..., np.newaxis]
+            var = xp.sum(dev * dev, axis=-1, dtype=np.float64) / (count - ddof)
+            result["variance"] = var
+            result["std_dev"] = xp.sqrt(var)
+    return {aggr: result[aggr] for aggr in aggrs}
+
+
+def _make_stat_cube(template, aggr, data):
+    """Attach statistic values to the metadata of a collapsed cube."""
+    aggregator = getattr(iris.analysis, aggr.upper())
+    out = template.copy(data=data)
+    # Replace the cell method added by the template's aggregator
+    *cell_methods, template_method = template.cell_methods
+    out.cell_methods = (
+        *cell_methods,
+        CellMethod(aggregator.cell_method, coords=template_method.coord_names),
+    )
+    if aggregator.units_func is not None:
+        out.units = aggregator.units_func(template.units)
+    return out
+
+
+def ugrid_spatial_stats(
+    cube, aggrs=FUSED_AGGREGATORS, model=lfric, time_chunk=None, ddof=1
+):
+    """
+    Collapse a UGRID cube over x and y coord computing several statistics.
+
+    The result is equivalent to calling `aeolus.lfric.ugrid_spatial`
+    for each aggregator, but the data are read and traversed only once
+    per chunk of the leading (time) dimension.
+
+    Parameters
+    ----------
+    cube: iris.cube.Cube
+        Cube with a UGRID mesh dimension.
+    aggrs: sequence of str, optional
+        Names of the statistics. Must be a subset of `FUSED_AGGREGATORS`.
+    model: aeolus.model.Model, optional
+        Model class with relevant coordinate names.
+    time_chunk: int, optional
+        Number of time steps to realise at once.
+        If not given, the whole time series is processed in one go.
+    ddof: int, optional
+        Delta degrees of freedom for `std_dev` and `variance`.
+
+    Returns
+    -------
+    iris.cube.CubeList
+        Cube list with one collapsed cube per aggregator.
+    """
+    aggrs = [aggr.lower() for aggr in aggrs]
+    if unknown := set(aggrs).difference(FUSED_AGGREGATORS):
+        raise ValueError(f"Aggregators {unknown} are not supported.")
+    # Collapse lazily to get the metadata without touching the data
+    template = ugrid_spatial(
+        cube.copy(data=cube.lazy_data()), "max", model=model
+    )
+
+    # Put the mesh dimension last and iterate over the leading (time) one
+    mesh_dim = cube.coord_dims(cube.coord(model.x))[0]
+    src = da.moveaxis(cube.lazy_data(), mesh_dim, -1)
+    if src.ndim == 1:
+        src = src[np.newaxis]
+    ntime = src.shape[0]
+    if time_chunk is None:
+        time_chunk = max(ntime, 1)
+    chunks = {aggr: [] for aggr in aggrs}
+    for i0 in range(0, ntime, time_chunk):
+        i1 = min(i0 + time_chunk, ntime)
+        arr = src[i0:i1].compute()
+        for aggr, values in _chunk_stats(arr, aggrs, ddof=ddof).items():
+            chunks[aggr].append(values)
+
+    if np.issubdtype(cube.dtype, np.floating):
+        dtype = cube.dtype
+    else:
+        dtype = np.float64
+    result = iris.cube.CubeList()
+    for aggr in aggrs:
+        data = np.ma.concatenate(chunks[aggr]).astype(dtype)
+        if not np.ma.is_masked(data):
+            data = np.ma.getdata(data)
+        data = data.reshape(template.shape)
+        result.append(_make_stat_cube(template, aggr, data))
+    return result
+
+
+def face_areas(cube):
+    """
+    Calculate areas of the mesh faces on a unit sphere.
+
+    Each face is split into triangles sharing its first node, and the
+    spherical excess of each triangle is found by the formula
+    of Van Oosterom and Strackee (1983).
+
+    Returns
+    -------
+    numpy.ndarray
+        Face areas in steradians.
+    """
+    key = mesh_fingerprint(cube)
+    try:
+        return _FACE_AREAS[key]
+    except KeyError:
+        pass
+    mesh = cube.mesh
+    node_x, node_y = mesh.node_coords
+    lon = np.deg2rad(np.ma.getdata(node_x.points))
+    lat = np.deg2rad(np.ma.getdata(node_y.points))
+    xyz = np.column_stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)]
+    )
+    conn = mesh.face_node_connectivity
+    # Faces with fewer nodes have masked indices, filled with -1
+    idx = np.ma.filled(conn.indices_by_location() - conn.start_index, -1)
+    areas = np.zeros(idx.shape[0])
+    vert_a = xyz[idx[:, 0]]
+    for k in range(1, idx.shape[1] - 1):
+        vert_b = xyz[idx[:, k]]
+        vert_c = xyz[idx[:, k + 1]]
+        numer = np.abs(np.sum(vert_a * np.cross(vert_b, vert_c), axis=1))
+        denom = (
+            1
+            + np.sum(vert_a * vert_b, axis=1)
+            + np.sum(vert_b * vert_c, axis=1)
+            + np.sum(vert_c * vert_a, axis=1)
+        )
+        valid = idx[:, k + 1] >= 0
+        areas += np.where(valid, 2 * np.arctan2(numer, denom), 0)
+    _FACE_AREAS[key] = areas
+    return areas
+
+
+def band_matrix(cube, axis="y", edges=None, model=lfric):
+    """
+    Get a sparse matrix averaging mesh faces over latitude or longitude bands.
+
+    Each face is assigned to the band containing its centre, and weighted
+    by its area. Bands narrower than the faces may contain no face centres,
+    so the bands should be coarser than the mesh, e.g. 2 degrees for C48.
+    The matrices are cached for each mesh and set of bands.
+
+    Parameters
+    ----------
+    cube: iris.cube.Cube
+        Cube with data on mesh faces.
+    axis: str, optional
+        "y" for latitude bands (zonal means) or "x" for longitude bands
+        (meridional means).
+    edges: array-like, optional
+        Band edges in degrees. By default, `LAT_EDGES` or `LON_EDGES`.
+    model: aeolus.model.Model, optional
+        Model class with relevant coordinate names.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Matrix of shape (bands, faces) with rows summing to 1,
+        or to 0 for bands without faces.
+    """
+    if cube.location != "face":
+        raise ValueError(f"Data on {cube.location}s are not supported.")
+    if edges is None:
+        edges = LAT_EDGES if axis == "y" else LON_EDGES
+    edges = np.asarray(edges, dtype=np.float64)
+    key = (mesh_fingerprint(cube), axis, edges.tobytes())
+    try:
+        return _BAND_MATRICES[key]
+    except KeyError:
+        pass
+    coord = model.y if axis == "y" else model.x
+    points = np.ma.getdata(cube.coord(coord).points)
+    if axis == "x":
+        # Wrap longitudes to the range of the bands
+        points = (points - edges[0]) % 360 + edges[0]
+    band = np.digitize(points, edges) - 1
+    # Include the faces on the outer edges
+    band[points == edges[-1]] = edges.size - 2
+    inside = (band >= 0) & (band < edges.size - 1)
+    areas = face_areas(cube)
+    matrix = scipy.sparse.csr_matrix(
+        (areas[inside], (band[inside], np.flatnonzero(inside))),
+        shape=(edges.size - 1, points.size),
+    )
+    band_areas = np.asarray(matrix.sum(axis=1)).ravel()
+    band_areas[band_areas == 0] = 1
+    _BAND_MATRICES[key] = scipy.sparse.diags(1 / band_areas) @ matrix
+    return _BAND_MATRICES[key]
+
+
+def _replace_mesh_dim(cube, data, new_coord=None):
+    """
+    Make a cube without the mesh dimension, keeping the other coordinates.
+
+    If `new_coord` is given, it becomes the dimension coordinate in place
+    of the mesh. Otherwise the mesh dimension is removed.
+    """
+    mesh_dim = cube.mesh_dim()
+    shift = 0 if new_coord is not None else 1
+
+    def new_dims(dims):
+        return tuple(i if i < mesh_dim else i - shift for i in dims)
+
+    result = iris.cube.Cube(data)
+    result.metadata = cube.metadata
+    for coord in cube.dim_coords:
+        if (dims := cube.coord_dims(coord)) != (mesh_dim,):
+            result.add_dim_coord(coord.copy(), new_dims(dims))
+    for coord in cube.aux_coords:
+        if mesh_dim not in (dims := cube.coord_dims(coord)):
+            result.add_aux_coord(coord.copy(), new_dims(dims))
+    if new_coord is not None:
+        result.add_dim_coord(new_coord, mesh_dim)
+    return result
+
+
+def _band_mean_block(block, matrix, mesh_dim):
+    """Average an array over bands of its mesh dimension."""
+    arr = np.moveaxis(block, mesh_dim, 0)
+    flat = arr.reshape(arr.shape[0], -1)
+    # Normalise by the area of valid faces in each band
+    valid = matrix @ (~np.ma.getmaskarray(flat)).astype(matrix.dtype)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = (matrix @ np.ma.filled(flat, 0)) / valid
+    result = np.ma.masked_where(valid <= 0, result)
+    if not np.ma.is_masked(result):
+        result = np.ma.getdata(result)
+    return np.moveaxis(
+        result.reshape(matrix.shape[:1] + arr.shape[1:]), 0, mesh_dim
+    )
+
+
+def ugrid_band_mean(cube, axis="y", edges=None, model=lfric):
+    """
+    Average a UGRID cube over latitude or longitude bands.
+
+    The mesh dimension is replaced by the band dimension, and all times
+    and levels are averaged by one sparse matrix product. Lazy data stay
+    lazy, so that the function can be applied to raw LFRic output.
+    Bands without valid faces are masked.
+
+    Parameters
+    ----------
+    cube: iris.cube.Cube
+        Cube with data on mesh faces.
+    axis: str, optional
+        "y" to average along longitude in latitude bands (zonal mean),
+        "x" to average along latitude in longitude bands (meridional mean).
+    edges: array-like, optional
+        Band edges in degrees. By default, `LAT_EDGES` or `LON_EDGES`.
+    model: aeolus.model.Model, optional
+        Model class with relevant coordinate names.
+
+    Returns
+    -------
+    iris.cube.Cube
+        Cube with a latitude or longitude dimension instead of the mesh.
+    """
+    if axis not in ("x", "y"):
+        raise ValueError(f"axis={axis} is not valid.")
+    if edges is None:
+        edges = LAT_EDGES if axis == "y" else LON_EDGES
+    edges = np.asarray(edges, dtype=np.float64)
+    matrix = band_matrix(cube, axis=axis, edges=edges, model=model)
+    mesh_dim = cube.mesh_dim()
+    if cube.has_lazy_data():
+        # Each chunk has to contain the whole mesh
+        src = cube.lazy_data().rechunk({mesh_dim: -1})
+        chunks = list(src.chunks)
+        chunks[mesh_dim] = (matrix.shape[0],)
+        dtype = np.result_type(matrix.dtype, src.dtype)
+        data = da.map_blocks(
+            _band_mean_block,
+            src,
+            matrix,
+            mesh_dim,
+            chunks=chunks,
+            dtype=dtype,
+            meta=np.ma.array([], dtype=dtype),
+        )
+    else:
+        data = _band_mean_block(cube.data, matrix, mesh_dim)
+
+    band_coord = DimCoord(
+        0.5 * (edges[:-1] + edges[1:]),
+        bounds=np.column_stack([edges[:-1], edges[1:]]),
+        standard_name=model.y if axis == "y" else model.x,
+        units="degrees",
+    )
+    result = _replace_mesh_dim(cube, data, band_coord)
+    collapsed = model.x if axis == "y" else model.y
+    result.add_cell_method(CellMethod("mean", coords=collapsed))
+    return result
+
+
+def ugrid_zonal_mean(cube, lat_edges=None, model=lfric):
+    """
+    Calculate the zonal mean of a UGRID cube without regridding.
+
+    See `ugrid_band_mean` for details.
+    """
+    return ugrid_band_mean(cube, axis="y", edges=lat_edges, model=model)
+
+
+def ugrid_meridional_mean(cube, lon_edges=None, model=lfric):
+    """
+    Calculate the meridional mean of a UGRID cube without regridding.
+
+    See `ugrid_band_mean` for details.
+    """
+    return ugrid_band_mean(cube, axis="x", edges=lon_edges, model=model)
+
+
+def cell_areas(cube, const=None, planet=None):
+    """
+    Calculate areas of the mesh faces on a planet.
+
+    Parameters
+    ----------
+    cube: iris.cube.Cube
+        Cube with data on mesh faces.
+    const: aeolus.const.const.ConstContainer, optional
+        Planet constants, e.g. from `aeolus.const.init_const`.
+    planet: str, optional
+        Name of the planet configuration in the `const` directory,
+        used if `const` is not given. By default, the `planet_conf`
+        attribute of the cube.
+
+    Returns
+    -------
+    numpy.ndarray
+        Face areas in m**2, cached for each mesh and planet radius.
+    """
+    if const is None:
+        if planet is not None:
+            const = init_const(planet, directory=paths.const)
+        elif "planet_conf" in cube.attributes:
+            const = cube.attributes["planet_conf"]
+        else:
+            raise ValueError("Either const or planet must be given.")
+    radius = const.radius.copy()
+    radius.convert_units("m")
+    key = (mesh_fingerprint(cube), float(radius.data))
+    try:
+        return _CELL_AREAS[key]
+    except KeyError:
+        pass
+    _CELL_AREAS[key] = face_areas(cube) * float(radius.data) ** 2
+    return _CELL_AREAS[key]
+
+
+def ugrid_area_integral(cube, const=None, planet=None, mean=False):
+    """
+    Integrate or average a UGRID cube over the planet's surface.
+
+    All times and levels are weighted by the cell areas in one
+    vectorised product. Masked points are excluded. Lazy data stay lazy.
+
+    Parameters
+    ----------
+    cube: iris.cube.Cube
+        Cube with data on mesh faces.
+    const: aeolus.const.const.ConstContainer, optional
+        Planet constants.
+    planet: str, optional
+        Name of the planet configuration, used if `const` is not given.
+        By default, the `planet_conf` attribute of the cube.
+    mean: bool, optional
+        Calculate the area-weighted mean instead of the integral.
+
+    Returns
+    -------
+    iris.cube.Cube
+        Cube without the mesh dimension.
+    """
+    areas = cell_areas(cube, const=const, planet=planet)
+    mesh_dim = cube.mesh_dim()
+    if cube.has_lazy_data():
+        xp = da
+        src = cube.lazy_data()
+        valid = ~da.ma.getmaskarray(src)
+        src = da.ma.filled(src, 0)
+    else:
+        xp = np
+        src = cube.data
+        valid = ~np.ma.getmaskarray(src)
+        src = np.ma.filled(src, 0)
+    axes = ([mesh_dim], [0])
+    data = xp.tensordot(src, areas, axes=axes)
+    if mean:
+        # Normalise by the area of valid points, masking where there are none
+        valid_area = xp.tensordot(valid.astype(areas.dtype), areas, axes=axes)
+        empty = valid_area <= 0
+        data = xp.ma.masked_where(empty, data / xp.where(empty, 1, valid_area))
+    result = _replace_mesh_dim(cube, data)
+    if mean:
+        result.add_cell_method(CellMethod("mean", coords="area"))
+    else:
+        result.units = cube.units * "m2"
+        result.add_cell_method(CellMethod("sum", coords="area"))
+    return result